@@ -0,0 +1,240 @@
+import dataclasses
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+import psutil
+import torch
+
+import constants
+from checkpoint import atomic_write
+from config import VideoMAEExperimentConfig
+from ecog_setup import create_model
+from pretrain_engine import model_forward
+from utils import PRECISION_DTYPES, get_autocast
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE = "batch_size_cache.json"
+# Batch sizes tried if none are given, until one doesn't fit into device memory.
+DEFAULT_BATCH_SIZES = [2**i for i in range(13)]
+
+
+def get_input_shape(config: VideoMAEExperimentConfig, batch_size: int):
+    """Shape of a batch of batch_size samples as returned from the data loader for config."""
+    num_frames = int(
+        config.ecog_data_config.sample_length * config.ecog_data_config.new_fs
+    )
+    return (
+        batch_size,
+        len(config.ecog_data_config.bands),
+        num_frames,
+        constants.GRID_SIZE,
+        constants.GRID_SIZE,
+    )
+
+
+def get_cache_key(config: VideoMAEExperimentConfig, device, train=True):
+    """Key of the probe results for the model and inputs of config on device.
+
+    Only the settings changing the model, its inputs or the numerical precision affect memory use and throughput, so
+    e.g. configs differing only in learning rate or data paths share results. The probe runs the model uncompiled, so
+    compiled and uncompiled runs share results too.
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        device_name = torch.cuda.get_device_name(device)
+    else:
+        device_name = device.type
+    key = {
+        "video_mae_task_config": dataclasses.asdict(config.video_mae_task_config),
+        "input_shape": get_input_shape(config, 1)[1:],
+        "precision": config.trainer_config.precision,
+        "device": device_name,
+        "train": train,
+        "torch": torch.__version__,
+    }
+    return json.dumps(key, sort_keys=True)
+
+
+def _get_peak_rss():
+    """Peak resident memory of this process in bytes since it started."""
+    # ru_maxrss is in kilobytes on linux and in bytes on macos.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (
+        1 if sys.platform == "darwin" else 1024
+    )
+
+
+def _is_out_of_memory(error):
+    """Whether error was raised for running out of device memory, on the gpu or the cpu."""
+    return isinstance(
+        error, torch.cuda.OutOfMemoryError
+    ) or "can't allocate memory" in str(error)
+
+
+def _measure_batch_size(model, optimizer, config, device, batch_size, num_steps):
+    """Run num_steps steps at batch_size after a warmup step and return their peak memory and throughput."""
+    device = torch.device(device)
+    dtype = PRECISION_DTYPES[config.trainer_config.precision]
+    signal = torch.randn(get_input_shape(config, batch_size), device=device)
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    for step in range(num_steps + 1):
+        if step == 1:
+            # The first step allocates optimizer state and warms up kernels.
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+        if optimizer is None:
+            with torch.no_grad(), get_autocast(device, dtype):
+                model(signal, forward_features=True)
+        else:
+            with get_autocast(device, dtype):
+                loss = model_forward(
+                    model,
+                    signal,
+                    config.video_mae_task_config.encoder_mask_ratio,
+                    config.video_mae_task_config.alpha,
+                )[0]
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            loss = None
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+
+    # The peak resident memory can't be reset, batch sizes are probed in increasing order so it's this one's.
+    return {
+        "batch_size": batch_size,
+        "peak_memory": (
+            torch.cuda.max_memory_allocated(device)
+            if device.type == "cuda"
+            else _get_peak_rss()
+        ),
+        "samples_per_second": batch_size * num_steps / elapsed,
+    }
+
+
+def probe_batch_sizes(
+    config: VideoMAEExperimentConfig,
+    device,
+    batch_sizes=None,
+    num_steps=3,
+    train=True,
+    cache_file=CACHE_FILE,
+):
+    """Find the largest batch size config's model can be trained (or run inference) with on device.
+
+    Runs a few steps at increasing batch sizes on random signal of the shape the data loader returns for config,
+    stopping at the first batch size running out of device memory. On the cpu, where running out of memory usually
+    gets the process killed instead of raising an error, probing also stops after the first batch size using more
+    than half of the memory available when starting. Training steps include the backward pass and an
+    AdamW step so optimizer state is accounted for, inference steps match forward(..., forward_features=True) as
+    used to compute embeddings. Every electrode is present in the synthetic signal, which is the largest number of
+    tokens a batch can have.
+
+    Results are cached in cache_file by get_cache_key, so sweeps over settings not affecting the model reuse them.
+
+    Args:
+        config: experiment config to build the model and inputs from.
+        device: device to probe, e.g. "cuda:0".
+        batch_sizes: increasing batch sizes to try, DEFAULT_BATCH_SIZES by default.
+        num_steps: number of timed steps per batch size, after one warmup step.
+        train: If True probe training steps (for ECoGDataConfig.batch_size), otherwise inference (e.g. for
+            EncodingTaskConfig.embedding_batch_size).
+        cache_file: json file to cache results in, None to always probe.
+
+    Returns:
+        dict with "max_batch_size", the largest batch size which fit (0 if none did), and "results", a list with
+            "batch_size", "peak_memory" in bytes and "samples_per_second" of every batch size which fit. On the cpu
+            the peak memory is the resident memory of the whole process.
+    """
+    key = get_cache_key(config, device, train)
+    if batch_sizes is None:
+        batch_sizes = DEFAULT_BATCH_SIZES
+    else:
+        key = json.dumps({"config": key, "batch_sizes": list(batch_sizes)})
+
+    cache = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+    if key in cache:
+        return cache[key]
+
+    memory_limit = None
+    if torch.device(device).type == "cpu":
+        memory_limit = _get_peak_rss() + psutil.virtual_memory().available / 2
+
+    model = create_model(config).to(device)
+    model.train(train)
+    optimizer = None
+    if train:
+        # lr 0 keeps the parameters unchanged while allocating the optimizer state.
+        optimizer = torch.optim.AdamW(model.parameters(), lr=0.0)
+
+    results = []
+    for batch_size in batch_sizes:
+        out_of_memory = False
+        try:
+            results.append(
+                _measure_batch_size(
+                    model, optimizer, config, device, batch_size, num_steps
+                )
+            )
+        except RuntimeError as error:
+            if not _is_out_of_memory(error):
+                raise
+            out_of_memory = True
+        finally:
+            model.zero_grad(set_to_none=True)
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        if out_of_memory:
+            logger.info(f"Batch size {batch_size} ran out of memory.")
+            break
+        logger.info(
+            f"Batch size {batch_size}: {results[-1]['samples_per_second']:.1f} samples/s, peak memory "
+            f"{results[-1]['peak_memory']}."
+        )
+        if memory_limit is not None and results[-1]["peak_memory"] > memory_limit:
+            logger.info(
+                f"Batch size {batch_size} used more than half of the available memory."
+            )
+            break
+
+    probe = {
+        "max_batch_size": results[-1]["batch_size"] if results else 0,
+        "results": results,
+    }
+
+    if cache_file is not None:
+        # Re-read the cache in case another job updated it while probing.
+        if os.path.exists(cache_file):
+            with open(cache_file, "r") as f:
+                cache = json.load(f)
+        cache[key] = probe
+        # Written atomically so jobs reading the cache meanwhile never see a partial file.
+        atomic_write(cache_file, lambda f: f.write(json.dumps(cache).encode()))
+
+    return probe
+
+
+if __name__ == "__main__":
+    from parser import arg_parser
+    from config import create_video_mae_experiment_config
+    from mae_st_util.logging import setup_logging
+
+    setup_logging()
+    experiment_config = create_video_mae_experiment_config(arg_parser())
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    for train in (True, False):
+        probe = probe_batch_sizes(experiment_config, device, train=train)
+        print(
+            f"Max {'training' if train else 'inference'} batch size on {device}: {probe['max_batch_size']}"
+        )
@@ -0,0 +1,228 @@
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import safetensors
+import safetensors.torch
+import torch
+
+from config import (
+    VideoMAEExperimentConfig,
+    config_to_string,
+    create_video_mae_experiment_config_from_string,
+)
+from ecog_setup import create_model
+
+logger = logging.getLogger(__name__)
+
+# Lists the saved checkpoints, oldest first, and the one with the lowest test loss.
+MANIFEST_FILE = "checkpoints.json"
+
+
+def atomic_write(path, write):
+    """Write a file with write(f) to a temporary file next to path and rename it to path once complete.
+
+    The rename is atomic, so path either holds the previous or the complete new file even if the job is killed.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_manifest(checkpoint_dir):
+    """Read the manifest of checkpoint_dir, an empty one if no checkpoint was saved yet."""
+    path = os.path.join(checkpoint_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {"checkpoints": [], "best": None}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def latest_checkpoint(checkpoint_dir):
+    """Path of the most recently saved checkpoint in checkpoint_dir, None if there is none."""
+    checkpoints = read_manifest(checkpoint_dir)["checkpoints"]
+    if not checkpoints:
+        return None
+    return os.path.join(checkpoint_dir, checkpoints[-1])
+
+
+def load_checkpoint(path, map_location="cpu"):
+    """Load a training checkpoint saved by AsyncCheckpointWriter.
+
+    Tensors are memory mapped from the file rather than read up front when loading onto the cpu.
+    """
+    return torch.load(path, map_location=map_location, weights_only=True, mmap=True)
+
+
+def save_model(model, experiment_config: VideoMAEExperimentConfig, path):
+    """Save the state dict of model together with the config it was created from, to load it with load_model.
+
+    Args:
+        model: MaskedAutoencoderViT created with ecog_setup.create_model(experiment_config).
+        experiment_config: config of the model.
+        path: file to save to. Saved in safetensors format with the config in its metadata if path ends in
+            ".safetensors", otherwise with torch.save as a dict with the "model" state dict and the "config" string
+            like training checkpoints.
+    """
+    config_string = config_to_string(experiment_config)
+    state_dict = {k: v.detach().cpu() for k, v in model.state_dict().items()}
+    if path.endswith(".safetensors"):
+        data = safetensors.torch.save(
+            {k: v.contiguous() for k, v in state_dict.items()},
+            metadata={"config": config_string},
+        )
+        atomic_write(path, lambda f: f.write(data))
+    else:
+        atomic_write(
+            path,
+            lambda f: torch.save({"model": state_dict, "config": config_string}, f),
+        )
+
+
+def load_model_config(path):
+    """Load the experiment config of a model saved by save_model or of a training checkpoint."""
+    if path.endswith(".safetensors"):
+        with safetensors.safe_open(path, framework="pt") as f:
+            config_string = f.metadata()["config"]
+    else:
+        config_string = load_checkpoint(path)["config"]
+    return create_video_mae_experiment_config_from_string(config_string)
+
+
+def load_model(path, device="cpu"):
+    """Load a model saved by save_model, or the model of a training checkpoint, in eval mode onto device.
+
+    The model is created from the saved config with ecog_setup.create_model on the meta device and the saved tensors
+    are assigned to it, so parameters aren't initialized only to be overwritten and are copied at most once. Tensors
+    are memory mapped from the file and safetensors files are read directly onto device.
+    """
+    if path.endswith(".safetensors"):
+        with safetensors.safe_open(path, framework="pt", device=str(device)) as f:
+            config_string = f.metadata()["config"]
+            state_dict = {key: f.get_tensor(key) for key in f.keys()}
+    else:
+        checkpoint = load_checkpoint(path)
+        config_string = checkpoint["config"]
+        state_dict = checkpoint["model"]
+
+    with torch.device("meta"):
+        model = create_model(
+            create_video_mae_experiment_config_from_string(config_string)
+        )
+    model.load_state_dict(state_dict, assign=True)
+    return model.to(device).eval()
+
+
+class AsyncCheckpointWriter:
+    """Saves training checkpoints from a background thread.
+
+    save snapshots the state into (pinned) cpu memory and returns, so training continues while the checkpoint is
+    written. Tensors on the gpu are copied without blocking and the writer waits for the copies to finish before
+    writing. Only one checkpoint is written at a time, a save waits for the previous one to finish, which also lets
+    the pinned buffers be reused for every checkpoint.
+
+    The last num_checkpoints checkpoints and the one with the lowest test loss are kept, older ones are deleted.
+    They're listed in MANIFEST_FILE, which is updated after each checkpoint is completely written.
+    """
+
+    def __init__(self, checkpoint_dir, num_checkpoints=3):
+        """
+        checkpoint_dir: directory to save checkpoints in, may hold checkpoints of a previous run to continue from.
+        num_checkpoints: number of most recent checkpoints to keep.
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.num_checkpoints = num_checkpoints
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.manifest = read_manifest(checkpoint_dir)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        # Pinned cpu buffers of the previous snapshot by their position in the state.
+        self._buffers = {}
+
+    def _snapshot(self, obj, key=()):
+        """Copy the tensors in obj to cpu, recursing into dicts, lists and tuples."""
+        if isinstance(obj, torch.Tensor):
+            tensor = obj.detach()
+            if tensor.device.type == "cpu":
+                return tensor.clone()
+            buffer = self._buffers.get(key)
+            if (
+                buffer is None
+                or buffer.shape != tensor.shape
+                or buffer.dtype != tensor.dtype
+            ):
+                buffer = torch.empty(
+                    tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=True
+                )
+                self._buffers[key] = buffer
+            return buffer.copy_(tensor, non_blocking=True)
+        if isinstance(obj, dict):
+            return {k: self._snapshot(v, key + (k,)) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, key + (i,)) for i, v in enumerate(obj))
+        return obj
+
+    def save(self, state, name, test_loss=None):
+        """Snapshot state and write it to name in checkpoint_dir in the background.
+
+        state: dict of tensors, state dicts and builtin values to save.
+        name: file name of the checkpoint.
+        test_loss: test loss of the checkpoint, the checkpoint with the lowest one is kept.
+        """
+        self.wait()
+        snapshot = self._snapshot(state)
+        copied = None
+        if torch.cuda.is_available():
+            copied = torch.cuda.Event()
+            copied.record()
+        self._pending = self._executor.submit(
+            self._write, snapshot, name, test_loss, copied
+        )
+
+    def _write(self, snapshot, name, test_loss, copied):
+        if copied is not None:
+            copied.synchronize()
+        atomic_write(
+            os.path.join(self.checkpoint_dir, name),
+            lambda f: torch.save(snapshot, f),
+        )
+
+        manifest = self.manifest
+        if name in manifest["checkpoints"]:
+            manifest["checkpoints"].remove(name)
+        manifest["checkpoints"].append(name)
+        if test_loss is not None and (
+            manifest["best"] is None or test_loss < manifest["best"]["test_loss"]
+        ):
+            manifest["best"] = {"name": name, "test_loss": test_loss}
+        keep = set(manifest["checkpoints"][-self.num_checkpoints :])
+        if manifest["best"] is not None:
+            keep.add(manifest["best"]["name"])
+        removed = [c for c in manifest["checkpoints"] if c not in keep]
+        manifest["checkpoints"] = [c for c in manifest["checkpoints"] if c in keep]
+        atomic_write(
+            os.path.join(self.checkpoint_dir, MANIFEST_FILE),
+            lambda f: f.write(json.dumps(manifest).encode()),
+        )
+
+        # Only delete checkpoints once the manifest doesn't reference them anymore.
+        for old in removed:
+            path = os.path.join(self.checkpoint_dir, old)
+            if os.path.exists(path):
+                os.remove(path)
+        logger.info(f"Saved checkpoint {name}.")
+
+    def wait(self):
+        """Wait for the checkpoint being written to finish, raises errors from writing it."""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        """Wait for the last checkpoint and stop the background thread."""
+        self.wait()
+        self._executor.shutdown()
@@ -1,4 +1,5 @@
 import configparser
+import io
 from dataclasses import dataclass, field, asdict
 import json
 from argparse import Namespace
@@ -42,6 +43,37 @@ class TrainerConfig:
     max_learning_rate: float = 3e-5
     # Number of epochs to train over data.
     num_epochs: int = 10
+    # If True then torch.compile the model. Builds the model with static shapes so it doesn't recompile for new
+    # electrode layouts.
+    compile_model: bool = False
+    # Numerical precision to train in, one of "fp32", "bf16" or "fp16". bf16 and fp16 run the model under autocast
+    # with normalization and loss kept in fp32, fp16 also scales gradients to avoid underflow.
+    precision: str = "fp32"
+    # Number of batches to accumulate gradients over before each optimizer step, the effective batch size is
+    # batch_size * gradient_accumulation_steps.
+    gradient_accumulation_steps: int = 1
+    # Number of samples passed through the model at once, batches are split into micro-batches of this size whose
+    # gradients are accumulated. 0 passes whole batches.
+    micro_batch_size: int = 0
+    # If True and micro_batch_size is 0 use the largest micro-batch fitting into device memory, found on the first
+    # batch of every epoch.
+    auto_micro_batch_size: bool = False
+    # Weight decay of the weights of linear and convolution layers, other parameters aren't decayed.
+    weight_decay: float = 1e-2
+    # Implementation of AdamW, one of "for_loop", "foreach" or "fused". foreach and fused update all parameters in a
+    # few kernels instead of a few per parameter. Only fused skips steps for a nan loss without copying the parameters
+    # and optimizer state, see pretrain_engine.optimizer_step.
+    optimizer_implementation: str = "fused"
+    # If True and training on multiple processes shard the optimizer state across them (ZeRO stage 1).
+    shard_optimizer_state: bool = False
+    # Number of most recent checkpoints to keep, the checkpoint with the lowest test loss is kept as well.
+    num_checkpoints: int = 3
+    # If True then continue training from the latest checkpoint of the job, including the state of the optimizer, lr
+    # scheduler and random number generators.
+    resume: bool = False
+    # Save a checkpoint in the middle of an epoch every this many minutes, including the position of the training
+    # data loader so resuming continues from the same sample. 0 only saves checkpoints at the end of epochs.
+    checkpoint_interval_minutes: float = 0.0
 
 
 @dataclass
@@ -72,6 +104,12 @@ class ViTConfig:
     trunc_init: bool = False
     # If True then don't use a bias for query, key, and values in attention blocks.
     no_qkv_bias: bool = False
+    # If True then pack the real tokens of samples with different padding masks into one sequence instead of
+    # padding every sample to the longest one.
+    pack_tokens: bool = False
+    # If True then rotate queries and keys in attention by 4D rotary position embeddings instead of adding learned
+    # position embeddings.
+    use_rope: bool = False
 
 
 @dataclass
@@ -92,6 +130,13 @@ class VideoMAETaskConfig:
     encoder_mask_ratio: float = 0.5
     # Percentage of masks tokens to pass into decoder for reconstruction.
     pct_masks_to_decode: float = 0
+    # How tokens are masked for the encoder, "random" or "tube" to mask the same electrodes in all frames.
+    mask_strategy: str = "random"
+    # If True select the patches to decode with running cell masking (see mask.get_running_cell_mask), else the
+    # same random patches are decoded in all frames.
+    running_cell_masking: bool = False
+    # Number of masks to draw for every sample, each sample is normalized and embedded once for all of its masks.
+    num_masks_per_sample: int = 1
     # Weight factor for loss computation. Final loss is determined by
     # loss = alpha * -(pearson correlation) + (1- alpha) * mean squared error. Alpha=1 is -correlation loss,
     # alpha = 0 is mse loss.
@@ -124,6 +169,19 @@ def create_video_mae_experiment_config_from_file(config_file_path):
     return create_video_mae_experiment_config(FakeArgs())
 
 
+def create_video_mae_experiment_config_from_string(config_string):
+    """Convert a config in .ini format, as returned from config_to_string, to an experiment config for VideoMAE."""
+
+    class FakeArgs:
+        def __init__(self):
+            self.config_string = config_string
+
+        def __getattr__(self, item):
+            return None
+
+    return create_video_mae_experiment_config(FakeArgs())
+
+
 def create_video_mae_experiment_config(args: Namespace | str):
     """Convert command line arguments and config file to an experiment config for VideoMAE.
 
@@ -133,7 +191,10 @@ def create_video_mae_experiment_config(args: Namespace | str):
     Can optionally pass
     """
     config = configparser.ConfigParser(converters={"list": json.loads})
-    config.read(args.config_file)
+    if getattr(args, "config_string", None) is not None:
+        config.read_string(args.config_string)
+    else:
+        config.read(args.config_file)
 
     return VideoMAEExperimentConfig(
         video_mae_task_config=VideoMAETaskConfig(
@@ -215,6 +276,20 @@ def create_video_mae_experiment_config(args: Namespace | str):
                         "VideoMAETaskConfig.ViTConfig", "no_qkv_bias"
                     )
                 ),
+                pack_tokens=(
+                    args.pack_tokens
+                    if args.pack_tokens
+                    else config.getboolean(
+                        "VideoMAETaskConfig.ViTConfig", "pack_tokens", fallback=False
+                    )
+                ),
+                use_rope=(
+                    args.use_rope
+                    if args.use_rope
+                    else config.getboolean(
+                        "VideoMAETaskConfig.ViTConfig", "use_rope", fallback=False
+                    )
+                ),
             ),
             encoder_mask_ratio=(
                 args.encoder_mask_ratio
@@ -226,6 +301,27 @@ def create_video_mae_experiment_config(args: Namespace | str):
                 if args.pct_masks_to_decode
                 else config.getfloat("VideoMAETaskConfig", "pct_masks_to_decode")
             ),
+            mask_strategy=(
+                args.mask_strategy
+                if args.mask_strategy
+                else config.get(
+                    "VideoMAETaskConfig", "mask_strategy", fallback="random"
+                )
+            ),
+            running_cell_masking=(
+                args.running_cell_masking
+                if args.running_cell_masking
+                else config.getboolean(
+                    "VideoMAETaskConfig", "running_cell_masking", fallback=False
+                )
+            ),
+            num_masks_per_sample=(
+                args.num_masks_per_sample
+                if args.num_masks_per_sample
+                else config.getint(
+                    "VideoMAETaskConfig", "num_masks_per_sample", fallback=1
+                )
+            ),
             alpha=(
                 args.alpha
                 if args.alpha
@@ -243,6 +339,71 @@ def create_video_mae_experiment_config(args: Namespace | str):
                 if args.num_epochs
                 else config.getint("TrainerConfig", "num_epochs")
             ),
+            compile_model=(
+                args.compile_model
+                if args.compile_model
+                else config.getboolean("TrainerConfig", "compile_model", fallback=False)
+            ),
+            precision=(
+                args.precision
+                if args.precision
+                else config.get("TrainerConfig", "precision", fallback="fp32")
+            ),
+            gradient_accumulation_steps=(
+                args.gradient_accumulation_steps
+                if args.gradient_accumulation_steps
+                else config.getint(
+                    "TrainerConfig", "gradient_accumulation_steps", fallback=1
+                )
+            ),
+            micro_batch_size=(
+                args.micro_batch_size
+                if args.micro_batch_size
+                else config.getint("TrainerConfig", "micro_batch_size", fallback=0)
+            ),
+            auto_micro_batch_size=(
+                args.auto_micro_batch_size
+                if args.auto_micro_batch_size
+                else config.getboolean(
+                    "TrainerConfig", "auto_micro_batch_size", fallback=False
+                )
+            ),
+            weight_decay=(
+                args.weight_decay
+                if args.weight_decay
+                else config.getfloat("TrainerConfig", "weight_decay", fallback=1e-2)
+            ),
+            optimizer_implementation=(
+                args.optimizer_implementation
+                if args.optimizer_implementation
+                else config.get(
+                    "TrainerConfig", "optimizer_implementation", fallback="fused"
+                )
+            ),
+            shard_optimizer_state=(
+                args.shard_optimizer_state
+                if args.shard_optimizer_state
+                else config.getboolean(
+                    "TrainerConfig", "shard_optimizer_state", fallback=False
+                )
+            ),
+            num_checkpoints=(
+                args.num_checkpoints
+                if args.num_checkpoints
+                else config.getint("TrainerConfig", "num_checkpoints", fallback=3)
+            ),
+            resume=(
+                args.resume
+                if args.resume
+                else config.getboolean("TrainerConfig", "resume", fallback=False)
+            ),
+            checkpoint_interval_minutes=(
+                args.checkpoint_interval_minutes
+                if args.checkpoint_interval_minutes
+                else config.getfloat(
+                    "TrainerConfig", "checkpoint_interval_minutes", fallback=0.0
+                )
+            ),
         ),
         ecog_data_config=ECoGDataConfig(
             batch_size=(
@@ -327,6 +488,16 @@ def write_config_file(path: str, experiment_config: VideoMAEExperimentConfig):
         path (str): path to write file to.
         experiment_config (VideoMAEExperimentConfig): Config to write in .ini format.
     """
+    with open(path, "w") as configfile:
+        configfile.write(config_to_string(experiment_config))
+
+
+def config_to_string(experiment_config: VideoMAEExperimentConfig) -> str:
+    """Serialize config in .ini format, to read back with create_video_mae_experiment_config_from_string.
+
+    Args:
+        experiment_config (VideoMAEExperimentConfig): Config to serialize.
+    """
     config = configparser.ConfigParser()
 
     def add_section(section_name, data):
@@ -349,6 +520,6 @@ def write_config_file(path: str, experiment_config: VideoMAEExperimentConfig):
     add_section("TrainerConfig", asdict(experiment_config.trainer_config))
     config["JobDetails"] = {"job_name": experiment_config.job_name}
 
-    # Write the configuration to the file
-    with open(path, "w") as configfile:
-        config.write(configfile)
+    configfile = io.StringIO()
+    config.write(configfile)
+    return configfile.getvalue()
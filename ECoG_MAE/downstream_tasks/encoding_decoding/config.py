@@ -25,7 +25,7 @@ class EncodingDecodingDataConfig(ECoGDataConfig):
 @dataclass
 class EncodingDecodingTaskConfig:
     # Path to the model checkpoint used to generate neural embeddings.
-    # Assumes model was saved using torch.save and is the SimpleViT in models.py.
+    # A training checkpoint or a model saved with checkpoint.save_model, loaded with checkpoint.load_model.
     model_path: str = ""
     
     # What device to run the embedding generation on. Likely one of "cuda" or "cpu"
@@ -33,6 +33,10 @@ class EncodingDecodingTaskConfig:
     
     # Batch size to use when generating neural embeddings.
     embedding_batch_size: int = 1
+
+    # Numerical precision to generate embeddings in, one of "fp32", "bf16" or "fp16". bf16 runs well on recent cpus.
+    # "int8" dynamically quantizes the model's linear layers for cpu inference.
+    embedding_precision: str = "fp32"
     
     # The number of folds to use when training the encoder.
     num_folds: int = 2
@@ -50,6 +54,7 @@ def create_encoding_decoding_experiment_config(args) -> EncodingDecodingExperime
         encoding_task_config=EncodingDecodingTaskConfig(
             model_path=args.model_path,
             embedding_device=args.embedding_device,
+            embedding_precision=args.embedding_precision,
         ),
         encoding_data_config=EncodingDecodingDataConfig(
             # ECoGDataConfig variables are loaded from the model checkpoint to ensure data is preprocessed in the same way.
@@ -21,6 +21,13 @@ def arg_parser():
         default=1,
         help="Batch size to use when generating neural embeddings.",
     )
+    parser.add_argument(
+        "--embedding-precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16", "fp16", "int8"],
+        help="Numerical precision to generate neural embeddings in. bf16 runs well on recent cpus, int8 dynamically quantizes the model for cpu inference.",
+    )
     
     # Data config.
     parser.add_argument(
@@ -1,4 +1,6 @@
+import copy
 from dataclasses import asdict, replace
+import time
 
 import numpy as np
 from scipy import stats
@@ -11,6 +13,7 @@ import torch.nn as nn
 from scipy import stats
 
 from config import ECoGDataConfig
+from utils import PRECISION_DTYPES, get_autocast
 from downstream_tasks.encoding_decoding.config import (
     EncodingDecodingDataConfig,
     EncodingDecodingExperimentConfig,
@@ -48,6 +51,7 @@ def run_encoding_task(
         model,
         experiment_config.encoding_task_config.embedding_batch_size,
         experiment_config.encoding_task_config.embedding_device,
+        experiment_config.encoding_task_config.embedding_precision,
     )
 
     predictions = run_regression(
@@ -92,6 +96,7 @@ def run_decoding_task(
         model,
         experiment_config.encoding_task_config.embedding_batch_size,
         experiment_config.encoding_task_config.embedding_device,
+        experiment_config.encoding_task_config.embedding_precision,
     )
 
     # Only change as of now is the order of regression.
@@ -190,6 +195,31 @@ def run_regression(X: np.array, Y: np.array, num_folds: int) -> np.array:
     return all_predictions
 
 
+def quantize_model(model: nn.Module) -> nn.Module:
+    """Dynamically quantize the Linear layers of a model to int8 for cpu inference.
+
+    Weights are stored in int8 and activations are quantized per batch on the fly, which speeds up the attention and
+    MLP projections that dominate the encoder's cost. The model passed in is left unchanged.
+
+    Args:
+        model (nn.Module): fp32 model on the cpu.
+
+    Returns:
+        nn.Module: quantized copy of model.
+    """
+    return torch.ao.quantization.quantize_dynamic(
+        copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8
+    )
+
+
+def get_windows_per_second_per_core(
+    num_windows: int, elapsed: float, device: str
+) -> float:
+    """Throughput of embedding generation in windows per second per core, per device for accelerators."""
+    num_cores = torch.get_num_threads() if torch.device(device).type == "cpu" else 1
+    return num_windows / elapsed / num_cores
+
+
 # TODO: Add tests for this.
 @torch.no_grad()
 def generate_embedding_dataset(
@@ -197,43 +227,69 @@ def generate_embedding_dataset(
     model: nn.Module,
     embedding_batch_size: int,
     device: str,
+    precision: str = "fp32",
+    accuracy_check_windows: int = 64,
 ) -> tuple[np.array, np.array]:
     """Gathers word embeddings and generates neural embeddings using model from the dataset.
 
     Args:
         dataset (EncodingDecodingDataset): dataset used to gather word and neural data.
-        model (nn.Module): model used to generate neural embeddings. Expected as of now to output embeddings of shape
-            [batch_size, num_tokens, output_dim] where num_tokens is the number of patches for the VideoMAE model, although different
-            models could be plugged in here as well. Embeddings are joined together using average pooling to form one summary embedding.
+        model (nn.Module): model used to generate neural embeddings. Expected as of now to output one embedding of shape
+            [batch_size, output_dim] per example, which the VideoMAE model does by average pooling its tokens, although
+            different models could be plugged in here as well.
         embedding_batch_size (int): The number of neural examples to pass into the model per-inference. Can speed up inference by
             parallelizing at the cost of RAM or VRAM.
         device (str): The name of the device to run inference on. Model is assumed to already be on this device.
+        precision (str): Numerical precision to run the model in under autocast, one of "fp32", "bf16" or "fp16". Or "int8"
+            to run a dynamically quantized copy of the model on the cpu, see quantize_model.
+        accuracy_check_windows (int): For precisions other than fp32 the embeddings of this many examples are compared to the
+            fp32 model's with get_correlation_metrics as an accuracy check.
 
     Returns:
         tuple[np.array, np.array]: (word_embeddings, neural_embeddings) both parallel arrays containing the embeddings for our examples.
     """
+    # Dynamically quantized Linear layers only have cpu kernels, fail before loading any data.
+    if precision == "int8" and torch.device(device).type != "cpu":
+        raise ValueError(
+            f"int8 precision is only supported on the cpu, got device {device}. Use bf16 or fp16 on the gpu instead."
+        )
+
     model.eval()
 
     print("padding mask:", dataset.padding_mask)
     model.initialize_mask(dataset.padding_mask.to(device))
 
+    embedding_model = model
+    if precision == "int8":
+        embedding_model = quantize_model(model)
+        autocast_dtype = torch.float32
+    else:
+        autocast_dtype = PRECISION_DTYPES[precision]
+
     # Setup dataloader and iterate through examples.
     word_embeddings = []
     neural_embeddings = []
+    reference_embeddings = []
+    inference_time = 0.0
 
     def _generate_neural_embeddings(neural_batch: list):
+        nonlocal inference_time
         neural_data = torch.cat(neural_batch)
         neural_data = neural_data.to(device)
 
         # Model output is shape:
-        # [batch_size, num_patches, output_dim]
-        model_outputs = model(neural_data, forward_features=True)
+        # [batch_size, output_dim]
+        start = time.perf_counter()
+        with get_autocast(device, autocast_dtype):
+            model_outputs = embedding_model(neural_data, forward_features=True)
+        pooled_embeddings = model_outputs.float().cpu().numpy()
+        inference_time += time.perf_counter() - start
 
-        # Average pooling, can consider other options in the future.
-        pooled_embeddings = torch.mean(model_outputs, dim=1)
+        neural_embeddings.extend(pooled_embeddings)
 
-        for embedding in pooled_embeddings:
-            neural_embeddings.append(embedding.detach().cpu().numpy())
+        if precision != "fp32" and len(reference_embeddings) < accuracy_check_windows:
+            reference_outputs = model(neural_data, forward_features=True)
+            reference_embeddings.extend(reference_outputs.float().cpu().numpy())
 
     # Collect data into batches to accelerate inference.
     neural_batch = []
@@ -255,6 +311,23 @@ def generate_embedding_dataset(
     word_embeddings = np.array(word_embeddings)
     neural_embeddings = np.array(neural_embeddings)
 
+    print(
+        f"Embedding throughput ({precision}):",
+        get_windows_per_second_per_core(len(neural_embeddings), inference_time, device),
+        "windows/sec per core",
+    )
+    if len(reference_embeddings) > 1:
+        accuracy = get_correlation_metrics(
+            np.array(reference_embeddings),
+            neural_embeddings[: len(reference_embeddings)],
+        )
+        print(
+            f"Correlation of {precision} to fp32 embeddings:",
+            accuracy["overall_correlation"],
+            "mean per embedding:",
+            accuracy["mean_embedding_correlation"],
+        )
+
     model.train()
 
     return word_embeddings, neural_embeddings
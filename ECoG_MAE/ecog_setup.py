@@ -4,6 +4,8 @@ import os
 import math
 import torch
 import numpy as np
+import torch.nn as nn
+from torch.distributed.optim import ZeroRedundancyOptimizer
 from accelerate import Accelerator, DeepSpeedPlugin
 
 import utils
@@ -12,11 +14,14 @@ import constants
 from mae_st_util.models_mae import MaskedAutoencoderViT
 
 
-def system_setup():
+def system_setup(precision="fp32", gradient_accumulation_steps=1):
     """
     Sets up accelerator, device, datatype precision and local rank
 
     Args:
+        precision: numerical precision to train in, one of "fp32", "bf16" or "fp16". See TrainerConfig.precision.
+        gradient_accumulation_steps: number of batches to accumulate gradients over, see
+            TrainerConfig.gradient_accumulation_steps.
 
     Returns:
         accelerator: an accelerator instance - https://huggingface.co/docs/accelerate/en/index
@@ -32,8 +37,12 @@ def system_setup():
     seed = 42
     utils.seed_everything(seed)
 
-    # accelerator = Accelerator(split_batches=False, mixed_precision="fp16")
-    accelerator = Accelerator(split_batches=False)
+    # fp16 also sets up a gradient scaler on the accelerator which is used in pretrain_engine.
+    accelerator = Accelerator(
+        split_batches=False,
+        mixed_precision="no" if precision == "fp32" else precision,
+        gradient_accumulation_steps=gradient_accumulation_steps,
+    )
 
     device = "cuda:0"
 
@@ -65,7 +74,7 @@ def model_setup(config: VideoMAEExperimentConfig, device, num_train_samples):
 
     Returns:
         model: an untrained model instance with randomly initialized parameters
-        optimizer: an Adam optimizer instance - https://www.analyticsvidhya.com/blog/2023/12/adam-optimizer/
+        optimizer: an AdamW optimizer instance, see create_optimizer - https://www.analyticsvidhya.com/blog/2023/12/adam-optimizer/
         lr_scheduler: https://pytorch.org/docs/stable/generated/torch.optim.lr_scheduler.OneCycleLR.html
         num_patches: the number of patches in which the input data is segmented
     """
@@ -95,36 +104,17 @@ def model_setup(config: VideoMAEExperimentConfig, device, num_train_samples):
     model = create_model(config)
     utils.count_params(model)
 
-    no_decay = ["bias", "LayerNorm.bias", "LayerNorm.weight"]
-    opt_grouped_parameters = [
-        {
-            "params": [
-                p
-                for n, p in model.named_parameters()
-                if not any(nd in n for nd in no_decay)
-            ],
-            "weight_decay": 1e-2,
-        },
-        {
-            "params": [
-                p
-                for n, p in model.named_parameters()
-                if any(nd in n for nd in no_decay)
-            ],
-            "weight_decay": 0.0,
-        },
-    ]
-
-    optimizer = torch.optim.AdamW(
-        opt_grouped_parameters, lr=config.trainer_config.max_learning_rate
-    )
+    optimizer = create_optimizer(model, config, device)
 
+    # The optimizer steps once per accumulation window and on the last batch of each epoch, see
+    # pretrain_engine.train_single_epoch.
+    num_batches = math.ceil(num_train_samples / config.ecog_data_config.batch_size)
     lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(
         optimizer,
         max_lr=config.trainer_config.max_learning_rate,
         epochs=config.trainer_config.num_epochs,
         steps_per_epoch=math.ceil(
-            num_train_samples / config.ecog_data_config.batch_size
+            num_batches / config.trainer_config.gradient_accumulation_steps
         ),
     )
 
@@ -159,5 +149,91 @@ def create_model(config: VideoMAEExperimentConfig):
         pred_t_dim=num_frames,
         img_mask=None,
         pct_masks_to_decode=config.video_mae_task_config.pct_masks_to_decode,
+        mask_strategy=config.video_mae_task_config.mask_strategy,
+        decoder_mask_strategy=(
+            "running_cell"
+            if config.video_mae_task_config.running_cell_masking
+            else "random"
+        ),
+        num_masks=config.video_mae_task_config.num_masks_per_sample,
+        pack_tokens=model_config.pack_tokens,
+        use_rope=model_config.use_rope,
+        static_shapes=config.trainer_config.compile_model,
     )
     return model
+
+
+# Modules whose weights are decayed, all other parameters (biases, norms, tokens and position embeddings) aren't.
+DECAY_MODULES = (nn.Linear, nn.Conv1d, nn.Conv2d, nn.Conv3d)
+
+
+def get_parameter_groups(model: nn.Module, weight_decay: float):
+    """Split the trainable parameters of model into a group with weight decay and one without.
+
+    Parameters are classified by the type of the module owning them rather than by name: only weights with at least
+    2 dimensions of DECAY_MODULES are decayed.
+
+    Args:
+        model: model to optimize.
+        weight_decay: weight decay of the decayed group.
+
+    Returns:
+        list of parameter group dicts for a torch optimizer.
+    """
+    decay, no_decay = [], []
+    for module in model.modules():
+        for name, param in module.named_parameters(recurse=False):
+            if not param.requires_grad:
+                continue
+            if (
+                isinstance(module, DECAY_MODULES)
+                and name == "weight"
+                and param.ndim >= 2
+            ):
+                decay.append(param)
+            else:
+                no_decay.append(param)
+    return [
+        {"params": decay, "weight_decay": weight_decay},
+        {"params": no_decay, "weight_decay": 0.0},
+    ]
+
+
+def create_optimizer(model: nn.Module, config: VideoMAEExperimentConfig, device=None):
+    """Create the AdamW optimizer of model for config.
+
+    With TrainerConfig.shard_optimizer_state and multiple processes the optimizer state is sharded across them with
+    a ZeroRedundancyOptimizer, which uses the process group set up by the accelerator. Every process then only keeps
+    the state of its shard, and the updated parameters are broadcast after each step.
+
+    Args:
+        model: model to optimize.
+        config: experiment config, see TrainerConfig.
+        device: device the model is trained on. On the gpu the foreach and for_loop implementations keep their step
+            counters on the device (capturable=True), so steps skipped for a nan loss don't need to sync with the
+            host, see pretrain_engine.optimizer_step.
+
+    Returns:
+        torch optimizer.
+    """
+    param_groups = get_parameter_groups(model, config.trainer_config.weight_decay)
+    implementation = config.trainer_config.optimizer_implementation
+    if implementation not in ("for_loop", "foreach", "fused"):
+        raise ValueError(f"Unknown optimizer implementation {implementation}.")
+    kwargs = {
+        "lr": config.trainer_config.max_learning_rate,
+        "foreach": implementation == "foreach",
+        "fused": implementation == "fused",
+    }
+    if implementation != "fused" and device is not None:
+        kwargs["capturable"] = torch.device(device).type == "cuda"
+
+    if (
+        config.trainer_config.shard_optimizer_state
+        and torch.distributed.is_initialized()
+        and torch.distributed.get_world_size() > 1
+    ):
+        return ZeroRedundancyOptimizer(
+            param_groups, optimizer_class=torch.optim.AdamW, **kwargs
+        )
+    return torch.optim.AdamW(param_groups, **kwargs)
@@ -59,8 +59,8 @@ class ECoGDataset(torch.utils.data.IterableDataset):
         return int(self.max_samples)
 
     def __iter__(self):
-        # Load data into ram on first iteration.
-        if self.index == 0:
+        # Load data into ram on first iteration, or when continuing from the middle of the file.
+        if not hasattr(self, "signal"):
             logger.debug(
                 "-----------------------------------------------------------------------------"
             )
@@ -149,6 +149,41 @@ class ECoGDataset(torch.utils.data.IterableDataset):
         return sig
 
 
+class ResumableChainDataset(torch.utils.data.ChainDataset):
+    """ChainDataset of ECoGDatasets which tracks its streaming position, so iteration can continue from a checkpoint.
+
+    The position is the index of the file and the index of the sample in that file which are streamed next. It's
+    tracked in the process iterating over the datasets, so it's only exact for data loaders without workers (as
+    created by dl_setup), which fetch samples when a batch is requested.
+    """
+
+    def __init__(self, datasets):
+        datasets = list(datasets)
+        super().__init__(datasets)
+        self.file_index = 0
+        self.sample_index = 0
+
+    def __iter__(self):
+        start_file, start_sample = self.file_index, self.sample_index
+        for file_index in range(start_file, len(self.datasets)):
+            dataset = self.datasets[file_index]
+            dataset.index = start_sample if file_index == start_file else 0
+            for sample in dataset:
+                self.file_index = file_index
+                self.sample_index = dataset.index + 1
+                yield sample
+        # Start from the first file in the next epoch.
+        self.file_index = 0
+        self.sample_index = 0
+
+    def state_dict(self):
+        return {"file_index": self.file_index, "sample_index": self.sample_index}
+
+    def load_state_dict(self, state):
+        self.file_index = state["file_index"]
+        self.sample_index = state["sample_index"]
+
+
 def split_dataframe(shuffle: bool, df: pd.DataFrame, ratio: float):
     """
     Shuffles a pandas dataframe and splits it into two dataframes with the specified ratio
@@ -259,7 +294,7 @@ def _create_dataloader(
         ecog_data_config.sample_length, root, data_files_df
     )
     datasets = [ECoGDataset(train_path, ecog_data_config) for train_path in filepaths]
-    dataset_combined = torch.utils.data.ChainDataset(datasets)
+    dataset_combined = ResumableChainDataset(datasets)
     dataloader = torch.utils.data.DataLoader(
         dataset_combined, batch_size=ecog_data_config.batch_size
     )
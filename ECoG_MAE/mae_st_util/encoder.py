@@ -0,0 +1,250 @@
+import torch
+import torch.nn as nn
+
+from mae_st_util import video_vit
+from mae_st_util.pos_embed import interpolate_pos_embed_temporal
+from rope import RotaryPositionalEmbeddings4D
+
+
+class EncoderViT(nn.Module):
+    """Encoder of a MaskedAutoencoderViT for inference, without the decoder and masking.
+
+    Computes the same embeddings as MaskedAutoencoderViT.forward(..., forward_features=True) for an electrode layout
+    frozen at export. Only the position embeddings of patches inside the padding mask are kept. Exported with
+    export_encoder and loaded with load_encoder, which only need this module and the layers in video_vit.
+    """
+
+    def __init__(
+        self,
+        img_size,
+        patch_size,
+        in_chans,
+        embed_dim,
+        depth,
+        num_heads,
+        mlp_ratio,
+        num_frames,
+        t_patch_size,
+        qkv_bias,
+        cls_embed,
+        use_rope,
+        img_mask,
+        norm_eps=1e-5,
+        input_scale_factor=1e6,
+        final_norm=False,
+    ):
+        """
+        Arguments are as for MaskedAutoencoderViT, except for:
+
+        img_mask: bool tensor of shape [H, W] of present electrodes, frozen into the encoder.
+        norm_eps: eps of the LayerNorms.
+        input_scale_factor: scale_factor of the MaskedBatchNorm normalizing the input.
+        final_norm: If True apply the encoder's final norm to the tokens, forward_features doesn't.
+        """
+        super().__init__()
+        self.cls_embed = cls_embed
+        self.final_norm = final_norm
+
+        self.masked_input_norm = video_vit.MaskedBatchNorm(
+            in_chans, scale_factor=input_scale_factor
+        )
+        self.patch_embed = video_vit.PatchEmbed(
+            img_size, patch_size, in_chans, embed_dim, num_frames, t_patch_size
+        )
+        T, H, W = self.patch_embed.input_size
+
+        img_mask = torch.as_tensor(img_mask).bool()
+        self.register_buffer("img_mask", img_mask)
+        # A patch is used if any of its electrodes is present, same as MaskedAutoencoderViT.initialize_mask.
+        patch_mask = img_mask.view(H, patch_size, W, patch_size).any(dim=3).any(dim=1)
+        self.register_buffer("patch_indices", patch_mask.flatten().nonzero().squeeze(1))
+        n_valid = len(self.patch_indices)
+
+        if cls_embed:
+            # cls token with its position embedding added.
+            self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
+        self.rope = None
+        if use_rope:
+            self.rope = RotaryPositionalEmbeddings4D(
+                embed_dim // num_heads,
+                grid_height=H,
+                grid_width=W,
+                grid_depth=1,
+                grid_time=T,
+            )
+        else:
+            # position embeddings of the patches inside img_mask
+            self.pos_embed = nn.Parameter(torch.zeros(1, T * n_valid, embed_dim))
+
+        self.blocks = nn.ModuleList(
+            [
+                video_vit.Block(
+                    embed_dim,
+                    num_heads,
+                    mlp_ratio,
+                    qkv_bias=qkv_bias,
+                    qk_scale=None,
+                    norm_layer=lambda dim: nn.LayerNorm(dim, eps=norm_eps),
+                )
+                for i in range(depth)
+            ]
+        )
+        self.norm = nn.LayerNorm(embed_dim, eps=norm_eps)
+
+    def get_rope(self, T):
+        L = self.patch_embed.grid_size[0] * self.patch_embed.grid_size[1]
+        positions = (
+            torch.arange(T, device=self.patch_indices.device).unsqueeze(1) * L
+            + self.patch_indices
+        ).view(1, -1)
+        if self.cls_embed:
+            positions = torch.cat((positions.new_full((1, 1), -1), positions), dim=1)
+        device_type = positions.device.type
+        if torch.is_autocast_enabled(device_type):
+            dtype = torch.get_autocast_dtype(device_type)
+        else:
+            dtype = torch.float32
+        return self.rope(positions, grid_time=T, dtype=dtype)
+
+    def forward(self, imgs, global_pool=True, cls_forward=False, per_frame=False):
+        """
+        imgs: [N, C, T, H, W] signal, T may be any multiple of t_patch_size.
+        global_pool, cls_forward, per_frame: see MaskedAutoencoderViT.forward_features.
+        """
+        imgs = self.masked_input_norm(imgs, self.img_mask)
+        x = self.patch_embed(imgs)
+        x = x[:, :, self.patch_indices]
+        N, T, n_valid, C = x.shape
+
+        rope = None
+        if self.rope is not None:
+            rope = self.get_rope(T)
+        else:
+            pos_embed = interpolate_pos_embed_temporal(self.pos_embed, T, n_valid)
+            x = x + pos_embed.view(1, T, n_valid, C)
+        x = x.reshape(N, T * n_valid, C)
+
+        if self.cls_embed:
+            x = torch.cat((self.cls_token.expand(N, -1, -1), x), dim=1)
+
+        for blk in self.blocks:
+            x = blk(x, rope=rope)
+        if self.final_norm:
+            x = self.norm(x)
+
+        if global_pool or per_frame:
+            if self.cls_embed:
+                # remove cls token
+                x = x[:, 1:, :]
+            if per_frame:
+                return x.view(N, T, n_valid, C).mean(dim=2)
+            return x.mean(dim=1)
+        elif cls_forward:
+            return x[:, :1, :]
+        return x
+
+
+def export_encoder(model, path=None, padding_mask=None, final_norm=False):
+    """Export the encoder of a MaskedAutoencoderViT for inference.
+
+    Args:
+        model (MaskedAutoencoderViT): trained model.
+        path (str, optional): file to save the exported encoder to. Contains only tensors and builtin types so it
+            can be loaded with torch.load(path, weights_only=True).
+        padding_mask (torch.Tensor, optional): bool tensor of shape [H, W] of present electrodes to freeze into
+            the encoder, initialized on the model. If None the model's current mask is used.
+        final_norm (bool): If True the encoder applies the final norm, by default embeddings match
+            forward(..., forward_features=True).
+
+    Returns:
+        dict with the encoder's "config" (keyword arguments of EncoderViT) and "state_dict".
+    """
+    if padding_mask is not None:
+        model.initialize_mask(padding_mask)
+    if model.per_sample_mask:
+        raise ValueError("Can only export an encoder for a mask shared by all samples.")
+    img_mask = model.img_mask
+    if img_mask is None:
+        img_mask = torch.ones(model.patch_embed.img_size, dtype=torch.bool)
+
+    attn = model.blocks[0].attn
+    config = {
+        "img_size": model.patch_embed.img_size[0],
+        "patch_size": model.patch_embed.patch_size[0],
+        "in_chans": model.patch_embed.in_chans,
+        "embed_dim": model.embed_dim,
+        "depth": len(model.blocks),
+        "num_heads": attn.num_heads,
+        "mlp_ratio": model.blocks[0].mlp.fc1.out_features / model.embed_dim,
+        "num_frames": model.patch_embed.frames,
+        "t_patch_size": model.patch_embed.t_patch_size,
+        "qkv_bias": attn.q.bias is not None,
+        "cls_embed": model.cls_embed,
+        "use_rope": model.use_rope,
+        "img_mask": img_mask.cpu().tolist(),
+        "norm_eps": model.norm.eps,
+        "input_scale_factor": model.masked_input_norm.scale_factor,
+        "final_norm": final_norm,
+    }
+
+    encoder = EncoderViT(**config)
+    state_dict = {
+        key: value
+        for key, value in model.state_dict().items()
+        if key.startswith(("masked_input_norm.", "patch_embed.", "blocks.", "norm."))
+    }
+    with torch.no_grad():
+        if model.use_rope:
+            cls_pos_embed = 0.0
+        else:
+            pos_embed = model.get_pos_embed()
+            if model.cls_embed:
+                cls_pos_embed, pos_embed = pos_embed[:, :1], pos_embed[:, 1:]
+            T, H, W = model.input_size
+            pos_embed = pos_embed.view(1, T, H * W, -1)[:, :, encoder.patch_indices]
+            state_dict["pos_embed"] = pos_embed.reshape(1, -1, model.embed_dim)
+        if model.cls_embed:
+            state_dict["cls_token"] = model.cls_token + cls_pos_embed
+    state_dict["img_mask"] = encoder.img_mask
+    state_dict["patch_indices"] = encoder.patch_indices
+    encoder.load_state_dict(state_dict)
+
+    exported = {
+        "config": config,
+        "state_dict": {k: v.detach().cpu() for k, v in encoder.state_dict().items()},
+    }
+    if path is not None:
+        torch.save(exported, path)
+    return exported
+
+
+def load_encoder(path, device="cpu"):
+    """Load an encoder saved by export_encoder in eval mode onto device."""
+    exported = torch.load(path, map_location=device, weights_only=True)
+    encoder = EncoderViT(**exported["config"])
+    encoder.load_state_dict(exported["state_dict"])
+    return encoder.to(device).eval()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from checkpoint import load_model
+
+    parser = argparse.ArgumentParser(
+        description="Export the encoder of a checkpoint saved by train.py."
+    )
+    parser.add_argument(
+        "checkpoint",
+        help="Path to the training checkpoint or model saved by checkpoint.save_model.",
+    )
+    parser.add_argument("output", help="Path to save the exported encoder to.")
+    parser.add_argument(
+        "--final-norm",
+        action="store_true",
+        help="Apply the encoder's final norm to the embeddings.",
+    )
+    args = parser.parse_args()
+
+    model = load_model(args.checkpoint)
+    export_encoder(model, args.output, final_norm=args.final_norm)
@@ -11,18 +11,33 @@
 # MAE-ST: https://github.com/facebookresearch/mae_st
 # --------------------------------------------------------
 
+from contextlib import contextmanager
 from functools import partial
 import torch
 import torch.nn as nn
 from einops import rearrange
 import copy
 from mae_st_util import video_vit
+import utils
+from mask import (
+    PatchMaskCache,
+    get_running_cell_mask,
+    get_tube_mask,
+    keep_mask_ids,
+    padding_mask_key,
+    sample_keep_ids,
+)
+from mae_st_util.pos_embed import interpolate_pos_embed_temporal
 from metrics import pearson_correlation
+from rope import RotaryPositionalEmbeddings4D
 
 
 class MaskedAutoencoderViT(nn.Module):
     """Masked Autoencoder with VisionTransformer backbone"""
 
+    # Number of input lengths to cache interpolated position embeddings for, see interpolate_pos_embed.
+    POS_EMBED_CACHE_SIZE = 8
+
     def __init__(
         self,
         img_size=224,
@@ -46,6 +61,12 @@ class MaskedAutoencoderViT(nn.Module):
         pred_t_dim=8,
         img_mask=None,
         pct_masks_to_decode=1,
+        pack_tokens=False,
+        static_shapes=False,
+        use_rope=False,
+        mask_strategy="random",
+        decoder_mask_strategy="random",
+        num_masks=1,
         proj_drop=0.0,
         drop_path=0.0,
         **kwargs,
@@ -81,6 +102,24 @@ class MaskedAutoencoderViT(nn.Module):
             img_mask (torch.Tensor, optional): Mask indicating which pixels are present/absent. True means present, false means
                 absent. Can also be instantiated using initialize_mask(). Defaults to None.
             pct_masks_to_decode (float, optional): Percentage of masked patches to decode. Defaults to 1.
+            pack_tokens (bool, optional): If True and samples have different padding masks, only the real tokens of
+                each sample are packed along one sequence for the transformer blocks instead of padding every sample
+                to the longest one. Defaults to False.
+            static_shapes (bool, optional): If True all tensor shapes only depend on the model config and not on the
+                image mask, so that a torch.compile'd forward doesn't recompile for new electrode layouts. Tokens are
+                padded to the sizes of a full grid and padding is excluded with attention masks and loss weights.
+                Defaults to False.
+            use_rope (bool, optional): If True rotate queries and keys in attention by 4D rotary position
+                embeddings of each token's (time, height, width) position instead of adding learned position
+                embeddings, sep_pos_embed is then ignored. Defaults to False.
+            mask_strategy (str, optional): How tokens are masked for the encoder, "random" masks tokens
+                independently and "tube" masks patches for all frames at once (see mask.get_tube_mask), so the
+                encoder gets the same number of tokens from every frame. Defaults to "random".
+            decoder_mask_strategy (str, optional): How the patches passed through the decoder are selected, "random"
+                selects the same patches for all frames and "running_cell" moves the selection across frames as in
+                mask.get_running_cell_mask. Only used with an image mask. Defaults to "random".
+            num_masks (int, optional): Number of masks drawn for every sample in forward. The input is normalized and
+                embedded once and shared by all masks, the loss is computed over all masks together. Defaults to 1.
             proj_drop (float, optional): Probability of drop out in projection layer of attention blocks.
             drop_path (float, optional): Probability of drop path in attention blocks.
             **kwargs: Additional arguments passed to parent class.
@@ -105,9 +144,25 @@ class MaskedAutoencoderViT(nn.Module):
         self.t_pred_patch_size = t_patch_size * pred_t_dim // num_frames
         self.embed_dim = embed_dim
         self.pct_masks_to_decode = pct_masks_to_decode
+        self.pack_tokens = pack_tokens
+        self.static_shapes = static_shapes
+        self.use_rope = use_rope
         self.patch_size = patch_size
+        assert mask_strategy in ("random", "tube"), mask_strategy
+        assert decoder_mask_strategy in (
+            "random",
+            "running_cell",
+        ), decoder_mask_strategy
+        self.mask_strategy = mask_strategy
+        self.decoder_mask_strategy = decoder_mask_strategy
+        self.num_masks = num_masks
 
         self.masked_input_norm = video_vit.MaskedBatchNorm(in_chans)
+        self.mask_cache = PatchMaskCache()
+        self.mask_key = None
+        # (t_grid_size, device, dtype) -> (data_ptr, version, interpolated position embeddings), see
+        # interpolate_pos_embed
+        self._pos_embed_cache = {}
 
         self.patch_embed = patch_embed(
             img_size,
@@ -125,7 +180,17 @@ class MaskedAutoencoderViT(nn.Module):
             self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
             self.decoder_cls_token = nn.Parameter(torch.zeros(1, 1, decoder_embed_dim))
 
-        if sep_pos_embed:
+        self.rope = None
+        self.decoder_rope = None
+        if use_rope:
+            self.rope = RotaryPositionalEmbeddings4D(
+                embed_dim // num_heads,
+                grid_height=input_size[1],
+                grid_width=input_size[2],
+                grid_depth=1,
+                grid_time=input_size[0],
+            )
+        elif sep_pos_embed:
             self.pos_embed_spatial = nn.Parameter(
                 torch.zeros(1, input_size[1] * input_size[2], embed_dim)
             )
@@ -165,7 +230,15 @@ class MaskedAutoencoderViT(nn.Module):
 
         self.mask_token = nn.Parameter(torch.zeros(1, 1, decoder_embed_dim))
 
-        if sep_pos_embed:
+        if use_rope:
+            self.decoder_rope = RotaryPositionalEmbeddings4D(
+                decoder_embed_dim // decoder_num_heads,
+                grid_height=input_size[1],
+                grid_width=input_size[2],
+                grid_depth=1,
+                grid_time=input_size[0],
+            )
+        elif sep_pos_embed:
             self.decoder_pos_embed_spatial = nn.Parameter(
                 torch.zeros(1, input_size[1] * input_size[2], decoder_embed_dim)
             )
@@ -215,7 +288,10 @@ class MaskedAutoencoderViT(nn.Module):
     def initialize_weights(self):
         if self.cls_embed:
             torch.nn.init.trunc_normal_(self.cls_token, std=0.02)
-        if self.sep_pos_embed:
+        if self.use_rope:
+            # rotary position embeddings don't have parameters
+            pass
+        elif self.sep_pos_embed:
             torch.nn.init.trunc_normal_(self.pos_embed_spatial, std=0.02)
             torch.nn.init.trunc_normal_(self.pos_embed_temporal, std=0.02)
 
@@ -253,83 +329,254 @@ class MaskedAutoencoderViT(nn.Module):
             nn.init.constant_(m.weight, 1.0)
 
     def initialize_mask(self, img_mask):
-        """Provide a mask of which pixels in the image are not present. True means value is masked out, False means it is present.
+        """Provide a mask of which pixels in the image are not present. True means value is present, False means it is masked out.
+
+        Patch masks derived from img_mask are cached by its bit pattern, so calling this with the electrode layout of
+        the previous batch is only a lookup.
 
-        img_mask: bool tensor of shape [H, W]
+        img_mask: bool tensor of shape [H, W] shared by all samples, or per-sample masks of shape [B, H, W]. With
+            per-sample masks every sample keeps its own electrodes and sequences of different lengths are padded to
+            the longest one in the batch and excluded from attention with attention masks.
         """
-        if img_mask is not None:
-            img_mask = torch.as_tensor(img_mask > 0).float()
+        if img_mask is None:
+            self._set_mask_buffers(None, None, None, None)
+            self.n_valid_patches = None
+            self.n_mask_patches = None
+            self.mask_key = None
+            return
 
-            H, W = img_mask.shape
-            img_mask_patches = self.patchify(
-                img_mask.view(1, 1, 1, H, W).repeat(
-                    1, self.patch_embed.in_chans, self.pred_t_dim, 1, 1
-                )
-            )
+        img_mask = torch.as_tensor(img_mask) > 0
+        device = self.mask_token.device
 
-            patch_mask = (
-                rearrange(
-                    img_mask,
-                    "(h ph) (w pw) -> (h w) (ph pw)",
-                    ph=self.patch_embed.patch_size[0],
-                    pw=self.patch_embed.patch_size[1],
+        if img_mask.ndim == 3:
+            sample_keys = padding_mask_key(img_mask)
+            if len(set(sample_keys)) == 1 and not self.static_shapes:
+                # All samples share the same layout so there's no need for per-sample masks.
+                img_mask = img_mask[0]
+            else:
+                key = (tuple(sample_keys), str(device))
+                if key == self.mask_key:
+                    return
+
+                sample_masks = [
+                    self.mask_cache.get(
+                        (sample_key, str(device)),
+                        lambda m=sample_mask: self._build_patch_masks(m.to(device)),
+                    )
+                    for sample_key, sample_mask in zip(sample_keys, img_mask)
+                ]
+                self._set_mask_buffers(
+                    torch.stack([masks[0] for masks in sample_masks]),
+                    torch.cat([masks[1] for masks in sample_masks]),
+                    torch.stack([masks[2] for masks in sample_masks]),
+                    None,
                 )
-                .any(dim=1)
-                .float()
+                self.n_valid_patches = [len(masks[3]) for masks in sample_masks]
+                self.n_mask_patches = [
+                    int(n * self.pct_masks_to_decode) for n in self.n_valid_patches
+                ]
+                self.mask_key = key
+                return
+
+        key = (padding_mask_key(img_mask), str(device))
+        if key == self.mask_key:
+            return
+
+        masks = self.mask_cache.get(
+            key, lambda: self._build_patch_masks(img_mask.to(device))
+        )
+        self._set_mask_buffers(*masks)
+        self.n_valid_patches = len(masks[3])
+        self.n_mask_patches = int(self.n_valid_patches * self.pct_masks_to_decode)
+        self.mask_key = key
+
+    @property
+    def per_sample_mask(self):
+        """True if the image mask was initialized with a different mask for each sample."""
+        return self.img_mask is not None and self.img_mask.ndim == 3
+
+    @property
+    def pad_samples(self):
+        """True if tokens are padded per sample, because samples have their own masks or static shapes are used."""
+        return self.img_mask is not None and (
+            self.static_shapes or self.per_sample_mask
+        )
+
+    @contextmanager
+    def repeat_masks(self, num_repeats):
+        """Repeat the image mask of every sample num_repeats times while in this context.
+
+        Used to draw several masks for every sample of a batch, where the rows of the batch are the num_repeats
+        masks of the first sample followed by those of the second one and so on. Only per-sample masks need to be
+        repeated, a shared mask already applies to any number of rows.
+        """
+        if num_repeats == 1 or not self.per_sample_mask:
+            yield
+            return
+
+        buffers = (self.img_mask, self.img_mask_patches, self.patch_mask)
+        n_valid_patches, n_mask_patches = self.n_valid_patches, self.n_mask_patches
+        mask_key = self.mask_key
+        self._set_mask_buffers(
+            *[buffer.repeat_interleave(num_repeats, dim=0) for buffer in buffers],
+            self.patch_mask_indices,
+        )
+        self.n_valid_patches = [n for n in n_valid_patches for _ in range(num_repeats)]
+        self.n_mask_patches = [n for n in n_mask_patches for _ in range(num_repeats)]
+        self.mask_key = None
+        try:
+            yield
+        finally:
+            self._set_mask_buffers(*buffers, self.patch_mask_indices)
+            self.n_valid_patches = n_valid_patches
+            self.n_mask_patches = n_mask_patches
+            self.mask_key = mask_key
+
+    def get_sample_len_keep(self, mask_ratio):
+        """Number of tokens kept for the encoder per sample, computed on device from the patch mask.
+
+        Returns:
+            long tensor of shape [1] for a shared mask or [B] for per-sample masks.
+        """
+        T = self.patch_embed.t_grid_size
+        H, W = self.patch_embed.grid_size
+        if self.mask_strategy == "tube":
+            n_valid_patches = self.patch_mask.view(-1, H * W).sum(dim=1).double()
+            return T * (n_valid_patches * (1 - mask_ratio)).long()
+        # Double precision floors the same way as int(T * n_mask_patches * (1 - mask_ratio)) in get_len_keep.
+        n_mask_patches = torch.floor(
+            self.patch_mask.view(-1, H * W).sum(dim=1).double()
+            * self.pct_masks_to_decode
+        )
+        return (T * n_mask_patches * (1 - mask_ratio)).long()
+
+    def generate_noise(self, batch_size, device, generator=None):
+        """Draw the random noise used for masking, to be passed into forward.
+
+        Supplying the noise as inputs keeps random ops out of a compiled forward and makes masks reproducible.
+
+        generator: optional torch.Generator on device to draw the noise from.
+
+        Returns noise for batch_size * num_masks rows, the masks of each sample are consecutive:
+            noise: [N, L] noise for random_masking.
+            decoder_noise: [N, H * W] noise for select_decoder_patches, [N, T, H * W] for running cell masking.
+        """
+        batch_size = batch_size * self.num_masks
+        return (
+            self.generate_encoder_noise(batch_size, device, generator),
+            self.generate_decoder_noise(batch_size, device, generator),
+        )
+
+    def generate_encoder_noise(self, batch_size, device, generator=None):
+        """Draw the noise deciding which tokens random_masking keeps, following mask_strategy.
+
+        Returns [N, L] noise, or [N, H * W] noise over patches for tube masking.
+        """
+        T = self.patch_embed.t_grid_size
+        H, W = self.patch_embed.grid_size
+        if self.mask_strategy == "tube":
+            return torch.rand(batch_size, H * W, device=device, generator=generator)
+        return torch.rand(batch_size, T * H * W, device=device, generator=generator)
+
+    def generate_decoder_noise(self, batch_size, device, generator=None):
+        """Draw the noise deciding which patches select_decoder_patches selects, following decoder_mask_strategy."""
+        T = self.patch_embed.t_grid_size
+        H, W = self.patch_embed.grid_size
+        if self.decoder_mask_strategy == "running_cell":
+            return torch.rand(batch_size, T, H * W, device=device, generator=generator)
+        return torch.rand(batch_size, H * W, device=device, generator=generator)
+
+    def get_len_keep(self, mask_ratio):
+        """Number of tokens kept for the encoder, a list with one entry per sample for per-sample masks.
+
+        With static shapes this is the number kept for a full grid, see get_sample_len_keep for the number kept
+        per sample. Tube masking keeps int(n_valid_patches * (1 - mask_ratio)) patches in every frame.
+        """
+        T = self.patch_embed.t_grid_size
+        H, W = self.patch_embed.grid_size
+        if self.mask_strategy == "tube":
+            if self.img_mask is None or self.static_shapes:
+                return T * int(H * W * (1 - mask_ratio))
+            if self.per_sample_mask:
+                return [T * int(n * (1 - mask_ratio)) for n in self.n_valid_patches]
+            return T * int(self.n_valid_patches * (1 - mask_ratio))
+        if self.img_mask is None or self.static_shapes:
+            return int(T * H * W * (1 - mask_ratio))
+        if self.per_sample_mask:
+            return [int(T * n * (1 - mask_ratio)) for n in self.n_mask_patches]
+        return int(T * self.n_mask_patches * (1 - mask_ratio))
+
+    def _build_patch_masks(self, img_mask):
+        """Derive the patch level masks used by the model from a [H, W] image mask."""
+        img_mask = img_mask.float()
+
+        H, W = img_mask.shape
+        img_mask_patches = self.patchify(
+            img_mask.view(1, 1, 1, H, W).repeat(
+                1, self.patch_embed.in_chans, self.pred_t_dim, 1, 1
             )
-            (patch_mask_indices,) = patch_mask.nonzero(as_tuple=True)
+        )
 
-            self.register_buffer("img_mask", img_mask)
-            self.register_buffer("img_mask_patches", img_mask_patches)
-            self.register_buffer("patch_mask", patch_mask)
-            self.register_buffer("patch_mask_indices", patch_mask_indices)
-            self.n_mask_patches = int(
-                len(patch_mask_indices) * self.pct_masks_to_decode
+        patch_mask = (
+            rearrange(
+                img_mask,
+                "(h ph) (w pw) -> (h w) (ph pw)",
+                ph=self.patch_embed.patch_size[0],
+                pw=self.patch_embed.patch_size[1],
             )
-        else:
-            self.register_buffer("img_mask", None)
-            self.register_buffer("img_mask_patches", None)
-            self.register_buffer("patch_mask", None)
-            self.register_buffer("patch_mask_indices", None)
-            self.n_mask_patches = None
+            .any(dim=1)
+            .float()
+        )
+        (patch_mask_indices,) = patch_mask.nonzero(as_tuple=True)
+
+        return img_mask, img_mask_patches, patch_mask, patch_mask_indices
+
+    def _set_mask_buffers(
+        self, img_mask, img_mask_patches, patch_mask, patch_mask_indices
+    ):
+        buffers = {
+            "img_mask": img_mask,
+            "img_mask_patches": img_mask_patches,
+            "patch_mask": patch_mask,
+            "patch_mask_indices": patch_mask_indices,
+        }
+        for name, value in buffers.items():
+            if name in self._buffers:
+                self._buffers[name] = value
+            else:
+                # Masks of the current batch move with the model but aren't saved in its state dict.
+                self.register_buffer(name, value, persistent=False)
 
     def patchify(self, imgs):
         """
         imgs: (N, C, T, H, W)
-        x: (N, L, patch_size**2 *C)
+        x: (N, L, t_pred_patch_size * patch_size**2 * C)
         """
-        N, C, T, H, W = imgs.shape
-        ph, pw = self.patch_embed.patch_size
-        u = self.t_pred_patch_size
-        assert H % ph == 0 and W % pw == 0 and T % u == 0
-        h = H // ph
-        w = W // pw
-        t = T // u
-
-        x = imgs.reshape(shape=(N, C, t, u, h, ph, w, pw))
-        x = torch.einsum("nctuhpwq->nthwupqc", x)
-        x = x.reshape(shape=(N, t * h * w, u * ph * pw * C))
-        self.patch_info = (N, C, T, H, W, ph, pw, u, t, h, w)
-        return x
+        return utils.patchify(imgs, self.patch_embed.patch_size, self.t_pred_patch_size)
 
     def unpatchify(self, x):
         """
-        x: (N, L, patch_size**2 *C)
-        imgs: (N, C, H, W)
-        """
-        N, C, T, H, W, ph, pw, u, t, h, w = self.patch_info
-
-        x = x.reshape(shape=(N, t, h, w, u, ph, pw, C))
+        x: (N, L, t_pred_patch_size * patch_size**2 * C)
+        imgs: (N, C, T, H, W)
 
-        x = torch.einsum("nthwupqc->nctuhpwq", x)
-        imgs = x.reshape(shape=(N, C, T, H, W))
-        return imgs
+        Shapes are derived from x and the model config so patchify and unpatchify don't share any state.
+        """
+        return utils.unpatchify(
+            x,
+            self.patch_embed.patch_size,
+            self.t_pred_patch_size,
+            self.patch_embed.grid_size,
+        )
 
-    def random_masking(self, x, mask_ratio, use_contrastive_loss=False):
+    def random_masking(
+        self, x, mask_ratio, use_contrastive_loss=False, noise=None, generator=None
+    ):
         """
         Perform per-sample random masking by per-sample shuffling.
-        Per-sample shuffling is done by argsort random noise.
+        The tokens with the smallest noise are kept, see mask.sample_keep_ids.
         x: [N, L, D], sequence
+        noise: optional [N, L] noise in [0, 1) to shuffle by, [N, H * W] for tube masking, see generate_noise.
+        generator: optional torch.Generator to draw the noise from if it isn't given.
         """
         N, L, D = x.shape  # batch, length, dim
         T = self.patch_embed.t_grid_size
@@ -337,27 +584,39 @@ class MaskedAutoencoderViT(nn.Module):
         assert L == T * H * W
 
         # adjust number to keep relative to image mask
-        if self.img_mask is not None:
-            len_keep = int(T * self.n_mask_patches * (1 - mask_ratio))
+        if self.static_shapes and self.img_mask is not None:
+            # Keep as many tokens as for a full grid and mask out the rest with an attention mask.
+            sample_len_keep = self.get_sample_len_keep(mask_ratio)
+            len_keep = self.get_len_keep(mask_ratio)
+        elif self.per_sample_mask:
+            # Samples keep different numbers of tokens, so keep the most of any sample and mask out the rest
+            # with an attention mask, see get_keep_mask.
+            len_keep = self.get_len_keep(mask_ratio)
+            sample_len_keep = torch.tensor(len_keep, device=x.device)
+            len_keep = max(len_keep)
         else:
-            len_keep = int(L * (1 - mask_ratio))
+            len_keep = self.get_len_keep(mask_ratio)
 
-        noise = torch.rand(N, L, device=x.device)  # noise in [0, 1]
+        if noise is None:
+            noise = self.generate_encoder_noise(N, x.device, generator)
 
-        # shift missing patches to not be selected
+        # missing patches are only selected after all present ones
+        valid = None
         if self.img_mask is not None:
-            noise = noise.view(N, T, H * W)
-            noise = noise + (1.0 - self.patch_mask)
-            noise = noise.view(N, L)
-
-        # sort noise for each sample
-        ids_shuffle = torch.argsort(
-            noise, dim=1
-        )  # ascend: small is keep, large is remove
-        ids_restore = torch.argsort(ids_shuffle, dim=1)
-
-        # keep the first subset
-        ids_keep = ids_shuffle[:, :len_keep]
+            valid = (self.patch_mask > 0).view(-1, 1, H * W).expand(-1, T, -1)
+            valid = valid.reshape(-1, L)
+
+        if self.mask_strategy == "tube":
+            # the kept tokens are ordered frame by frame with the same patches in every frame
+            if self.img_mask is None:
+                patch_mask = torch.ones(H * W, dtype=torch.bool, device=x.device)
+            else:
+                patch_mask = self.patch_mask.view(-1, H * W)
+            keep_mask = get_tube_mask(mask_ratio, T, patch_mask, x.device, noise=noise)
+            ids_keep, ids_restore = keep_mask_ids(keep_mask, len_keep, valid)
+        else:
+            # small is keep, large is remove
+            ids_keep, ids_restore = sample_keep_ids(noise, len_keep, valid)
         if not use_contrastive_loss:
             x_masked = torch.gather(
                 x, dim=1, index=ids_keep.unsqueeze(-1).repeat(1, 1, D)
@@ -376,41 +635,196 @@ class MaskedAutoencoderViT(nn.Module):
                 .repeat(1, 1, D),
             )
 
+        # generate the binary mask from the shuffled positions: 0 is keep, 1 is remove
         if not use_contrastive_loss:
-            # generate the binary mask: 0 is keep, 1 is remove
-            mask = torch.ones([N, L], device=x.device)
-            mask[:, :len_keep] = 0
-            # unshuffle to get the binary mask
-            mask = torch.gather(mask, dim=1, index=ids_restore)
+            if self.pad_samples:
+                mask = (ids_restore >= sample_len_keep.unsqueeze(1)).float()
+            else:
+                mask = (ids_restore >= len_keep).float()
         else:
-            # generate the binary mask: 0 is keep, 1 is remove
-            mask1 = torch.ones([N, L], device=x.device)
-            mask2 = torch.ones([N, L], device=x.device)
-            mask1[:, : len_keep // 2] = 0
-            mask2[:, len_keep // 2 : len_keep] = 0
-            # unshuffle to get the binary mask
-            mask1 = torch.gather(mask1, dim=1, index=ids_restore)
-            mask2 = torch.gather(mask2, dim=1, index=ids_restore)
+            mask1 = (ids_restore >= len_keep // 2).float()
+            mask2 = ((ids_restore < len_keep // 2) | (ids_restore >= len_keep)).float()
 
         if not use_contrastive_loss:
             return x_masked, mask, ids_restore, ids_keep
         else:
             return [x_masked1, x_masked2], [mask1, mask2], ids_restore, ids_keep
 
-    def forward_encoder(self, x, mask_ratio, use_contrastive_loss=False):
+    def get_keep_mask(self, mask, len_keep):
+        """Get which of the tokens kept for the encoder belong to a sample when samples are padded, see pad_samples.
+
+        mask: [N, L], 0 is keep, 1 is remove.
+        len_keep: number of tokens passed into the encoder, the most kept by any sample.
+
+        Returns:
+            keep_mask: bool tensor [N, len_keep], False for tokens padding a sample to len_keep. None if samples
+                aren't padded.
+        """
+        if not self.pad_samples:
+            return None
+        sample_len_keep = mask.shape[1] - mask.sum(dim=1, keepdim=True)
+        return torch.arange(len_keep, device=mask.device) < sample_len_keep
+
+    def interpolate_pos_embed(self, pos_embed, t_grid_size, num_spatial=1):
+        """Interpolate learned position embeddings over time for inputs with a different number of frames.
+
+        pos_embed: [1, T * num_spatial, C] position embeddings without extra tokens, see
+            pos_embed.interpolate_pos_embed_temporal.
+        t_grid_size: number of temporal patches of the input.
+        num_spatial: number of tokens per temporal patch.
+
+        Interpolated embeddings are cached per length as long as the embeddings aren't updated or replaced, unless
+        gradients need to flow through the interpolation. The POS_EMBED_CACHE_SIZE most recently added lengths are
+        kept.
+        """
+        if t_grid_size == self.input_size[0]:
+            return pos_embed
+        if torch.is_grad_enabled() and pos_embed.requires_grad:
+            return interpolate_pos_embed_temporal(pos_embed, t_grid_size, num_spatial)
+
+        key = (t_grid_size, pos_embed.device, pos_embed.dtype)
+        source = (pos_embed.data_ptr(), pos_embed._version)
+        cached = self._pos_embed_cache.get(key)
+        if cached is None or cached[:2] != source:
+            self._pos_embed_cache.pop(key, None)
+            if len(self._pos_embed_cache) >= self.POS_EMBED_CACHE_SIZE:
+                # Dicts are ordered by insertion, so this evicts the oldest length.
+                del self._pos_embed_cache[next(iter(self._pos_embed_cache))]
+            cached = (
+                *source,
+                interpolate_pos_embed_temporal(
+                    pos_embed.detach(), t_grid_size, num_spatial
+                ),
+            )
+            self._pos_embed_cache[key] = cached
+        return cached[2]
+
+    def get_pos_embed(self, ids_keep=None, t_grid_size=None):
+        """Get the learned position embeddings of the encoder tokens, prepended by the cls token's if used.
+
+        ids_keep: optional [N, len_keep] indices of the kept tokens, see random_masking. If None the embeddings of
+            every token are returned with a batch dimension of 1.
+        t_grid_size: optional number of temporal patches if the input has a different number of frames than the
+            model was configured for, the temporal position embeddings are interpolated to this length.
+        """
+        t_grid_size = t_grid_size or self.input_size[0]
+        num_spatial = self.input_size[1] * self.input_size[2]
+        if self.sep_pos_embed:
+            pos_embed_temporal = self.interpolate_pos_embed(
+                self.pos_embed_temporal, t_grid_size
+            )
+            pos_embed = self.pos_embed_spatial.repeat(
+                1, t_grid_size, 1
+            ) + torch.repeat_interleave(
+                pos_embed_temporal,
+                num_spatial,
+                dim=1,
+            )
+            cls_pos_embed = self.pos_embed_class if self.cls_embed else None
+        else:
+            pos_embed = self.interpolate_pos_embed(
+                self.pos_embed[:, int(self.cls_embed) :, :], t_grid_size, num_spatial
+            )
+            cls_pos_embed = self.pos_embed[:, :1, :] if self.cls_embed else None
+
+        if ids_keep is not None:
+            pos_embed = pos_embed.expand(ids_keep.shape[0], -1, -1)
+            pos_embed = torch.gather(
+                pos_embed,
+                dim=1,
+                index=ids_keep.unsqueeze(-1).repeat(1, 1, pos_embed.shape[2]),
+            )
+        if self.cls_embed:
+            pos_embed = torch.cat(
+                [cls_pos_embed.expand(pos_embed.shape[0], -1, -1), pos_embed], 1
+            )
+        return pos_embed
+
+    def get_rope(self, rope, positions, t_grid_size=None):
+        """Get the rotary position embeddings of tokens for the attention blocks.
+
+        rope: self.rope for the encoder or self.decoder_rope for the decoder.
+        positions: long tensor [N, L] of the tokens' indices into the T * H * W patch grid, excluding the cls
+            token which isn't rotated.
+        t_grid_size: optional number of temporal patches T if the input has a different number of frames than the
+            model was configured for.
+
+        Returns:
+            (cos, sin) to pass into the blocks, or None if rotary position embeddings aren't used.
+        """
+        if rope is None:
+            return None
+        if self.cls_embed:
+            positions = torch.cat(
+                (positions.new_full((positions.shape[0], 1), -1), positions), dim=1
+            )
+        # Rotate in the dtype queries and keys are computed in.
+        device_type = positions.device.type
+        if torch.is_autocast_enabled(device_type):
+            dtype = torch.get_autocast_dtype(device_type)
+        else:
+            dtype = torch.float32
+        return rope(
+            positions,
+            grid_time=t_grid_size or self.patch_embed.t_grid_size,
+            dtype=dtype,
+        )
+
+    def forward_packed(self, x, token_mask, blocks, norm, rope=None):
+        """Apply transformer blocks and norm to only the real tokens of each sample.
+
+        x: [N, L, C] tokens padded to the longest sample.
+        token_mask: bool tensor [N, L] of real tokens excluding the cls token, on the cpu so packing doesn't sync
+            with the device.
+        blocks: transformer blocks to apply.
+        norm: norm applied after the blocks.
+        rope: optional rotary position embeddings of the padded tokens, see get_rope.
+
+        Returns:
+            [N, L, C] tokens, padded tokens are zero.
+        """
+        if self.cls_embed:
+            token_mask = torch.cat((token_mask[:, :1] | True, token_mask), dim=1)
+        packed = video_vit.PackedSequences(token_mask, x.device)
+        x = packed.pack(x)
+        if rope is not None:
+            rope = packed.pack_rope(rope)
+        for blk in blocks:
+            x = blk(x, packed=packed, rope=rope)
+        x = norm(x)
+        return packed.unpack(x)
+
+    def forward_encoder(
+        self,
+        x,
+        mask_ratio,
+        use_contrastive_loss=False,
+        noise=None,
+        generator=None,
+        num_masks=1,
+    ):
         x = self.patch_embed(x)
 
+        # every mask of a sample shares its patch embeddings, see repeat_masks
+        if num_masks > 1:
+            x = x.repeat_interleave(num_masks, dim=0)
+
         N, T, L, C = x.shape
 
         x = x.reshape(N, T * L, C)
 
         # masking: length -> length * mask_ratio
         if not use_contrastive_loss:
-            x, mask, ids_restore, ids_keep = self.random_masking(x, mask_ratio)
+            x, mask, ids_restore, ids_keep = self.random_masking(
+                x, mask_ratio, noise=noise, generator=generator
+            )
             x = x.view(N, -1, C)
         else:
             [x1, x2], [mask1, mask2], ids_restore, ids_keep = self.random_masking(
-                x, mask_ratio, use_contrastive_loss=use_contrastive_loss
+                x,
+                mask_ratio,
+                use_contrastive_loss=use_contrastive_loss,
+                generator=generator,
             )
             x1 = x1.view(len(x1), -1, C)
             x2 = x2.view(len(x2), -1, C)
@@ -425,66 +839,50 @@ class MaskedAutoencoderViT(nn.Module):
                 x1 = torch.cat((cls_tokens, x1), dim=1)
                 x2 = torch.cat((cls_tokens, x2), dim=1)
 
-        # add pos embed w/o cls token
-        if self.sep_pos_embed:
-            pos_embed = self.pos_embed_spatial.repeat(
-                1, self.input_size[0], 1
-            ) + torch.repeat_interleave(
-                self.pos_embed_temporal,
-                self.input_size[1] * self.input_size[2],
-                dim=1,
-            )
-            pos_embed = pos_embed.expand(x.shape[0], -1, -1)
-            pos_embed = torch.gather(
-                pos_embed,
-                dim=1,
-                index=ids_keep.unsqueeze(-1).repeat(1, 1, pos_embed.shape[2]),
-            )
-            if self.cls_embed:
-                pos_embed = torch.cat(
-                    [
-                        self.pos_embed_class.expand(pos_embed.shape[0], -1, -1),
-                        pos_embed,
-                    ],
-                    1,
-                )
+        # add pos embed w/o cls token, or rotate queries and keys by the positions of the kept tokens
+        if self.use_rope:
+            if not use_contrastive_loss:
+                rope = self.get_rope(self.rope, ids_keep)
+            else:
+                n_keep1 = x1.shape[1] - self.cls_embed
+                rope1 = self.get_rope(self.rope, ids_keep[:, :n_keep1])
+                rope2 = self.get_rope(self.rope, ids_keep[:, n_keep1:])
         else:
-            if self.cls_embed:
-                cls_ind = 1
+            rope = rope1 = rope2 = None
+            pos_embed = self.get_pos_embed(ids_keep)
+            if not use_contrastive_loss:
+                x = x.view([N, -1, C]) + pos_embed
             else:
-                cls_ind = 0
-            pos_embed = self.pos_embed[:, cls_ind:, :].expand(x.shape[0], -1, -1)
-            pos_embed = torch.gather(
-                pos_embed,
-                dim=1,
-                index=ids_keep.unsqueeze(-1).repeat(1, 1, pos_embed.shape[2]),
-            )
-            if self.cls_embed:
-                pos_embed = torch.cat(
-                    [
-                        self.pos_embed[:, :1, :].expand(x.shape[0], -1, -1),
-                        pos_embed,
-                    ],
-                    1,
+                x1 = x1.view([len(x1), -1, C]) + pos_embed[:, : x1.shape[1]]
+                x2 = x2.view([len(x2), -1, C]) + torch.cat(
+                    (pos_embed[:, :1], pos_embed[:, x1.shape[1] :]), dim=1
                 )
-        if not use_contrastive_loss:
-            x = x.view([N, -1, C]) + pos_embed
-        else:
-            x1 = x1.view([len(x1), -1, C]) + pos_embed[:, : x1.shape[1]]
-            x2 = x2.view([len(x2), -1, C]) + torch.cat(
-                (pos_embed[:, :1], pos_embed[:, x1.shape[1] :]), dim=1
-            )
 
         if not use_contrastive_loss:
-            # apply Transformer blocks
-            for blk in self.blocks:
-                x = blk(x)
-            x = self.norm(x)
+            # exclude tokens padding samples with fewer electrodes from attention
+            attn_mask = self.get_keep_mask(mask, ids_keep.shape[1])
+            if attn_mask is not None and self.cls_embed:
+                attn_mask = torch.cat((attn_mask[:, :1] | True, attn_mask), dim=1)
+
+            if attn_mask is not None and self.pack_tokens and not self.static_shapes:
+                # Computed from the host side lengths so packing doesn't wait on the device.
+                len_keep = self.get_len_keep(mask_ratio)
+                token_mask = torch.arange(max(len_keep)) < torch.tensor(
+                    len_keep
+                ).unsqueeze(1)
+                x = self.forward_packed(
+                    x, token_mask, self.blocks, self.norm, rope=rope
+                )
+            else:
+                # apply Transformer blocks
+                for blk in self.blocks:
+                    x = blk(x, attn_mask=attn_mask, rope=rope)
+                x = self.norm(x)
         else:
             # apply Transformer blocks
             for blk in self.blocks:
-                x1 = blk(x1)
-                x2 = blk(x2)
+                x1 = blk(x1, rope=rope1)
+                x2 = blk(x2, rope=rope2)
             x1 = self.norm(x1)
             x2 = self.norm(x2)
 
@@ -517,57 +915,132 @@ class MaskedAutoencoderViT(nn.Module):
             cls_tokens = cls_token.expand(x.shape[0], -1, -1)
             x = torch.cat((cls_tokens, x), dim=1)
 
-        # add pos embed w/o cls token
-        if self.sep_pos_embed:
-            pos_embed = self.pos_embed_spatial.repeat(
-                1, self.input_size[0], 1
-            ) + torch.repeat_interleave(
-                self.pos_embed_temporal,
-                self.input_size[1] * self.input_size[2],
-                dim=1,
-            )
-            pos_embed = pos_embed.expand(x.shape[0], -1, -1)
-            pos_embed = torch.gather(
-                pos_embed,
-                dim=1,
-                index=ids_keep.unsqueeze(-1).repeat(1, 1, pos_embed.shape[2]),
+        # add pos embed w/o cls token, or rotate queries and keys by the positions of the kept tokens
+        rope = self.get_rope(self.rope, ids_keep)
+        if not self.use_rope:
+            x = x.view([N, -1, C]) + self.get_pos_embed(ids_keep)
+
+        for blk in self.blocks:
+            x = blk(x, rope=rope)
+        x = self.norm(x)
+        return x
+
+    def select_decoder_patches(self, noise=None, generator=None):
+        """Randomly select the spatial patches passed into the decoder (VideoMAE2 approach).
+
+        noise: optional [N, H * W] noise in [0, 1) deciding which patches are selected, or [N, T, H * W] to select
+            patches for each frame, see generate_noise. Without it the noise is drawn on device for one sample, or
+            one per sample for per-sample masks.
+        generator: optional torch.Generator to draw the noise from if it isn't given.
+
+        Returns:
+            Tensor of shape [N, n_mask_patches] (or [N, T, n_mask_patches] for per-frame noise) of indices into the
+            H * W patch grid, or None if no image mask is set in which case every patch is decoded. For per-sample
+            masks the last dim is max(n_mask_patches), see get_decoder_patch_mask for which of these belong to
+            each sample.
+        """
+        if self.img_mask is None:
+            return None
+
+        # Valid patches are selected first by smallest noise, the first n_mask_patches of each sample are decoded.
+        H, W = self.patch_embed.grid_size
+        patch_mask = self.patch_mask.view(-1, H * W)
+        if noise is None:
+            noise = self.generate_decoder_noise(
+                patch_mask.shape[0], patch_mask.device, generator
             )
-            if self.cls_embed:
-                pos_embed = torch.cat(
-                    [
-                        self.pos_embed_class.expand(pos_embed.shape[0], -1, -1),
-                        pos_embed,
-                    ],
-                    1,
-                )
+        if self.static_shapes:
+            num_to_select = int(self.pct_masks_to_decode * H * W)
+        elif self.per_sample_mask:
+            num_to_select = max(self.n_mask_patches)
         else:
-            if self.cls_embed:
-                cls_ind = 1
-            else:
-                cls_ind = 0
-            pos_embed = self.pos_embed[:, cls_ind:, :].expand(x.shape[0], -1, -1)
-            pos_embed = torch.gather(
-                pos_embed,
-                dim=1,
-                index=ids_keep.unsqueeze(-1).repeat(1, 1, pos_embed.shape[2]),
+            num_to_select = self.n_mask_patches
+        if noise.ndim == 3:
+            # Patches skipped by running cell masking in a frame are selected after all others, so the pattern is
+            # followed as far as the number of selected patches allows and patches without signal can be filled
+            # up with skipped ones.
+            T = noise.shape[1]
+            running_cell_mask = get_running_cell_mask(
+                1 - self.pct_masks_to_decode,
+                1,
+                T,
+                torch.zeros(T * H * W, dtype=torch.bool, device=noise.device),
+                noise.device,
             )
-            if self.cls_embed:
-                pos_embed = torch.cat(
-                    [
-                        self.pos_embed[:, :1, :].expand(x.shape[0], -1, -1),
-                        pos_embed,
-                    ],
-                    1,
-                )
+            noise = (noise + ~running_cell_mask.view(T, H * W)) / 2
+            patch_mask = patch_mask.unsqueeze(1)
+        return torch.topk(
+            noise + (1.0 - patch_mask), num_to_select, dim=-1, largest=False
+        ).indices
 
-        x = x.view([N, -1, C]) + pos_embed
+    def get_decoder_patch_mask(self, num_patches):
+        """Get which of the patches from select_decoder_patches belong to each sample for per-sample masks.
 
-        for blk in self.blocks:
-            x = blk(x)
-        x = self.norm(x)
-        return x
+        num_patches: number of patches selected per sample.
+
+        Returns:
+            bool tensor [N, num_patches] (or [1, num_patches] for a shared mask), False for patches padding a
+                sample. None if samples aren't padded, see pad_samples.
+        """
+        if not self.pad_samples:
+            return None
+        # Computed on device to match int(n_valid_patches * pct_masks_to_decode) without a host to device copy.
+        H, W = self.patch_embed.grid_size
+        n_mask_patches = (
+            self.patch_mask.view(-1, H * W).sum(dim=1).double()
+            * self.pct_masks_to_decode
+        ).long()
+        return torch.arange(
+            num_patches, device=self.patch_mask.device
+        ) < n_mask_patches.unsqueeze(1)
+
+    def masked_token_ids(self, ids_restore, len_keep):
+        """Get the indices of tokens removed by random_masking which lie inside the image mask.
+
+        ids_restore: [N, L] as returned from random_masking.
+        len_keep: number of tokens kept for the encoder, see get_len_keep.
+
+        Returns:
+            ids_masked: [N, M] indices of removed tokens. M is the same for every sample since padded
+                patches are always sorted to the end of the shuffle. For per-sample masks M is the most removed
+                tokens of any sample, samples with fewer are filled up with their padded patches which carry no
+                weight in the loss. With static shapes and an image mask every token is returned in shuffled order.
+        """
+        N, L = ids_restore.shape
+        ids_shuffle = torch.empty_like(ids_restore).scatter_(
+            1,
+            ids_restore,
+            torch.arange(L, device=ids_restore.device).expand(N, L),
+        )
+        T = self.patch_embed.t_grid_size
+        if self.static_shapes and self.img_mask is not None:
+            # The number of removed tokens depends on the mask, so keep every token and let forward_loss select
+            # the removed ones with the mask.
+            return ids_shuffle
+        if self.per_sample_mask:
+            num_masked = max(
+                T * n_valid - keep
+                for n_valid, keep in zip(self.n_valid_patches, len_keep)
+            )
+            index = torch.tensor(len_keep, device=ids_restore.device).unsqueeze(
+                1
+            ) + torch.arange(num_masked, device=ids_restore.device)
+            return torch.gather(ids_shuffle, dim=1, index=index)
+
+        if self.img_mask is not None:
+            len_valid = T * self.n_valid_patches
+        else:
+            len_valid = L
+        return ids_shuffle[:, len_keep:len_valid]
 
-    def forward_decoder(self, x, ids_restore, use_contrastive_loss=False):
+    def forward_decoder(
+        self,
+        x,
+        ids_restore,
+        use_contrastive_loss=False,
+        included_patches=None,
+        keep_mask=None,
+    ):
         N = x.shape[0]
         T = self.patch_embed.t_grid_size
         H, W = self.patch_embed.grid_size
@@ -576,6 +1049,10 @@ class MaskedAutoencoderViT(nn.Module):
         x = self.decoder_embed(x)
         C = x.shape[-1]
 
+        # tokens padding samples with fewer kept tokens were removed, so they are replaced with mask tokens
+        if keep_mask is not None:
+            x = torch.where(keep_mask.unsqueeze(-1), x, self.mask_token.to(x.dtype))
+
         # append mask tokens to sequence
         mask_tokens = self.mask_token.repeat(N, T * H * W + 0 - x.shape[1], 1)
         x_ = torch.cat([x[:, :, :], mask_tokens], dim=1)  # no cls token
@@ -590,7 +1067,7 @@ class MaskedAutoencoderViT(nn.Module):
             decoder_cls_tokens = decoder_cls_token.expand(x.shape[0], -1, -1)
             x = torch.cat((decoder_cls_tokens, x), dim=1)
 
-        if self.sep_pos_embed:
+        if self.sep_pos_embed and not self.use_rope:
             decoder_pos_embed = self.decoder_pos_embed_spatial.repeat(
                 1, self.input_size[0], 1
             ) + torch.repeat_interleave(
@@ -608,15 +1085,19 @@ class MaskedAutoencoderViT(nn.Module):
                     ],
                     1,
                 )
-        else:
+        elif not self.use_rope:
             decoder_pos_embed = self.decoder_pos_embed[:, :, :]
 
-        # add pos embed
-        x = x + decoder_pos_embed
+        # add pos embed, with rotary position embeddings the positions of the decoded tokens are tracked instead
+        if self.use_rope:
+            positions = torch.arange(T * H * W, device=x.device).view(1, T, H * W)
+        else:
+            x = x + decoder_pos_embed
 
         attn = self.decoder_blocks[0].attn
 
         # drop patches outside image mask (and then only keep a subset a la VideoMAE2)
+        attn_mask = None
         if self.img_mask is not None:
             if self.cls_embed:
                 decoder_cls_tokens, x = x[:, :1, :], x[:, 1:, :]
@@ -624,20 +1105,59 @@ class MaskedAutoencoderViT(nn.Module):
             # x = x[:, :, self.patch_mask_indices]
 
             # drop patches randomly to preserve memory (VideoMAE2 approach)
-            included_patches = self.patch_mask_indices
-            num_to_select = int(self.pct_masks_to_decode * len(included_patches))
-            selected_idx = torch.randperm(len(included_patches))[:num_to_select]
-            included_patches = included_patches[selected_idx]
-            x = x[:, :, included_patches]
+            if included_patches is None:
+                included_patches = self.select_decoder_patches()
+            n_decode = included_patches.shape[-1]
+            # the same patches are decoded in every frame unless they were selected per frame
+            patch_index = included_patches.view(
+                -1, T if included_patches.ndim == 3 else 1, n_decode
+            )
+            x = torch.gather(
+                x,
+                dim=2,
+                index=patch_index.unsqueeze(-1).expand(N, T, n_decode, C),
+            )
 
-            x = x.view([N, T * self.n_mask_patches, C])
+            x = x.view([N, T * n_decode, C])
             if self.cls_embed:
                 x = torch.cat((decoder_cls_tokens, x), dim=1)
+            if self.use_rope:
+                positions = torch.gather(
+                    positions.expand(N, T, H * W),
+                    dim=2,
+                    index=patch_index.expand(N, T, n_decode),
+                )
 
-        # apply Transformer blocks
-        for blk in self.decoder_blocks:
-            x = blk(x)
-        x = self.decoder_norm(x)
+            patch_valid = self.get_decoder_patch_mask(n_decode)
+            if patch_valid is not None:
+                attn_mask = patch_valid.unsqueeze(1).expand(N, T, n_decode)
+                attn_mask = attn_mask.reshape(N, T * n_decode)
+                if self.cls_embed:
+                    attn_mask = torch.cat((attn_mask[:, :1] | True, attn_mask), dim=1)
+
+        rope = None
+        if self.use_rope:
+            rope = self.get_rope(
+                self.decoder_rope, positions.reshape(positions.shape[0], -1)
+            )
+
+        if attn_mask is not None and self.pack_tokens and not self.static_shapes:
+            n_mask_patches = torch.tensor(self.n_mask_patches).view(N, 1, 1)
+            token_mask = (torch.arange(n_decode) < n_mask_patches).expand(
+                N, T, n_decode
+            )
+            x = self.forward_packed(
+                x,
+                token_mask.reshape(N, T * n_decode),
+                self.decoder_blocks,
+                self.decoder_norm,
+                rope=rope,
+            )
+        else:
+            # apply Transformer blocks
+            for blk in self.decoder_blocks:
+                x = blk(x, attn_mask=attn_mask, rope=rope)
+            x = self.decoder_norm(x)
 
         # predictor projection
         x = self.decoder_pred(x)
@@ -649,55 +1169,144 @@ class MaskedAutoencoderViT(nn.Module):
         # fill outside mask with zeros
         if self.img_mask is not None:
             C = x.shape[-1]
-            x = x.view([N, T, self.n_mask_patches, C])
+            x = x.view([N, T, n_decode, C])
+            if patch_valid is not None:
+                # patches padding a sample point at its padded electrodes, they must not overwrite anything
+                x = x * patch_valid[:, None, :, None].to(x.dtype)
             x_ = torch.zeros([N, T, H * W, C], dtype=x.dtype, device=x.device)
             x = x_.scatter(
                 2,
-                included_patches.view(1, 1, -1, 1).expand(N, T, self.n_mask_patches, C),
+                patch_index.unsqueeze(-1).expand(N, T, n_decode, C),
                 x,
             )
             x = x.view([N, T * H * W, C])
 
         return x
 
-    def forward_loss(self, imgs, pred, mask, alpha):
+    def forward_loss(
+        self,
+        imgs,
+        pred,
+        ids_masked,
+        alpha,
+        decoded_patches=None,
+        mask=None,
+        metrics=None,
+    ):
         """
         imgs: [N, C, T, H, W]
         pred: [N, t*h*w, u*p*p*C]
-        mask: [N, t*h*w], 0 is keep, 1 is remove,
+        ids_masked: [N, M], indices of the removed tokens to compute loss over, see masked_token_ids.
         alpha: Loss weighting between correlation and MSE given by alpha * -correlation + (1 - alpha) * mse
+        decoded_patches: indices into the H * W patch grid which were passed through the decoder, as returned from
+            select_decoder_patches. Removed tokens outside of these are excluded from the loss. If None all patches
+            are assumed decoded.
+        mask: optional [N, L] mask from random_masking, 0 is keep, 1 is remove. If set tokens in ids_masked which
+            were kept are excluded from the loss, used when ids_masked holds every token for static shapes.
+        metrics: optional metrics.ReconstructionMetrics to add the reconstruction of the removed tokens to.
+
+        The loss is always computed in fp32, also when the model runs under autocast.
         """
-        _imgs = torch.index_select(
-            imgs,
-            2,
-            torch.linspace(
-                0,
-                imgs.shape[2] - 1,
-                self.pred_t_dim,
+        with torch.autocast(device_type=pred.device.type, enabled=False):
+            return self._forward_loss(
+                imgs.float(),
+                pred.float(),
+                ids_masked,
+                alpha,
+                decoded_patches=decoded_patches,
+                mask=mask,
+                metrics=metrics,
             )
-            .long()
-            .to(imgs.device),
-        )
-        target = self.patchify(_imgs)
-
-        # Calculate correlation of masked patches
-        B, L, C = target.shape
-        expanded_mask = mask.repeat_interleave(C, axis=1).view(B, L, C).bool()
-        masked_imgs = target.masked_fill(expanded_mask, torch.nan)
-        masked_pred = pred.masked_fill(expanded_mask, torch.nan)
-        correlation = pearson_correlation(
-            masked_imgs[~masked_imgs.isnan()], masked_pred[~masked_pred.isnan()]
-        )
 
-        # Calculate mse
-        mse = (pred - target) ** 2
+    def _forward_loss(
+        self,
+        imgs,
+        pred,
+        ids_masked,
+        alpha,
+        decoded_patches=None,
+        mask=None,
+        metrics=None,
+    ):
+        if self.pred_t_dim != imgs.shape[2]:
+            imgs = torch.index_select(
+                imgs,
+                2,
+                torch.linspace(
+                    0,
+                    imgs.shape[2] - 1,
+                    self.pred_t_dim,
+                )
+                .long()
+                .to(imgs.device),
+            )
+        target = self.patchify(imgs)
+
+        # Only gather the removed tokens once so that the rest of the loss works on a compact tensor.
+        D = target.shape[-1]
+        gather_idx = ids_masked.unsqueeze(-1).expand(-1, -1, D)
+        # With several masks per sample the target is gathered for all of a sample's masks at once.
+        target = torch.gather(
+            target,
+            dim=1,
+            index=ids_masked.reshape(target.shape[0], -1, 1).expand(-1, -1, D),
+        ).view_as(gather_idx)
+        pred = torch.gather(pred, dim=1, index=gather_idx)
+
+        weights = None
         if self.img_mask is not None:
             # exclude missing pixels from loss
-            mask = mask.unsqueeze(-1) * self.img_mask_patches
-        else:
-            mse = mse.mean(dim=-1)  # [N, L], mean loss per patch
+            N = ids_masked.shape[0]
+            weights = torch.gather(
+                self.img_mask_patches.expand(N, -1, -1), dim=1, index=gather_idx
+            )
+            if decoded_patches is not None:
+                H, W = self.patch_embed.grid_size
+                n_decode = decoded_patches.shape[-1]
+                # [N, T, n_decode] for patches selected per frame, else [N, 1, n_decode]
+                decoded_patches = decoded_patches.view(
+                    decoded_patches.shape[0], -1, n_decode
+                )
+                patch_valid = self.get_decoder_patch_mask(n_decode)
+                if patch_valid is None:
+                    patch_valid = torch.ones_like(decoded_patches, dtype=torch.bool)
+                else:
+                    patch_valid = patch_valid.unsqueeze(1)
+                decoded = torch.zeros(
+                    [*decoded_patches.shape[:2], H * W],
+                    dtype=weights.dtype,
+                    device=weights.device,
+                ).scatter(
+                    2,
+                    decoded_patches,
+                    patch_valid.expand_as(decoded_patches).to(weights.dtype),
+                )
+                if decoded.shape[1] == 1:
+                    index = ids_masked % (H * W)
+                else:
+                    index = ids_masked
+                decoded = torch.gather(
+                    decoded.view(decoded.shape[0], -1).expand(N, -1), dim=1, index=index
+                )
+                weights = weights * decoded.unsqueeze(-1)
+            if mask is not None:
+                weights = weights * torch.gather(
+                    mask, dim=1, index=ids_masked
+                ).unsqueeze(-1)
 
-        mse = (mse * mask).sum() / mask.sum()  # mean loss on removed patches
+        if metrics is not None:
+            metrics.update(target, pred, ids_masked, weights)
+
+        # Calculate mse and correlation on masked patches
+        mse = (pred - target) ** 2
+        if weights is None:
+            mse = mse.mean()
+            correlation = pearson_correlation(target.flatten(), pred.flatten())
+        else:
+            mse = (mse * weights).sum() / weights.sum()
+            correlation = pearson_correlation(
+                target.flatten(), pred.flatten(), weights.flatten()
+            )
 
         # Loss is weighted sum of mse and correlation
         loss = alpha * (-correlation) + (1 - alpha) * mse
@@ -721,6 +1330,216 @@ class MaskedAutoencoderViT(nn.Module):
     def forward_input_norm(self, x):
         return self.masked_input_norm(x, self.img_mask)
 
+    def forward_features(self, x, global_pool=True, cls_forward=False, per_frame=False):
+        """Encode every patch of an input, without masking tokens out.
+
+        x: [N, T, L, C] patch embeddings, see patch_embed. T may differ from the number of temporal patches the
+            model was configured for.
+        global_pool: If True return the average of the encoded tokens [N, C].
+        cls_forward: If True and not pooling return the encoded cls token [N, 1, C].
+        per_frame: If True return the average of the encoded tokens of each temporal patch [N, T, C].
+
+        Returns:
+            Encoded tokens [N, num_tokens, C] unless pooled, tokens outside the image mask are removed (or padded for
+                static shapes and per-sample masks).
+        """
+        N, T, L, C = x.shape  # T: temporal; L: spatial
+
+        x = x.reshape([N, T * L, C])
+
+        # append cls token
+        if self.cls_embed:
+            cls_token = self.cls_token
+            cls_tokens = cls_token.expand(x.shape[0], -1, -1)
+            x = torch.cat((cls_tokens, x), dim=1)
+
+        # add pos embed, with rotary position embeddings the positions of the kept tokens are tracked instead
+        if self.use_rope:
+            positions = torch.arange(T * L, device=x.device).view(1, T, L)
+        else:
+            x = x + self.get_pos_embed(t_grid_size=T)
+
+        # drop patches outside image mask
+        attn_mask = None
+        if self.img_mask is not None:
+            if self.cls_embed:
+                cls_tokens, x = x[:, :1, :], x[:, 1:, :]
+            x = x.view([N, T, L, C])
+            if self.static_shapes:
+                # keep every patch and exclude padding from attention so shapes don't depend on the mask
+                n_valid = L
+                attn_mask = self.patch_mask.view(-1, 1, L).bool()
+                attn_mask = attn_mask.expand(N, T, L).reshape(N, T * L)
+            elif self.per_sample_mask:
+                # move valid patches to the front of each sample and pad up to the most valid patches
+                n_valid = max(self.n_valid_patches)
+                ids_valid = torch.argsort(1.0 - self.patch_mask, dim=1, stable=True)[
+                    :, :n_valid
+                ]
+                x = torch.gather(
+                    x,
+                    dim=2,
+                    index=ids_valid[:, None, :, None].expand(N, T, n_valid, C),
+                )
+                if self.use_rope:
+                    positions = torch.gather(
+                        positions.expand(N, T, L),
+                        dim=2,
+                        index=ids_valid.unsqueeze(1).expand(N, T, n_valid),
+                    )
+                attn_mask = torch.gather(self.patch_mask, 1, ids_valid).bool()
+                attn_mask = attn_mask.unsqueeze(1).expand(N, T, n_valid)
+                attn_mask = attn_mask.reshape(N, T * n_valid)
+            else:
+                n_valid = self.n_valid_patches
+                x = x[:, :, self.patch_mask_indices]
+                if self.use_rope:
+                    positions = positions[:, :, self.patch_mask_indices]
+            x = x.reshape([N, T * n_valid, C])
+            if self.cls_embed:
+                x = torch.cat((cls_tokens, x), dim=1)
+                if attn_mask is not None:
+                    attn_mask = torch.cat((attn_mask[:, :1] | True, attn_mask), dim=1)
+
+        rope = None
+        if self.use_rope:
+            # positions are shared across the batch unless samples have different masks
+            rope = self.get_rope(
+                self.rope,
+                positions.reshape(-1, x.shape[1] - self.cls_embed),
+                t_grid_size=T,
+            )
+
+        # apply Transformer blocks
+        for blk in self.blocks:
+            x = blk(x, attn_mask=attn_mask, rope=rope)
+
+        if global_pool or per_frame:
+            if self.cls_embed:
+                # remove cls token
+                x = x[:, 1:, :]
+                if attn_mask is not None:
+                    attn_mask = attn_mask[:, 1:]
+            # average over every token, or the tokens of each temporal patch
+            pool_dim = 1
+            if per_frame:
+                x = x.view(N, T, -1, C)
+                if attn_mask is not None:
+                    attn_mask = attn_mask.view(N, T, -1)
+                pool_dim = 2
+            if attn_mask is None:
+                x = x.mean(dim=pool_dim)
+            else:
+                # padded tokens are excluded from the mean
+                weights = attn_mask.unsqueeze(-1).to(x.dtype)
+                x = (x * weights).sum(dim=pool_dim) / weights.sum(dim=pool_dim)
+        elif cls_forward:
+            x = x[:, :1, :]
+        return x
+
+    @torch.no_grad()
+    def embed_stream(
+        self,
+        chunks,
+        window_size=None,
+        hop_size=None,
+        batch_size=32,
+        per_frame=False,
+    ):
+        """Embed a long recording with a sliding window, consuming it chunk by chunk.
+
+        Each chunk is normalized and patch embedded once as it arrives, overlapping windows reuse those patch
+        embeddings and only run the transformer blocks. Only the patch embeddings still needed by upcoming windows
+        are kept, so the whole recording is never held in memory. The model is switched to eval mode while embedding, so
+        the input is normalized with the running statistics, and the image mask (if any) must be shared by the whole
+        recording.
+
+        chunks: iterable of consecutive [C, T, H, W] pieces of the recording (tensors or numpy arrays), the pieces
+            can have any number of frames. A single [C, T, H, W] tensor is also accepted.
+        window_size: number of frames per window, defaults to the number of frames the model was configured for.
+            Must be a multiple of the temporal patch size.
+        hop_size: number of frames between the starts of consecutive windows, defaults to window_size. Must be a
+            multiple of the temporal patch size.
+        batch_size: number of windows encoded per forward pass.
+        per_frame: If True yield one embedding per temporal patch of a window instead of one per window.
+
+        Yields:
+            (start, embedding) with start the first frame of the window in the recording and embedding of shape
+                [embed_dim], or [window_size // t_patch_size, embed_dim] if per_frame. Trailing frames which don't
+                fill a window are dropped.
+        """
+        assert (
+            not self.per_sample_mask
+        ), "Streaming requires a mask shared by every frame."
+        t_patch_size = self.patch_embed.t_patch_size
+        window_size = window_size or self.patch_embed.frames
+        hop_size = hop_size or window_size
+        assert (
+            window_size % t_patch_size == 0 and hop_size % t_patch_size == 0
+        ), f"window_size and hop_size must be multiples of t_patch_size ({t_patch_size})."
+        # windows and hops in temporal patches
+        window_patches = window_size // t_patch_size
+        hop_patches = hop_size // t_patch_size
+
+        if isinstance(chunks, torch.Tensor):
+            chunks = chunks.split(window_size, dim=1)
+        device = self.patch_embed.proj.weight.device
+
+        remainder = None  # frames which don't fill a temporal patch yet
+        patches = None  # [T, L, C] patch embeddings of the frames still needed
+        patches_start = 0  # temporal patch index of patches[0] in the recording
+        window_start = 0  # temporal patch index of the next window
+        windows, starts = [], []
+
+        def encode_windows():
+            features = self.forward_features(
+                torch.stack(windows), global_pool=not per_frame, per_frame=per_frame
+            )
+            for start, embedding in zip(starts, features):
+                yield start * t_patch_size, embedding
+            windows.clear()
+            starts.clear()
+
+        # Normalize with the running statistics and without dropout even if the model is training, the mode is
+        # restored once the recording is consumed or the generator is closed.
+        training = self.training
+        self.eval()
+        try:
+            for chunk in chunks:
+                chunk = torch.as_tensor(chunk, device=device)
+                if remainder is not None:
+                    chunk = torch.cat((remainder, chunk), dim=1)
+                n_frames = chunk.shape[1] // t_patch_size * t_patch_size
+                chunk, remainder = chunk[:, :n_frames], chunk[:, n_frames:]
+                if n_frames == 0:
+                    continue
+
+                new_patches = self.patch_embed(
+                    self.masked_input_norm(chunk.unsqueeze(0), self.img_mask)
+                )[0]
+                if patches is None:
+                    patches = new_patches
+                else:
+                    patches = torch.cat((patches, new_patches), dim=0)
+
+                while window_start + window_patches <= patches_start + len(patches):
+                    offset = window_start - patches_start
+                    windows.append(patches[offset : offset + window_patches])
+                    starts.append(window_start)
+                    window_start += hop_patches
+                    if len(windows) == batch_size:
+                        yield from encode_windows()
+
+                # drop patch embeddings before the next window
+                offset = min(window_start - patches_start, len(patches))
+                patches = patches[offset:]
+                patches_start += offset
+
+            if windows:
+                yield from encode_windows()
+        finally:
+            self.train(training)
+
     def forward(
         self,
         imgs,
@@ -730,74 +1549,53 @@ class MaskedAutoencoderViT(nn.Module):
         global_pool=True,
         cls_forward=False,
         alpha=0.5,
+        noise=None,
+        decoder_noise=None,
+        generator=None,
+        metrics=None,
     ):
         imgs = self.masked_input_norm(imgs, self.img_mask)
-        # TODO: Break this out and test.
         if forward_features:
-            # embed patches
-            x = self.patch_embed(imgs)
-            N, T, L, C = x.shape  # T: temporal; L: spatial
-
-            x = x.reshape([N, T * L, C])
-
-            # append cls token
-            if self.cls_embed:
-                cls_token = self.cls_token
-                cls_tokens = cls_token.expand(x.shape[0], -1, -1)
-                x = torch.cat((cls_tokens, x), dim=1)
-
-            if self.sep_pos_embed:
-                pos_embed = self.pos_embed_spatial.repeat(
-                    1, self.input_size[0], 1
-                ) + torch.repeat_interleave(
-                    self.pos_embed_temporal,
-                    self.input_size[1] * self.input_size[2],
-                    dim=1,
+            return self.forward_features(
+                self.patch_embed(imgs), global_pool=global_pool, cls_forward=cls_forward
+            )
+        else:
+            num_masks = 1 if use_contrastive_loss else self.num_masks
+            with self.repeat_masks(num_masks):
+                latent, mask, ids_restore = self.forward_encoder(
+                    imgs,
+                    mask_ratio,
+                    use_contrastive_loss=use_contrastive_loss,
+                    noise=noise,
+                    generator=generator,
+                    num_masks=num_masks,
                 )
-                if self.cls_embed:
-                    pos_embed = torch.cat(
-                        [
-                            self.pos_embed_class.expand(pos_embed.shape[0], -1, -1),
-                            pos_embed,
-                        ],
-                        1,
+                if not use_contrastive_loss:
+                    included_patches = self.select_decoder_patches(
+                        noise=decoder_noise, generator=generator
                     )
-            else:
-                pos_embed = self.pos_embed[:, :, :]
-            x = x + pos_embed
-
-            # drop patches outside image mask
-            if self.img_mask is not None:
-                if self.cls_embed:
-                    cls_tokens, x = x[:, :1, :], x[:, 1:, :]
-                x = x.view([N, T, L, C])
-                x = x[:, :, self.patch_mask_indices]
-                x = x.reshape([N, T * self.n_mask_patches, C])
-                if self.cls_embed:
-                    x = torch.cat((cls_tokens, x), dim=1)
-
-            # apply Transformer blocks
-            for blk in self.blocks:
-                x = blk(x)
-
-            if global_pool:
-                if self.cls_embed:
-                    # remove cls token
-                    x = x[:, 1:, :]
-                x = x.mean(dim=1)
-            elif cls_forward:
-                x = x[:, :1, :]
-            return x
-        else:
-            latent, mask, ids_restore = self.forward_encoder(
-                imgs, mask_ratio, use_contrastive_loss=use_contrastive_loss
-            )
-            if not use_contrastive_loss:
-                pred = self.forward_decoder(
-                    latent, ids_restore, use_contrastive_loss=use_contrastive_loss
-                )  # [N, L, p*p*C]
-                loss, mse, correlation = self.forward_loss(imgs, pred, mask, alpha)
-                return loss, mse, pred, mask, latent, correlation
+                    # latent doesn't include the cls token
+                    keep_mask = self.get_keep_mask(mask, latent.shape[1])
+                    pred = self.forward_decoder(
+                        latent,
+                        ids_restore,
+                        use_contrastive_loss=use_contrastive_loss,
+                        included_patches=included_patches,
+                        keep_mask=keep_mask,
+                    )  # [N * num_masks, L, p*p*C]
+                    ids_masked = self.masked_token_ids(
+                        ids_restore, self.get_len_keep(mask_ratio)
+                    )
+                    loss, mse, correlation = self.forward_loss(
+                        imgs,
+                        pred,
+                        ids_masked,
+                        alpha,
+                        decoded_patches=included_patches,
+                        mask=mask if self.static_shapes else None,
+                        metrics=metrics,
+                    )
+                    return loss, mse, pred, mask, latent, correlation
 
     def forward_head(self, x):
         # classifier
@@ -812,7 +1610,7 @@ class MaskedAutoencoderViT(nn.Module):
         N, L, C = x.shape
         T = self.patch_embed.t_grid_size
         H, W = self.patch_embed.grid_size
-        assert L == T * self.n_mask_patches
+        assert L == T * self.n_valid_patches
 
         x = x.view(N, T, -1, C)
         x_ = torch.zeros([N, T, H * W, C], dtype=x.dtype, device=x.device)
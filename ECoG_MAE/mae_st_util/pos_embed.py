@@ -51,3 +51,43 @@ def interpolate_pos_embed(model, checkpoint_model):
             pos_tokens = pos_tokens.permute(0, 2, 3, 1).flatten(1, 2)
             new_pos_embed = torch.cat((extra_tokens, pos_tokens), dim=1)
             checkpoint_model["pos_embed"] = new_pos_embed
+
+    # temporal position embeddings of a model with a different sample length
+    for key in ["pos_embed_temporal", "decoder_pos_embed_temporal"]:
+        if key in checkpoint_model and hasattr(model, key):
+            new_size = getattr(model, key).shape[-2]
+            if checkpoint_model[key].shape[-2] != new_size:
+                print(
+                    "Temporal position interpolate %s from %d to %d"
+                    % (key, checkpoint_model[key].shape[-2], new_size)
+                )
+                checkpoint_model[key] = interpolate_pos_embed_temporal(
+                    checkpoint_model[key], new_size
+                )
+
+
+def interpolate_pos_embed_temporal(pos_embed, new_t_size, num_spatial=1):
+    """Linearly interpolate position embeddings along time to a different number of temporal patches.
+
+    pos_embed: [1, T * num_spatial, C] position embeddings ordered by time first, without extra tokens.
+    new_t_size: number of temporal patches to interpolate to.
+    num_spatial: number of tokens per temporal patch, 1 for separate temporal position embeddings.
+
+    Returns:
+        [1, new_t_size * num_spatial, C] position embeddings.
+    """
+    embedding_size = pos_embed.shape[-1]
+    t_size = pos_embed.shape[-2] // num_spatial
+    if t_size == new_t_size:
+        return pos_embed
+    # [1, T, S, C] -> [1, S * C, T] to interpolate over time
+    pos_tokens = pos_embed.reshape(1, t_size, num_spatial * embedding_size)
+    pos_tokens = torch.nn.functional.interpolate(
+        pos_tokens.permute(0, 2, 1),
+        size=new_t_size,
+        mode="linear",
+        align_corners=False,
+    )
+    return pos_tokens.permute(0, 2, 1).reshape(
+        1, new_t_size * num_spatial, embedding_size
+    )
@@ -6,6 +6,8 @@ import torch.nn as nn
 from timm.layers import to_2tuple
 from timm.models.vision_transformer import DropPath, Mlp
 
+from rope import apply_rotary_embedding
+
 
 class PatchEmbed(nn.Module):
     """Image to Patch Embedding"""
@@ -61,12 +63,103 @@ class PatchEmbed(nn.Module):
         assert (
             H == self.img_size[0] and W == self.img_size[1]
         ), f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
-        assert T == self.frames
+        # Other numbers of frames than the model was configured for give more or less temporal patches, see
+        # MaskedAutoencoderViT.get_pos_embed.
+        assert (
+            T % self.t_patch_size == 0
+        ), f"Number of frames ({T}) must be a multiple of t_patch_size ({self.t_patch_size})."
         x = self.proj(x).flatten(3)
         x = torch.einsum("ncts->ntsc", x)  # [N, T, H*W, C]
         return x
 
 
+class PackedSequences:
+    """
+    Tokens of samples with different lengths packed along a single sequence, cu_seqlens style.
+
+    Linear layers, norms and MLPs run on the packed tokens so their cost scales with the number of real tokens.
+    Attention runs on the packed tokens as well, as a nested (jagged) tensor split at cu_seqlens, so every sample
+    only attends to its own tokens and the cost scales with the squared length of each sample rather than of the
+    longest one. On the gpu this dispatches to variable length flash or memory efficient attention kernels, on
+    other devices each sample's tokens attend in turn.
+    """
+
+    def __init__(self, token_mask, device):
+        """
+        token_mask: bool tensor of shape [B, N] with the real tokens of each sample in a padded batch. Pass a cpu
+            tensor so that packing doesn't need to sync with the device.
+        device: device the tokens live on.
+        """
+        token_mask = token_mask.cpu()
+        self.batch_size, self.max_seqlen = token_mask.shape
+        seqlens = token_mask.sum(dim=1)
+        self.cu_seqlens = torch.nn.functional.pad(seqlens.cumsum(dim=0), (1, 0)).to(
+            device
+        )
+        self.seqlens = seqlens.tolist()
+        self.total_seqlen = int(seqlens.sum())
+        # Passed to the nested tensors so attention doesn't compute them on the device.
+        self.min_seqlen = int(seqlens.min())
+        self.max_packed_seqlen = int(seqlens.max())
+        self.index = token_mask.flatten().nonzero().squeeze(1).to(device)
+
+    def pack(self, x):
+        """[B, N, C] padded tokens -> [1, total_seqlen, C] packed tokens."""
+        C = x.shape[-1]
+        return x.reshape(-1, C).index_select(0, self.index).unsqueeze(0)
+
+    def unpack(self, x):
+        """[1, total_seqlen, C] packed tokens -> [B, N, C] padded tokens, padding is filled with zeros."""
+        C = x.shape[-1]
+        x_ = x.new_zeros([self.batch_size * self.max_seqlen, C])
+        x_ = x_.index_copy(0, self.index, x.reshape(-1, C))
+        return x_.view(self.batch_size, self.max_seqlen, C)
+
+    def pack_rope(self, rope):
+        """(cos, sin) of shape [B or 1, 1, N, d] for the padded tokens -> [total_seqlen, 1, d] for the packed ones."""
+        return tuple(
+            self.pack(t.expand(self.batch_size, -1, -1, -1).squeeze(1)).transpose(0, 1)
+            for t in rope
+        )
+
+    def attention(self, q, k, v, scale):
+        """Scaled dot product attention within each sample.
+
+        q, k, v: [total_seqlen, num_heads, head_dim] packed queries, keys and values.
+
+        Returns:
+            [total_seqlen, num_heads, head_dim]
+        """
+        if q.device.type != "cuda":
+            # Nested tensors fall back to slower strided kernels off the gpu, attend per sample instead.
+            return torch.cat(
+                [
+                    torch.nn.functional.scaled_dot_product_attention(
+                        *(t.transpose(0, 1) for t in qkv), scale=scale
+                    ).transpose(0, 1)
+                    for qkv in zip(
+                        q.split(self.seqlens),
+                        k.split(self.seqlens),
+                        v.split(self.seqlens),
+                    )
+                ]
+            )
+
+        def nested(x):
+            # [B, num_heads, j, head_dim] with the ragged sequence dimension j.
+            return torch.nested.nested_tensor_from_jagged(
+                x,
+                self.cu_seqlens,
+                min_seqlen=self.min_seqlen,
+                max_seqlen=self.max_packed_seqlen,
+            ).transpose(1, 2)
+
+        x = torch.nn.functional.scaled_dot_product_attention(
+            nested(q), nested(k), nested(v), scale=scale
+        )
+        return x.transpose(1, 2).values()
+
+
 class Attention(nn.Module):
     def __init__(
         self,
@@ -93,32 +186,48 @@ class Attention(nn.Module):
         self.input_size = input_size
         assert input_size[1] == input_size[2]
 
-    def forward(self, x):
-        B, N, C = x.shape
-        q = (
-            self.q(x)
-            .reshape(B, N, self.num_heads, C // self.num_heads)
-            .permute(0, 2, 1, 3)
-        )
-        k = (
-            self.k(x)
-            .reshape(B, N, self.num_heads, C // self.num_heads)
-            .permute(0, 2, 1, 3)
-        )
-        v = (
-            self.v(x)
-            .reshape(B, N, self.num_heads, C // self.num_heads)
-            .permute(0, 2, 1, 3)
-        )
+    def forward(self, x, attn_mask=None, packed=None, rope=None):
+        """
+        x: [B, N, C]
+        attn_mask: optional bool tensor of shape [B, N], tokens which are False are not attended to. Used to pad
+            variable length sequences in a batch.
+        packed: optional PackedSequences if x holds the packed tokens of several samples, x is then
+            [1, total_seqlen, C] and attn_mask is ignored.
+        rope: optional (cos, sin) tensors of shape [B, 1, N, C // num_heads] from RotaryPositionalEmbeddings4D to
+            rotate queries and keys by, [total_seqlen, 1, C // num_heads] from PackedSequences.pack_rope if packed
+            is set.
+        """
+        q, k, v = self.q(x), self.k(x), self.v(x)
+        if packed is not None:
+            C = q.shape[-1]
+            q, k, v = (
+                t.view(-1, self.num_heads, C // self.num_heads) for t in (q, k, v)
+            )
+            if rope is not None:
+                q = apply_rotary_embedding(q, *rope)
+                k = apply_rotary_embedding(k, *rope)
+            x = packed.attention(q, k, v, self.scale).reshape(1, -1, C)
+            x = self.proj(x)
+            return self.proj_drop(x)
+
+        B, N, C = q.shape
+        q = q.reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
+        k = k.reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
+        v = v.reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
+        if rope is not None:
+            q = apply_rotary_embedding(q, *rope)
+            k = apply_rotary_embedding(k, *rope)
 
         attn = (q @ k.transpose(-2, -1)) * self.scale
+        if attn_mask is not None:
+            attn = attn.masked_fill(~attn_mask[:, None, None, :], float("-inf"))
 
         attn = attn.softmax(dim=-1)
 
         x = (attn @ v).transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
-        x = x.view(B, -1, C)
+        x = x.view(x.shape[0], -1, C)
         return x
 
 
@@ -162,8 +271,10 @@ class Block(nn.Module):
             drop=drop,
         )
 
-    def forward(self, x):
-        x = x + self.drop_path(self.attn(self.norm1(x)))
+    def forward(self, x, attn_mask=None, packed=None, rope=None):
+        x = x + self.drop_path(
+            self.attn(self.norm1(x), attn_mask=attn_mask, packed=packed, rope=rope)
+        )
         x = x + self.drop_path(self.mlp(self.norm2(x)))
         return x
 
@@ -188,31 +299,62 @@ class MaskedBatchNorm(nn.Module):
 
         x: batch tensor of shape [batch, channels, frames, height, width].
         mask: tensor of shape [height, width] denoting which electrodes are masked. Those with False will be removed.
+            Can also be of shape [batch, height, width] to use a different mask for each sample.
         """
-        # Code adapted from: https://discuss.pytorch.org/t/batchnorm-for-different-sized-samples-in-batch/44251/8
+        # Always normalize in fp32, scaling by scale_factor overflows fp16.
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return self._forward(x.float(), mask)
+
+    def _forward(self, x, mask):
         B, C, T, H, W = x.shape
-        x = x.reshape(B, C, T * H * W)
-        x = x * self.scale_factor
 
         if mask is None:
+            x = x.reshape(B, C, T * H * W) * self.scale_factor
             return self.bn(x).view(B, C, T, H, W)
 
-        # We don't want to include padded values in the normalization process so we take advantage of the fact
-        # that batch norm does not differentiate between batch and time axis. If we just used the mask on the time
-        # axis than we would have a jagged tensor but here we can flatten it out and remove all masked values.
-        # Swap time and channel axes to set the batch and time axis next to each other.
-        flattened_x = x.permute(0, 2, 1).reshape(B * T * H * W, C, 1)
-        # Make mask align with flattened out x array.
-        expanded_mask = mask.unsqueeze(0).repeat((B * T, 1, 1)).view(B, 1, T * H * W)
-        flattened_mask = expanded_mask.reshape(-1, 1, 1) > 0
-        # Apply mask.
-        masked_values = torch.masked_select(flattened_x, flattened_mask).reshape(
-            -1, C, 1
+        # We don't want to include padded values in the normalization process. The statistics are computed from
+        # per-electrode sums over frames weighted by the [height, width] mask, so the mask is never broadcast over
+        # frames and no copies of the input are made. Scaling by scale_factor is folded into the statistics.
+        if mask.ndim == 2:
+            mask = mask.unsqueeze(0).expand(B, H, W)
+        mask = mask.reshape(B, 1, H * W).bool()
+        x = x.reshape(B, C, T, H * W)
+
+        bn = self.bn
+        if self.training or bn.running_mean is None:
+            weights = mask.to(torch.float64)
+            count = weights.sum() * T
+            # Two passes, the variance of the centered values doesn't cancel like E[x^2] - E[x]^2 does when the
+            # mean is large next to the standard deviation.
+            mean = (x.sum(dim=2).double() * weights).sum(dim=(0, 2)) / count
+            centered = x - mean.float()[None, :, None, None]
+            var = (
+                torch.linalg.vector_norm(centered, dim=2).double().square() * weights
+            ).sum(dim=(0, 2)) / count
+            mean = (mean * self.scale_factor).float()
+            var = (var * self.scale_factor**2).float()
+            if self.training and bn.running_mean is not None:
+                # Same running statistics as nn.BatchNorm1d over the masked values.
+                with torch.no_grad():
+                    bn.num_batches_tracked.add_(1)
+                    if bn.momentum is None:
+                        momentum = 1.0 / bn.num_batches_tracked
+                    else:
+                        momentum = bn.momentum
+                    bn.running_mean.lerp_(mean.to(bn.running_mean.dtype), momentum)
+                    bn.running_var.lerp_(
+                        (var * count / (count - 1)).to(bn.running_var.dtype), momentum
+                    )
+        else:
+            mean, var = bn.running_mean.float(), bn.running_var.float()
+
+        # Normalize as x * scale + shift with per-electrode coefficients, padded values are passed through
+        # scaled but unnormalized.
+        inv_std = torch.rsqrt(var + bn.eps)
+        scale = torch.where(
+            mask, (self.scale_factor * inv_std)[None, :, None], self.scale_factor
         )
-        normed = self.bn(masked_values)
-        # Scatter in normalized values and fix shape back to original batch.
-        scattered = flattened_x.masked_scatter(flattened_mask, normed)
-        backshaped = (
-            scattered.reshape(B, T * H * W, C).permute(0, 2, 1).view(B, C, T, H, W)
+        shift = torch.where(mask, (-mean * inv_std)[None, :, None], 0.0)
+        return torch.addcmul(shift.unsqueeze(2), x, scale.unsqueeze(2)).view(
+            B, C, T, H, W
         )
-        return backshaped
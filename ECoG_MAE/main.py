@@ -14,7 +14,10 @@ def main(args):
 
     experiment_config = create_video_mae_experiment_config(args)
 
-    accelerator, device, data_type, local_rank = system_setup()
+    accelerator, device, data_type, local_rank = system_setup(
+        experiment_config.trainer_config.precision,
+        experiment_config.trainer_config.gradient_accumulation_steps,
+    )
     train_dl, test_dl, num_train_samples = dl_setup(experiment_config)
     model, optimizer, lr_scheduler, _ = model_setup(
         experiment_config, device, num_train_samples
@@ -1,63 +1,222 @@
+from collections import OrderedDict
+
 import torch
 from einops import rearrange
 
 
-def get_padding_mask(signal, device):
+def get_padding_mask(signal, device, per_sample=False):
     """
     Zero padding for channels that were rejected during preprocessing for bad signal quality
 
     Args:
         signal: torch tensor of shape batch size * number of bands * timepoints * h * w
-        model: model object
         device: GPU device
+        per_sample: if True return a mask for each sample instead of one mask shared across the batch, so that
+            electrodes rejected for one sample are not dropped for every other sample in the batch
 
     Returns:
-        padding_mask: boolean tensor of same shape as image indicating which parts of the signal are padded
+        padding_mask: boolean tensor of shape [h, w] (or [batch size, h, w] if per_sample) indicating which
+            electrodes hold signal
 
     """
+    if per_sample:
+        return (~torch.isnan(signal)).all((1, 2)).to(device)
     return (~torch.isnan(signal)).all((0, 1, 2)).to(device)
 
 
-def get_tube_mask(tube_mask_ratio, height, width, padding_mask, device):
+def padding_mask_key(padding_mask):
+    """
+    Pack a padding mask into a hashable key with one bit per electrode, i.e. a single 64 bit integer for an 8x8 grid.
+
+    Args:
+        padding_mask: boolean tensor of shape [H, W] or per-sample masks of shape [B, H, W]
+
+    Returns:
+        key: tuple of python ints for a [H, W] mask, or a list of such tuples (one per sample) for a [B, H, W] mask
+    """
+    per_sample = padding_mask.ndim == 3
+    flat = padding_mask.reshape(-1, padding_mask.shape[-2] * padding_mask.shape[-1])
+    flat = flat.to("cpu", torch.int64)
+
+    # Split into 64 bit words so grids with more than 64 electrodes are also supported.
+    num_bits = flat.shape[1]
+    num_words = (num_bits + 63) // 64
+    flat = torch.nn.functional.pad(flat, (0, num_words * 64 - num_bits))
+    words = (flat.view(-1, num_words, 64) << torch.arange(64)).sum(dim=-1)
+
+    keys = [tuple(sample_words) for sample_words in words.tolist()]
+    return keys if per_sample else keys[0]
+
+
+class PatchMaskCache:
+    """
+    Small LRU cache of patch masks derived from padding masks, keyed by padding_mask_key.
+
+    Consecutive batches from the same recording share an electrode layout, so looking up the derived masks avoids
+    recomputing them for every batch.
+    """
+
+    def __init__(self, max_size=8):
+        self.max_size = max_size
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def get(self, key, build_fn):
+        """
+        Get the cached value for key, calling build_fn() to create it on a cache miss.
+
+        Args:
+            key: hashable key, see padding_mask_key
+            build_fn: function with no arguments building the value to cache
+
+        Returns:
+            cached value for key
+        """
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        value = build_fn()
+        self._cache[key] = value
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._cache.clear()
+
+
+def _removed_positions(kept, valid, num_kept):
+    """Positions of removed tokens in the shuffled sequence, ones inside valid first, each in index order."""
+    removed_valid = ~kept & valid
+    removed_invalid = ~kept & ~valid
+    return torch.where(
+        removed_valid,
+        num_kept + removed_valid.cumsum(dim=1) - 1,
+        num_kept
+        + removed_valid.sum(dim=1, keepdim=True)
+        + removed_invalid.cumsum(dim=1)
+        - 1,
+    )
+
+
+def sample_keep_ids(noise, len_keep, valid=None):
+    """
+    Select the tokens kept for the encoder from noise, the len_keep tokens with the smallest noise are kept.
+
+    Only the kept tokens are ordered by noise with topk, the removed ones follow in index order, tokens inside valid
+    before the ones outside of it. Everything runs on the device of noise, so masks are reproducible from the noise
+    and the generator it was drawn with.
+
+    Args:
+        noise: tensor of shape [N, L] in [0, 1)
+        len_keep: number of tokens to keep
+        valid: optional boolean tensor broadcastable to [N, L] of tokens which hold signal, tokens outside of it are
+            only kept if there are less than len_keep valid tokens
+
+    Returns:
+        ids_keep: long tensor of shape [N, len_keep] of the kept tokens in ascending order of noise
+        ids_restore: long tensor of shape [N, L] with the position of each token in the shuffled sequence, the
+            first len_keep positions are the kept tokens
+    """
+    N, L = noise.shape
+    if valid is None:
+        valid = torch.ones_like(noise, dtype=torch.bool)
+    else:
+        valid = valid.expand(N, L)
+        # shift tokens without signal to not be selected
+        noise = noise + (~valid).to(noise.dtype)
+
+    ids_keep = torch.topk(noise, len_keep, dim=1, largest=False).indices
+    kept = torch.zeros_like(valid).scatter_(1, ids_keep, True)
+
+    ids_restore = _removed_positions(kept, valid, len_keep)
+    ids_restore.scatter_(
+        1, ids_keep, torch.arange(len_keep, device=noise.device).expand(N, len_keep)
+    )
+    return ids_keep, ids_restore
+
+
+def keep_mask_ids(keep_mask, len_keep, valid=None):
+    """
+    Get the indices of the tokens kept by a boolean mask, e.g. from get_tube_mask.
+
+    Kept tokens come first in index order, so a mask keeping the same number of tokens in every frame gives frame
+    after frame of equally many tokens. Removed tokens follow as for sample_keep_ids.
+
+    Args:
+        keep_mask: boolean tensor of shape [N, L], True for tokens fed into the encoder
+        len_keep: number of tokens to return for every sample, samples keeping fewer tokens are filled up with the
+            first removed ones
+        valid: optional boolean tensor broadcastable to [N, L] of tokens which hold signal
+
+    Returns:
+        ids_keep: long tensor of shape [N, len_keep] of the kept tokens
+        ids_restore: long tensor of shape [N, L] with the position of each token in the shuffled sequence
+    """
+    N, L = keep_mask.shape
+    if valid is None:
+        valid = torch.ones_like(keep_mask)
+    else:
+        valid = valid.expand(N, L)
+
+    ids_restore = torch.where(
+        keep_mask,
+        keep_mask.cumsum(dim=1) - 1,
+        _removed_positions(keep_mask, valid, keep_mask.sum(dim=1, keepdim=True)),
+    )
+    ids_shuffle = torch.empty_like(ids_restore).scatter_(
+        1, ids_restore, torch.arange(L, device=keep_mask.device).expand(N, L)
+    )
+    return ids_shuffle[:, :len_keep], ids_restore
+
+
+def get_tube_mask(
+    tube_mask_ratio, num_frames, patch_mask, device, generator=None, noise=None
+):
     """
     Masking out a certain percentage of the original signal, the unmasked parts are fed into the encoder.
     When constructing the mask we are taking into account channels that are padded, such that only channels
     with actual data are not masked out. Channels that were rejected are automatically masked out.
 
+    The same patches are kept in every frame, so every sample keeps a fixed number of tokens per frame.
+
     Args:
         tube_mask_ratio: Proportion of tubes to mask out.
-        height: height of electrode grid
-        width: width of electrode grid
-        padding_mask: boolean tensor indicating which channels contain data
+        num_frames: number of temporal patches
+        patch_mask: boolean tensor of shape [P] (or [B, P] per sample) indicating which spatial patches contain data
         device: GPU device
+        generator: optional torch.Generator on device to draw the noise from
+        noise: optional tensor of shape [B, P] in [0, 1), the patches with the smallest noise are kept
 
     Returns:
-        tube_mask: boolean tensor of shape as patchified signal indicating which parts are fed into the encoder
-        (True) and which not (False)
+        tube_mask: boolean tensor of shape [B, num_frames * P] indicating which parts of the patchified signal are
+            fed into the encoder (True) and which not (False). B is 1 for a shared patch_mask without noise.
     """
+    patch_mask = patch_mask.to(device).bool()
+    patch_mask = patch_mask.view(-1, patch_mask.shape[-1])
+    num_patches = patch_mask.shape[1]
+    if noise is None:
+        noise = torch.rand(patch_mask.shape, device=device, generator=generator)
+    B = noise.shape[0]
 
-    # construct a tube mask of size number of channels
-    tube_mask = torch.zeros(height * width).to(device).to(torch.bool)
-
-    # only select idx of existing channels here - the first len(number of channels) entries in the padding mask
-    # indicate whether the channel contains a signal or not and we are only taking those which contain a signal (True) -
-    # chn_idx contains the indices of channels with data
-    chn_idx = torch.nonzero(padding_mask[: len(tube_mask)])
+    # we are taking 1 - tube_mask_ratio percent of all channels that contain signal, in double precision to floor
+    # the same way as python floats
+    num_keep = (
+        patch_mask.sum(dim=1, keepdim=True).double() * (1 - tube_mask_ratio)
+    ).long()
 
-    # shuffling values in chn_idx
-    mask_idx_candidates = chn_idx[torch.randperm(len(chn_idx))]
+    # rank the channels with signal randomly before the ones without
+    ranks = (noise + ~patch_mask).argsort(dim=1).argsort(dim=1)
+    tube_mask = ranks < num_keep
 
-    # now we are taking 1 - tube_mask_ratio percent of all (shuffled) channels that contain signal
-    tube_idx = mask_idx_candidates[
-        : int(len(mask_idx_candidates) * (1 - tube_mask_ratio))
-    ]
-    # and set them to True, meaning they will be unmasked
-    tube_mask[tube_idx] = True
-
-    # now we repeat this pattern of masking across the remaining patches
-    tube_mask = tube_mask.tile(len(padding_mask) // height // width)
-
-    return tube_mask
+    # now we repeat this pattern of masking across all frames
+    return tube_mask.unsqueeze(1).expand(B, num_frames, num_patches).reshape(B, -1)
 
 
 def get_decoder_mask(decoder_mask_ratio, tube_mask, device):
@@ -67,50 +226,63 @@ def get_decoder_mask(decoder_mask_ratio, tube_mask, device):
 
     Args:
         decoder_mask_ratio: The ratio of the number of masked tokens in the input sequence
-        tube_mask: boolean tensor indicating which parts of the patchified signal are masked out for the encoder
+        tube_mask: boolean tensor of shape [L] (or [B, L]) indicating which parts of the patchified signal are
+            fed into the encoder
         device: GPU device
 
     Returns:
-        decoder_mask: boolean tensor of shape as patchified signal indicating which of the patches are masked
-            for the decoder.
+        decoder_mask: boolean tensor of shape [B, L] indicating which of the patches are reconstructed by the
+            decoder, the first 1 - decoder_mask_ratio of the unseen patches of each sample.
     """
-
-    decoder_mask = torch.zeros_like(tube_mask).to(device).to(torch.bool)
-    remaining_mask_idx = (~tube_mask).nonzero()
-    decoder_mask_idx = remaining_mask_idx[
-        : int(len(remaining_mask_idx) * (1 - decoder_mask_ratio))
-    ]
-    decoder_mask[decoder_mask_idx] = True
-
-    return decoder_mask
+    unseen = ~tube_mask.to(device).bool().view(-1, tube_mask.shape[-1])
+    num_decode = (
+        unseen.sum(dim=1, keepdim=True).double() * (1 - decoder_mask_ratio)
+    ).long()
+    return unseen & (unseen.cumsum(dim=1) <= num_decode)
 
 
 def get_running_cell_mask(
-    decoder_mask_ratio, frame_patch_size, num_frames, tube_mask, device
+    decoder_mask_ratio,
+    frame_patch_size,
+    num_frames,
+    tube_mask,
+    device,
+    num_patch_per_cell=4,
 ):
     """
-    Not implemented for now
+    Getting parts of the signal that were not seen by the encoder to be reconstructed by the decoder with running
+    cell masking (Qing et al., 2023, MAR: Masked Autoencoder for Efficient Action Recognition). Consecutive patches
+    are grouped into cells and the skipped positions inside each cell move on by one with every frame, so the
+    decoded patches spatially progress across frames.
+
+    Args:
+        decoder_mask_ratio: proportion of patches in each cell which are not decoded
+        frame_patch_size: number of frames per temporal patch
+        num_frames: number of frames of the signal
+        tube_mask: boolean tensor of shape [L] (or [B, L]) indicating which parts of the patchified signal are
+            fed into the encoder
+        device: GPU device
+        num_patch_per_cell: number of patches per cell
+
+    Returns:
+        running_cell_mask: boolean tensor of shape [B, L] indicating which of the patches are reconstructed by the
+            decoder
     """
+    tube_mask = tube_mask.to(device).bool().view(-1, tube_mask.shape[-1])
+    num_temporal_patches = num_frames // frame_patch_size
+    num_patches = tube_mask.shape[1] // num_temporal_patches
 
-    num_patch_per_cell = 4
     num_mask_per_cell = int(decoder_mask_ratio * num_patch_per_cell)
-    stride = int(num_patch_per_cell / num_mask_per_cell)
-    num_patch_per_frame = 16  # change to be flexible #TODO
-    cell = torch.ones(num_frames // frame_patch_size, num_patch_per_cell)
-    # mask out patches in cell so that the mask spatially progresses across frames
-    # Quing et al., 2023, MAR: Masked Autoencoder for Efficient Action Recognition
-    for i in range(num_frames // frame_patch_size):
-        for j in range(num_mask_per_cell):
-            cell[i, (int(j * stride) + i) % num_patch_per_cell] = 0
-
-    running_cell_mask = (
-        cell.repeat(1, int(num_patch_per_frame / num_patch_per_cell))
-        .flatten(0)
-        .to(device)
-        .to(torch.bool)
-    )
+    if num_mask_per_cell == 0:
+        return ~tube_mask
+    stride = num_patch_per_cell // num_mask_per_cell
 
-    # filter out patches that were seen by the encoder
-    running_cell_mask[~tube_mask] == False
+    # Position of each patch in its cell relative to the cell's first skipped position in that frame.
+    offset = (
+        torch.arange(num_patches, device=device).view(1, -1)
+        - torch.arange(num_temporal_patches, device=device).view(-1, 1)
+    ) % num_patch_per_cell
+    skips = (offset % stride == 0) & (offset // stride < num_mask_per_cell)
 
-    return running_cell_mask
+    # filter out patches that were seen by the encoder
+    return ~skips.view(1, -1) & ~tube_mask
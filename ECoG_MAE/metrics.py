@@ -1,15 +1,156 @@
+import torch
+import torch.distributed as dist
 import torch.nn.functional as F
 
+import utils
 
-def pearson_correlation(x1, x2):
+
+def pearson_correlation(x1, x2, mask=None):
     """Compute pearson correlation between x1 and x2.
 
     Args:
         x1 (Tensor): shape [N]
         x2 (Tensor): shape [N]
+        mask (Tensor, optional): shape [N]. If set only entries where mask is non-zero are
+            included in the correlation, which gives the same result as indexing x1 and x2 with
+            the mask first but keeps shapes static.
     """
+    if mask is None:
+        return F.cosine_similarity(
+            x1 - x1.mean(),
+            x2 - x2.mean(),
+            dim=0,
+        )
+
+    mask = mask.to(x1.dtype)
+    count = mask.sum()
     return F.cosine_similarity(
-        x1 - x1.mean(),
-        x2 - x2.mean(),
+        (x1 - (x1 * mask).sum() / count) * mask,
+        (x2 - (x2 * mask).sum() / count) * mask,
         dim=0,
     )
+
+
+class ReconstructionMetrics:
+    """Accumulates MSE and pearson correlation of reconstructions per electrode, band and time patch on device.
+
+    Keeps running sums of the weights, targets, predictions, their squares and their products for every value of
+    the patchified signal, so update doesn't sync with the host and the metrics of any group of values follow from
+    summing the statistics over the group. Sums are kept in float64 to avoid cancellation over a whole epoch.
+    Statistics of several processes are merged with synchronize, e.g. once at the end of an epoch, also if a process
+    didn't update them.
+    """
+
+    # Order of the statistics along the first dimension of stats.
+    STATS = ("weight", "target", "pred", "target_sq", "pred_sq", "product")
+
+    def __init__(
+        self,
+        num_frames,
+        grid_size,
+        patch_size,
+        frame_patch_size,
+        num_bands,
+        device=None,
+    ):
+        """
+        num_frames: number of frames T of the reconstructed signal.
+        grid_size: (h, w) size of the patch grid.
+        patch_size: (ph, pw) electrodes per patch.
+        frame_patch_size: frames per patch u.
+        num_bands: number of bands C.
+        device: device of the reconstructions.
+        """
+        self.grid_size = tuple(grid_size)
+        self.patch_size = tuple(patch_size)
+        self.frame_patch_size = frame_patch_size
+        self.num_tokens = (
+            num_frames // frame_patch_size * self.grid_size[0] * self.grid_size[1]
+        )
+        # [len(STATS), t * h * w, u * ph * pw * C]
+        self.stats = torch.zeros(
+            len(self.STATS),
+            self.num_tokens,
+            frame_patch_size * self.patch_size[0] * self.patch_size[1] * num_bands,
+            dtype=torch.float64,
+            device=device,
+        )
+
+    def update(self, target, pred, ids_masked, weights=None):
+        """Add the reconstructed values of a batch to the statistics.
+
+        target: [N, M, u * ph * pw * C] patchified signal of the tokens in ids_masked.
+        pred: [N, M, u * ph * pw * C] reconstruction of the tokens in ids_masked.
+        ids_masked: [N, M] token indices into the t * h * w token grid.
+        weights: optional [N, M, u * ph * pw * C] weights of the values, 0 to exclude missing electrodes.
+
+        Values which aren't finite are excluded.
+        """
+        target = target.detach().double()
+        pred = pred.detach().double()
+        if weights is None:
+            weights = torch.ones_like(target)
+        else:
+            weights = weights.detach().double().expand_as(target)
+        finite = torch.isfinite(target) & torch.isfinite(pred)
+        weights = torch.where(finite, weights, 0.0)
+        target = torch.where(finite, target, 0.0)
+        pred = torch.where(finite, pred, 0.0)
+
+        weighted_target = weights * target
+        weighted_pred = weights * pred
+        stats = torch.stack(
+            [
+                weights,
+                weighted_target,
+                weighted_pred,
+                weighted_target * target,
+                weighted_pred * pred,
+                weighted_target * pred,
+            ]
+        ).view(len(self.STATS), -1, target.shape[-1])
+        self.stats.index_add_(1, ids_masked.reshape(-1), stats)
+
+    def synchronize(self):
+        """Sum the statistics over all processes."""
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.stats)
+
+    @staticmethod
+    def _metrics(stats):
+        """MSE and correlation from statistics summed over a group of values, [len(STATS), ...]."""
+        weight, target, pred, target_sq, pred_sq, product = stats
+        mse = (target_sq - 2 * product + pred_sq) / weight
+        covariance = product - target * pred / weight
+        target_var = target_sq - target**2 / weight
+        pred_var = pred_sq - pred**2 / weight
+        correlation = covariance / torch.sqrt(target_var * pred_var)
+        return mse, correlation
+
+    def compute(self):
+        """Compute the metrics from the statistics.
+
+        Returns:
+            dict of float64 cpu tensors "mse" and "correlation" over all values, "electrode_mse" and
+            "electrode_correlation" of shape [H, W], "band_mse" and "band_correlation" of shape [C] and
+            "time_patch_mse" and "time_patch_correlation" of shape [t]. Metrics of groups without any values,
+            e.g. missing electrodes, are nan.
+        """
+        # [len(STATS), C, T, H, W]
+        stats = utils.unpatchify(
+            self.stats, self.patch_size, self.frame_patch_size, self.grid_size
+        ).cpu()
+        S, C, T, H, W = stats.shape
+        stats = stats.view(S, C, T // self.frame_patch_size, -1, H, W)
+
+        metrics = {}
+        for name, dims in (
+            ("", (1, 2, 3, 4, 5)),
+            ("electrode_", (1, 2, 3)),
+            ("band_", (2, 3, 4, 5)),
+            ("time_patch_", (1, 3, 4, 5)),
+        ):
+            mse, correlation = self._metrics(stats.sum(dim=dims))
+            metrics[f"{name}mse"] = mse
+            metrics[f"{name}correlation"] = correlation
+        return metrics
@@ -70,6 +70,20 @@ def arg_parser():
         help="If True then don't use a bias for query, key, and values in attention blocks.",
     )
     parser.set_defaults(no_qkv_bias=False)
+    parser.add_argument(
+        "--pack-tokens",
+        dest="pack_tokens",
+        action="store_true",
+        help="If True then pack the real tokens of samples with different padding masks into one sequence.",
+    )
+    parser.set_defaults(pack_tokens=False)
+    parser.add_argument(
+        "--use-rope",
+        dest="use_rope",
+        action="store_true",
+        help="If True then use 4D rotary position embeddings in attention instead of learned position embeddings.",
+    )
+    parser.set_defaults(use_rope=False)
 
     # VideoMAETaskConfig parameters
     parser.add_argument(
@@ -82,6 +96,24 @@ def arg_parser():
         type=float,
         help="The percentage of masks to feed into the decoder.",
     )
+    parser.add_argument(
+        "--mask-strategy",
+        type=str,
+        choices=["random", "tube"],
+        help="How tokens are masked for the encoder, tube masks the same electrodes in all frames.",
+    )
+    parser.add_argument(
+        "--running-cell-masking",
+        dest="running_cell_masking",
+        action="store_true",
+        help="If True then select the patches to decode with running cell masking.",
+    )
+    parser.set_defaults(running_cell_masking=False)
+    parser.add_argument(
+        "--num-masks-per-sample",
+        type=int,
+        help="Number of masks to draw for every sample, the loss is computed over all of them.",
+    )
     parser.add_argument(
         "--norm-pix-loss",
         dest="norm_pix_loss",
@@ -146,6 +178,71 @@ def arg_parser():
     parser.add_argument(
         "--num-epochs", type=int, help="Number of epochs to train over data."
     )
+    parser.add_argument(
+        "--compile-model",
+        dest="compile_model",
+        action="store_true",
+        help="If True then torch.compile the model with static shapes.",
+    )
+    parser.set_defaults(compile_model=False)
+    parser.add_argument(
+        "--precision",
+        type=str,
+        choices=["fp32", "bf16", "fp16"],
+        help="Numerical precision to train in.",
+    )
+    parser.add_argument(
+        "--gradient-accumulation-steps",
+        type=int,
+        help="Number of batches to accumulate gradients over before each optimizer step.",
+    )
+    parser.add_argument(
+        "--micro-batch-size",
+        type=int,
+        help="Number of samples to pass through the model at once, 0 passes whole batches.",
+    )
+    parser.add_argument(
+        "--auto-micro-batch-size",
+        dest="auto_micro_batch_size",
+        action="store_true",
+        help="If True then use the largest micro-batch which fits into device memory.",
+    )
+    parser.set_defaults(auto_micro_batch_size=False)
+    parser.add_argument(
+        "--weight-decay",
+        type=float,
+        help="Weight decay of the weights of linear and convolution layers.",
+    )
+    parser.add_argument(
+        "--optimizer-implementation",
+        type=str,
+        choices=["for_loop", "foreach", "fused"],
+        help="Implementation of AdamW.",
+    )
+    parser.add_argument(
+        "--shard-optimizer-state",
+        dest="shard_optimizer_state",
+        action="store_true",
+        help="If True then shard the optimizer state across processes.",
+    )
+    parser.set_defaults(shard_optimizer_state=False)
+    parser.add_argument(
+        "--num-checkpoints",
+        type=int,
+        help="Number of most recent checkpoints to keep.",
+    )
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="If True then continue training from the latest checkpoint of the job.",
+    )
+    parser.set_defaults(resume=False)
+    parser.add_argument(
+        "--checkpoint-interval-minutes",
+        type=float,
+        help="Save a checkpoint in the middle of an epoch every this many minutes.",
+    )
     parser.add_argument("--loss", type=str, help="Type of loss to use.")
 
     # LoggingConfig parameters
@@ -1,10 +1,13 @@
+import contextlib
 import os
 
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
 from mask import *
 from utils import *
 from plot import save_reconstruction_plot
+from metrics import ReconstructionMetrics
 from mae_st_util.models_mae import MaskedAutoencoderViT
 from config import VideoMAEExperimentConfig
 import constants
@@ -13,10 +16,289 @@ import mae_st_util.misc as misc
 from mae_st_util.logging import master_print as print
 
 
-def model_forward(model, signal, mask_ratio, alpha):
-    """Pass signal through model after converting nan's to 0."""
+def model_forward(model, signal, mask_ratio, alpha, generator=None, metrics=None):
+    """Pass signal through model after converting nan's to 0.
+
+    generator: optional torch.Generator on the device of signal to draw the masks from, to get the same masks for
+        every call with an equally seeded generator.
+    metrics: optional metrics.ReconstructionMetrics to accumulate the reconstruction into.
+    """
     signal = torch.nan_to_num(signal)
-    return model(signal, mask_ratio=mask_ratio, alpha=alpha)
+    if model.static_shapes or generator is not None:
+        # Draw the masking noise outside of the model so a compiled forward is free of random ops.
+        noise, decoder_noise = model.generate_noise(
+            signal.shape[0], signal.device, generator
+        )
+        return model(
+            signal,
+            mask_ratio=mask_ratio,
+            alpha=alpha,
+            noise=noise,
+            decoder_noise=decoder_noise,
+            metrics=metrics,
+        )
+    return model(signal, mask_ratio=mask_ratio, alpha=alpha, metrics=metrics)
+
+
+def train_step(model, signal, mask_ratio, alpha, loss_weight, scaler=None):
+    """Forward and backward pass of a batch, skipping it on device if its loss is nan.
+
+    Kept free of host syncs so torch.compile can trace forward and backward into a single graph, the optimizer is
+    stepped separately with optimizer_step since torch.optim breaks the graph around optimizer.step by design.
+
+    Args:
+        model: model to train.
+        signal: batch on the device of model.
+        mask_ratio: ratio of patches to mask in the encoder.
+        alpha: weight of the loss on the masked patches.
+        loss_weight: factor to scale the loss with before backpropagating, e.g. to average over accumulated batches.
+        scaler: optional torch.amp.GradScaler to scale the loss with when training in fp16.
+
+    Returns:
+        Tensor of the unweighted loss, mse and correlation, and a boolean scalar tensor whether the loss was finite.
+    """
+    # TODO: Add more metrics using the other outputs.
+    loss, mse, _, _, _, correlation = model_forward(model, signal, mask_ratio, alpha)
+
+    # Batches with a nan loss are skipped on device by zeroing their loss and gradients instead of branching on the
+    # value in python.
+    is_finite = torch.isfinite(loss)
+    loss = torch.where(is_finite, loss, torch.zeros_like(loss))
+
+    scaled_loss = loss * loss_weight
+    if scaler is not None:
+        scaled_loss = scaler.scale(scaled_loss)
+    scaled_loss.backward()
+
+    return torch.stack([loss, mse, correlation]).detach(), is_finite
+
+
+def zero_non_finite_grads(model, is_finite):
+    """Zero all gradients of model in place if is_finite is False, without syncing with the device.
+
+    Args:
+        model: model whose parameter gradients to zero.
+        is_finite: boolean scalar tensor on the same device as the gradients.
+    """
+    for param in model.parameters():
+        if param.grad is not None:
+            param.grad.masked_fill_(~is_finite, 0.0)
+
+
+def _gated_step(optimizer, is_finite):
+    """Step optimizer only if is_finite is True, without syncing with the device.
+
+    Fused Adam and AdamW skip the update on device when given a found_inf tensor, like the gradient scaler uses,
+    which costs nothing for finite steps. Other optimizers step anyway and their parameters and state are restored
+    to the values before the step if is_finite is False. That keeps a copy of the parameters and of the optimizer
+    state, about three times the memory of the parameters for Adam, and makes extra passes over both on every step,
+    so the fused implementation should be used where available. Gradients are expected to be zeroed for skipped
+    steps, so state initialized by the first step is all zeros, which it is restored to.
+    """
+    # A ZeroRedundancyOptimizer steps its shard with the wrapped optimizer.
+    local_optimizer = getattr(optimizer, "optim", optimizer)
+    if isinstance(local_optimizer, torch.optim.Adam | torch.optim.AdamW) and all(
+        group["fused"] for group in local_optimizer.param_groups
+    ):
+        local_optimizer.found_inf = (~is_finite).float()
+        try:
+            optimizer.step()
+        finally:
+            del local_optimizer.found_inf
+        return
+
+    # A ZeroRedundancyOptimizer broadcasts the updated parameters of every shard, so all of them are restored, but
+    # only the state of the local shard exists on this process.
+    params = [
+        param
+        for group in optimizer.param_groups
+        for param in group["params"]
+        if param.grad is not None
+    ]
+    state_params = [
+        param
+        for group in local_optimizer.param_groups
+        for param in group["params"]
+        if param.grad is not None
+    ]
+    with torch.no_grad():
+        previous_params = [param.detach().clone() for param in params]
+        # The state is a defaultdict, reading it with get doesn't add entries for parameters without state yet.
+        previous_state = [
+            {
+                key: value.clone()
+                for key, value in local_optimizer.state.get(param, {}).items()
+                if isinstance(value, torch.Tensor)
+            }
+            for param in state_params
+        ]
+
+        optimizer.step()
+
+        for param, previous in zip(params, previous_params):
+            param.copy_(torch.where(is_finite, param, previous))
+        for param, previous in zip(state_params, previous_state):
+            for key, value in local_optimizer.state.get(param, {}).items():
+                if not isinstance(value, torch.Tensor):
+                    continue
+                previous_value = previous.get(key)
+                if previous_value is None:
+                    previous_value = torch.zeros_like(value)
+                # Step counters kept on the host (Adam without capturable=True on the gpu) need the flag on the
+                # host as well.
+                value.copy_(
+                    torch.where(is_finite.to(value.device), value, previous_value)
+                )
+
+
+def optimizer_step(optimizer, scaler=None, is_finite=None):
+    """Step the optimizer, through the gradient scaler if training in fp16.
+
+    Args:
+        optimizer: optimizer to step.
+        scaler: optional torch.amp.GradScaler the loss was scaled with (i.e. accelerator.scaler).
+        is_finite: optional boolean scalar tensor on the device of the gradients, if False the step is skipped,
+            leaving parameters and optimizer state unchanged. Without a scaler this doesn't sync with the device.
+
+    Returns:
+        True if the scaler skipped the step because gradients overflowed, always False without a scaler.
+    """
+    if scaler is None:
+        if is_finite is None:
+            optimizer.step()
+        else:
+            _gated_step(optimizer, is_finite)
+        return False
+
+    # The scaler checks gradients for infs on the host anyway, so checking is_finite there costs no extra wait.
+    if is_finite is not None and not is_finite.item():
+        return False
+
+    # The scaler only calls optimizer.step if the gradients didn't overflow, so the step hook tells whether it did
+    # without reading the scale from the device.
+    stepped = []
+    handle = optimizer.register_step_post_hook(lambda *args: stepped.append(True))
+    try:
+        scaler.step(optimizer)
+    finally:
+        handle.remove()
+    scaler.update()
+    return not stepped
+
+
+class SkippableLRScheduler:
+    """Wraps an lr scheduler to only step it for optimizer steps which weren't skipped, without waiting on the device.
+
+    step(is_finite) copies the flag to the host without blocking, and the scheduler is stepped once it's needed: by
+    the next step, flush or state_dict. Calling flush right before the next optimizer step, the device is usually
+    done with the previous one by then. Other attributes are those of the wrapped scheduler.
+    """
+
+    def __init__(self, lr_scheduler):
+        self.lr_scheduler = lr_scheduler
+        # Host copy of is_finite of the last step and the event recorded after copying it, if not applied yet.
+        self._pending = None
+
+    def step(self, is_finite=None):
+        """Step the scheduler if is_finite is True, always if it's None."""
+        self.flush()
+        if is_finite is None:
+            self.lr_scheduler.step()
+            return
+        copied = None
+        if is_finite.device.type == "cuda":
+            flag = torch.empty((), dtype=torch.bool, pin_memory=True)
+            flag.copy_(is_finite, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record()
+        else:
+            flag = is_finite.clone()
+        self._pending = (flag, copied)
+
+    def flush(self):
+        """Apply the pending step, waits for the device to finish the optimizer step if it hasn't yet."""
+        if self._pending is None:
+            return
+        flag, copied = self._pending
+        self._pending = None
+        if copied is not None:
+            copied.synchronize()
+        if flag:
+            self.lr_scheduler.step()
+
+    def state_dict(self):
+        self.flush()
+        return self.lr_scheduler.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self._pending = None
+        self.lr_scheduler.load_state_dict(state_dict)
+
+    def __getattr__(self, name):
+        return getattr(self.lr_scheduler, name)
+
+
+def find_micro_batch_size(
+    model, batch, padding_mask, device, mask_ratio, alpha, accelerator=None
+):
+    """Find the largest micro-batch of batch whose forward and backward pass fits into device memory.
+
+    Starts with the whole batch and halves the micro-batch size on every out of memory error. Gradients of the
+    probing passes are discarded and the running statistics of normalization layers are restored afterwards, so
+    probing doesn't change the model.
+
+    Args:
+        model: model to train.
+        batch: batch of signal on the host.
+        padding_mask: per-sample padding masks of batch, see mask.get_padding_mask.
+        device: device to train on.
+        mask_ratio: encoder mask ratio.
+        alpha: loss weight, see VideoMAETaskConfig.alpha.
+        accelerator: optional accelerator whose processes the model is trained on, the gradients of the probing
+            passes aren't synced between them.
+
+    Returns:
+        number of samples to pass through the model at once.
+    """
+    norm_layers = [
+        module
+        for module in model.modules()
+        if getattr(module, "track_running_stats", False)
+    ]
+    running_stats = [
+        [buffer.clone() for buffer in module.buffers(recurse=False)]
+        for module in norm_layers
+    ]
+
+    micro_batch_size = len(batch)
+    try:
+        with (
+            accelerator.no_sync(model)
+            if accelerator is not None
+            else contextlib.nullcontext()
+        ):
+            while True:
+                try:
+                    model.initialize_mask(padding_mask[:micro_batch_size])
+                    loss = model_forward(
+                        model, batch[:micro_batch_size].to(device), mask_ratio, alpha
+                    )[0]
+                    loss.backward()
+                    return micro_batch_size
+                except torch.cuda.OutOfMemoryError:
+                    if micro_batch_size == 1:
+                        raise
+                    micro_batch_size = (micro_batch_size + 1) // 2
+                finally:
+                    loss = None
+                    model.zero_grad(set_to_none=True)
+                    if torch.cuda.is_available():
+                        torch.cuda.empty_cache()
+    finally:
+        with torch.no_grad():
+            for module, stats in zip(norm_layers, running_stats):
+                for buffer, previous in zip(module.buffers(recurse=False), stats):
+                    buffer.copy_(previous)
 
 
 def train_single_epoch(
@@ -30,8 +312,22 @@ def train_single_epoch(
     config: VideoMAEExperimentConfig,
     logger,
     log_writer=None,
+    start_batch=0,
+    on_optimizer_step=None,
+    train_step_fn=train_step,
 ):
+    """Train model for an epoch.
+
+    start_batch: index of the first batch of train_dl, when continuing an epoch from a step checkpoint whose data
+        loader continues from the same sample.
+    on_optimizer_step: optional function called with the number of batches trained on in the epoch after every
+        optimizer step, e.g. to save step checkpoints.
+    train_step_fn: function running forward and backward of a batch with the signature of train_step, e.g. a
+        compiled train_step.
+    """
     model.train()
+    if not isinstance(lr_scheduler, SkippableLRScheduler):
+        lr_scheduler = SkippableLRScheduler(lr_scheduler)
 
     metric_logger = misc.MetricLogger(delimiter="  ")
     metric_logger.add_meter(
@@ -51,52 +347,156 @@ def train_single_epoch(
     metric_logger.add_meter(
         "correlation", misc.SmoothedValue(window_size=1, fmt="{value: 6f}")
     )
+    # Only set when training in fp16.
+    scaler = accelerator.scaler
+    if scaler is not None:
+        metric_logger.add_meter(
+            "overflows", misc.SmoothedValue(window_size=1, fmt="{value:.0f}")
+        )
     header = "Epoch: [{}]".format(epoch)
 
+    print_freq = config.logging_config.print_freq
+    # Metrics are accumulated on device and only pulled to host every print_freq steps, calling .item() every
+    # step forces the host to wait on the device.
+    running_metrics = torch.zeros(3, device=device)
+    num_finite_steps = torch.zeros((), device=device)
+    num_steps = 0
+    num_overflow_steps = 0
+    # Whether all batches accumulated since the last optimizer step had a finite loss.
+    accumulated_finite = torch.ones((), dtype=torch.bool, device=device)
+    num_accumulated = 0
+    # Found on the first batch with auto_micro_batch_size and kept for the rest of the epoch.
+    micro_batch_size = config.trainer_config.micro_batch_size
+
     for train_i, batch in enumerate(
-        metric_logger.log_every(train_dl, config.logging_config.print_freq, header)
+        metric_logger.log_every(train_dl, print_freq, header), start=start_batch
     ):
-        optimizer.zero_grad()
+        if num_accumulated == 0:
+            optimizer.zero_grad()
 
-        signal = batch.to(device)
+        # Compute the padding mask before moving the batch to the device so checking the electrode layout doesn't
+        # need to sync with the device. The model caches masks per layout so this is a lookup for most batches.
+        padding_mask = get_padding_mask(batch, "cpu", per_sample=True)
 
-        padding_mask = get_padding_mask(signal, device)
-        # TODO: We don't necessarily need to call this so often but for now this is easier.
-        # We could be more clever with this though.
-        model.initialize_mask(padding_mask)
+        if micro_batch_size == 0 and config.trainer_config.auto_micro_batch_size:
+            micro_batch_size = find_micro_batch_size(
+                model,
+                batch,
+                padding_mask,
+                device,
+                config.video_mae_task_config.encoder_mask_ratio,
+                config.video_mae_task_config.alpha,
+                accelerator,
+            )
+            logger.info(f"Using micro-batches of {micro_batch_size} samples.")
+        # 0 passes whole batches.
+        split_size = micro_batch_size or len(batch)
 
-        # TODO: Add more metrics using the other outputs.
-        loss, mse, _, _, _, correlation = model_forward(
-            model,
-            signal,
-            config.video_mae_task_config.encoder_mask_ratio,
-            config.video_mae_task_config.alpha,
+        num_accumulated += 1
+        # The data loader isn't prepared by the accelerator, so the accumulation windows are counted here instead
+        # of by accelerator.accumulate. The last batches of an epoch are stepped on even if they don't fill a window.
+        step_optimizer = (
+            num_accumulated == accelerator.gradient_accumulation_steps
+            or train_i == len(train_dl) - 1
         )
-        if torch.isnan(mse):
-            logger.error(
-                f"Got nan loss for index {train_i}. Ignoring and continuing..."
-            )
-            continue
+        # Gradients are only synced between processes on the batches ending a window.
+        with contextlib.nullcontext() if step_optimizer else accelerator.no_sync(model):
+            step_metrics = torch.zeros(3, device=device)
+            is_finite = torch.ones((), dtype=torch.bool, device=device)
+            for micro_batch, micro_padding_mask in zip(
+                batch.split(split_size), padding_mask.split(split_size)
+            ):
+                # The model caches masks per layout so this is a lookup for most batches.
+                model.initialize_mask(micro_padding_mask)
 
-        accelerator.backward(loss)
-        optimizer.step()
-        lr_scheduler.step()
+                signal = micro_batch.to(device)
+
+                # Weighted by size so the gradients add up to the ones of the whole batch, and divided by the
+                # number of accumulation steps like accelerator.backward does.
+                weight = len(micro_batch) / len(batch)
+                micro_metrics, micro_is_finite = train_step_fn(
+                    model,
+                    signal,
+                    config.video_mae_task_config.encoder_mask_ratio,
+                    config.video_mae_task_config.alpha,
+                    weight / accelerator.gradient_accumulation_steps,
+                    scaler,
+                )
+                is_finite &= micro_is_finite
+                step_metrics += weight * micro_metrics
 
-        loss_value = loss.item()
-        mse_value = mse.item()
-        correlation_value = correlation.item()
+        accumulated_finite &= is_finite
+        if step_optimizer:
+            # A nan loss skips the whole accumulation window, its gradients are mixed with the other batches'.
+            # Optimizer and scheduler are only stepped if all batches of the window were finite, decided on
+            # device, see optimizer_step and SkippableLRScheduler.
+            if accelerator.num_processes > 1:
+                # Gradients are averaged across processes, so all of them skip the step if any had a nan loss.
+                accumulated_finite = accumulated_finite.int()
+                torch.distributed.all_reduce(
+                    accumulated_finite, op=torch.distributed.ReduceOp.MIN
+                )
+                accumulated_finite = accumulated_finite.bool()
+            zero_non_finite_grads(model, accumulated_finite)
+            # Stepped here so the optimizer uses the learning rate after the previous step.
+            lr_scheduler.flush()
+            overflowed = optimizer_step(optimizer, scaler, accumulated_finite)
+            num_overflow_steps += overflowed
+            if not overflowed:
+                lr_scheduler.step(accumulated_finite)
+            accumulated_finite.fill_(True)
+            num_accumulated = 0
+            if on_optimizer_step is not None:
+                on_optimizer_step(train_i + 1)
+
+        running_metrics += torch.where(
+            is_finite, step_metrics, torch.zeros_like(step_metrics)
+        )
+        num_finite_steps += is_finite
+        num_steps += 1
+
+        if train_i % print_freq != 0 and train_i != len(train_dl) - 1:
+            continue
 
-        metric_logger.update(loss=loss_value)
-        metric_logger.update(mse=mse_value)
-        metric_logger.update(cpu_mem=misc.cpu_mem_usage()[0])
-        metric_logger.update(cpu_mem_all=misc.cpu_mem_usage()[1])
+        # Only sync with the device here.
+        num_finite = int(num_finite_steps.item())
+        if num_finite < num_steps:
+            logger.error(
+                f"Got nan loss for {num_steps - num_finite} of the last {num_steps} steps before index {train_i}. "
+                "Ignored them and continued..."
+            )
+        if num_finite > 0:
+            loss_value, mse_value, correlation_value = (
+                running_metrics / num_finite
+            ).tolist()
+            metric_logger.loss.update(loss_value, n=num_finite)
+            metric_logger.mse.update(mse_value, n=num_finite)
+            metric_logger.correlation.update(correlation_value, n=num_finite)
+        running_metrics.zero_()
+        num_finite_steps.zero_()
+        num_steps = 0
+
+        cpu_mem, cpu_mem_all = misc.cpu_mem_usage()
+        metric_logger.update(cpu_mem=cpu_mem)
+        metric_logger.update(cpu_mem_all=cpu_mem_all)
         metric_logger.update(gpu_mem=misc.gpu_mem_usage())
-        metric_logger.update(correlation=correlation_value)
 
+        lr_scheduler.flush()
         lr = optimizer.param_groups[0]["lr"]
         metric_logger.update(lr=lr)
 
-        if log_writer is not None:
+        if scaler is not None:
+            # Number of steps skipped by the gradient scaler since the last log.
+            metric_logger.update(overflows=num_overflow_steps)
+            if log_writer is not None:
+                epoch_1000x = int((train_i / len(train_dl) + epoch) * 1000)
+                log_writer.add_scalar(
+                    "overflows/train", num_overflow_steps, epoch_1000x
+                )
+                log_writer.add_scalar("grad_scale", scaler.get_scale(), epoch_1000x)
+        num_overflow_steps = 0
+
+        if log_writer is not None and num_finite > 0:
             """We use epoch_1000x as the x-axis in tensorboard.
             This calibrates different curves when batch size changes.
             """
@@ -106,6 +506,7 @@ def train_single_epoch(
             log_writer.add_scalar("mse/train", mse_value, epoch_1000x)
             log_writer.add_scalar("correlation/train", correlation_value, epoch_1000x)
 
+    lr_scheduler.flush()
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
@@ -120,31 +521,49 @@ def test_single_epoch(
     logger,
     log_writer=None,
 ):
+    """Evaluate model on test_dl.
+
+    Metrics are accumulated on device and only copied to the host at the end of the epoch, after merging them
+    across processes.
+
+    Returns:
+        dict with the mean "loss" over batches and the "mse" and "correlation" over all reconstructed values, as
+            well as their breakdowns per electrode, band and time patch, see ReconstructionMetrics.compute.
+    """
     model.eval()
+    # Evaluate every epoch on the same masks so test losses are comparable across epochs.
+    generator = torch.Generator(device=device).manual_seed(0)
+    H, W = model.patch_embed.grid_size
+    metrics = ReconstructionMetrics(
+        model.pred_t_dim,
+        (H, W),
+        model.patch_embed.patch_size,
+        model.t_pred_patch_size,
+        model.patch_embed.in_chans,
+        device=device,
+    )
     with torch.no_grad():
-        running_loss = 0.0
-        running_mse = 0.0
-        running_correlation = 0.0
+        # Sum of the finite losses and number of batches with finite loss.
+        running_loss = torch.zeros(2, dtype=torch.float64, device=device)
         for test_i, batch in enumerate(test_dl):
-            signal = batch.to(device)
-
-            padding_mask = get_padding_mask(signal, device)
-            # TODO: We don't necessarily need to call this so often but for now this is easier.
-            # We could be more clever with this though.
+            padding_mask = get_padding_mask(batch, "cpu", per_sample=True)
             model.initialize_mask(padding_mask)
 
-            # TODO: Add more metrics using the other outputs.
-            loss, mse, pred, _, _, correlation = model_forward(
+            signal = batch.to(device)
+
+            loss, _, pred, _, _, _ = model_forward(
                 model,
                 signal,
                 config.video_mae_task_config.encoder_mask_ratio,
                 config.video_mae_task_config.alpha,
+                generator=generator,
+                metrics=metrics,
+            )
+            # Skip batches with nan loss without syncing, the metrics exclude non-finite values themselves.
+            is_finite = torch.isfinite(loss)
+            running_loss += torch.stack(
+                [torch.where(is_finite, loss.double(), 0.0), is_finite.double()]
             )
-            if torch.isnan(mse):
-                logger.error(
-                    f"Got nan loss for index {test_i}. Ignoring and continuing..."
-                )
-                continue
 
             # Draw a plot of the first electrode in the first batch so we can see the reconstruction.
             if test_i == 0:
@@ -177,13 +596,19 @@ def test_single_epoch(
                     scale_output=True,
                 )
 
-            running_loss += loss.item()
-            running_mse += mse.item()
-            running_correlation += correlation.item()
-
-        loss_mean = running_loss / (test_i + 1)
-        mse_mean = running_mse / (test_i + 1)
-        correlation_mean = running_correlation / (test_i + 1)
+        # Merge across processes once per epoch.
+        metrics.synchronize()
+        if misc.is_dist_avail_and_initialized():
+            torch.distributed.all_reduce(running_loss)
+        total_loss, num_finite = running_loss.tolist()
+        if num_finite < test_i + 1:
+            logger.error(
+                f"Got nan loss for {test_i + 1 - int(num_finite)} test batches. Ignored them."
+            )
+        test_stats = {k: v.numpy() for k, v in metrics.compute().items()}
+        test_stats["loss"] = total_loss / max(num_finite, 1)
+        test_stats["mse"] = test_stats["mse"].item()
+        test_stats["correlation"] = test_stats["correlation"].item()
 
         # Write averages for test data.
         if log_writer is not None:
@@ -191,7 +616,26 @@ def test_single_epoch(
             This aligns with the training loop.
             """
             epoch_1000x = int((test_i / len(test_dl) + epoch) * 1000)
-            log_writer.add_scalar("loss/test", loss_mean, epoch_1000x)
-            log_writer.add_scalar("mse/test", mse_mean, epoch_1000x)
-            # Write overall correlation, individual channels, and bands.
-            log_writer.add_scalar("correlation/test", correlation_mean, epoch_1000x)
+            log_writer.add_scalar("loss/test", test_stats["loss"], epoch_1000x)
+            log_writer.add_scalar("mse/test", test_stats["mse"], epoch_1000x)
+            # Write overall correlation, individual bands, time patches and electrodes.
+            log_writer.add_scalar(
+                "correlation/test", test_stats["correlation"], epoch_1000x
+            )
+            for group in ("band", "time_patch"):
+                for metric in ("mse", "correlation"):
+                    for i, value in enumerate(test_stats[f"{group}_{metric}"]):
+                        log_writer.add_scalar(
+                            f"{metric}/test_{group}_{i}", value, epoch_1000x
+                        )
+            for metric in ("mse", "correlation"):
+                # Missing electrodes are nan, log them as 0.
+                values = np.nan_to_num(test_stats[f"electrode_{metric}"])
+                log_writer.add_image(
+                    f"{metric}/test_electrode_map",
+                    (values - values.min()) / max(values.max() - values.min(), 1e-12),
+                    epoch_1000x,
+                    dataformats="HW",
+                )
+
+        return test_stats
@@ -1,9 +1,24 @@
-from typing import Optional
-
 import torch
 import torch.nn as nn
 
 
+def rotate_half(x: torch.Tensor) -> torch.Tensor:
+    x1, x2 = x.chunk(2, dim=-1)
+    return torch.cat((-x2, x1), dim=-1)
+
+
+def apply_rotary_embedding(
+    x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor
+) -> torch.Tensor:
+    """
+    Rotate queries or keys by their position.
+
+    x: [batch, heads, tokens, d] queries or keys.
+    cos, sin: [batch, 1, tokens, d] as returned from RotaryPositionalEmbeddings4D.
+    """
+    return x * cos + rotate_half(x) * sin
+
+
 class RotaryPositionalEmbeddings4D(nn.Module):
     def __init__(
         self,
@@ -14,88 +29,73 @@ class RotaryPositionalEmbeddings4D(nn.Module):
         grid_time: int,
         base: int = 10_000,
     ):
+        """
+        Rotary position embeddings over a (time, depth, height, width) grid of tokens.
+
+        Each axis rotates a quarter of the d dimensions. Tokens are identified by their flat index
+        ((t * grid_depth + d) * grid_height + h) * grid_width + w into the grid, so tokens of later frames can be
+        embedded without changing the indices of earlier ones and grid_time only sets the initial cache size.
+        """
         super().__init__()
-        assert d % 4 == 0, f"{d} is not divisible by 4."
+        assert d % 8 == 0, f"{d} is not divisible by 8."
         self.base = base
         self.d = d
         self.grid_height = grid_height
         self.grid_width = grid_width
         self.grid_depth = grid_depth
         self.grid_time = grid_time
-        self.cos_cached = None
-        self.sin_cached = None
+        # (device, dtype) -> (grid_time, cos, sin)
+        self._cache = {}
 
-    def _build_cache_1d(self, effective_d: int, seq_idx: torch.Tensor) -> torch.Tensor:
-        seq_idx = seq_idx.reshape(-1)  # List of positions
-        theta = 1.0 / (
-            self.base ** (torch.arange(0, effective_d, 2).float() / effective_d)
-        )
+    def _build_cache(self, grid_time: int, device, dtype):
+        frame_size = self.grid_depth * self.grid_height * self.grid_width
+        index = torch.arange(grid_time * frame_size, device=device)
+        coords = [
+            index // frame_size,
+            index // (self.grid_height * self.grid_width) % self.grid_depth,
+            index // self.grid_width % self.grid_height,
+            index % self.grid_width,
+        ]
 
-        idx_theta = torch.einsum("n,d->nd", seq_idx, theta)
-        idx_theta2 = torch.cat([idx_theta, idx_theta], dim=1)
-        return idx_theta2
-
-    def _build_cache(self, x: torch.Tensor) -> None:
-        # x: batched tensor
-        # x.shape -> Batch, Seq Length, Embed Dim
-        if self.cos_cached is not None and x.shape[1] <= self.cos_cached.shape[1]:
-            # if cache is already built
-            return
-        # get the positions
-        grid_h = torch.arange(self.grid_height, dtype=torch.float32)
-        grid_w = torch.arange(self.grid_width, dtype=torch.float32)
-        grid_d = torch.arange(self.grid_depth, dtype=torch.float32)
-        grid_t = torch.arange(self.grid_time, dtype=torch.float32)
-
-        grid = torch.meshgrid(
-            grid_t, grid_d, grid_h, grid_w, indexing="xy"
-        )  # This order should match with i/p
-        grid = torch.stack(grid, axis=0)
-        grid = grid.reshape(
-            [4, 1, self.grid_time, self.grid_depth, self.grid_height, self.grid_width]
+        effective_d = self.d // 4
+        theta = 1.0 / (
+            self.base
+            ** (
+                torch.arange(0, effective_d, 2, device=device, dtype=torch.float32)
+                / effective_d
+            )
         )
+        angles = torch.cat([torch.outer(c.float(), theta) for c in coords], dim=1)
+        angles = torch.cat([angles, angles], dim=1)
+        # Row 0 is the identity rotation for tokens without a position (i.e. cls token).
+        angles = torch.cat([angles.new_zeros(1, self.d), angles], dim=0)
+        return grid_time, angles.cos().to(dtype), angles.sin().to(dtype)
 
-        # Get the embedings
-        emb_t = self._build_cache_1d(self.d // 4, grid[0])  # 1/4 in-case of 4D
-        emb_d = self._build_cache_1d(self.d // 4, grid[1])
-        emb_h = self._build_cache_1d(self.d // 4, grid[2])  # (T*D*H*W, embedding_dim/4)
-        emb_w = self._build_cache_1d(self.d // 4, grid[3])
-        emb = torch.concatenate(
-            [emb_t, emb_d, emb_h, emb_w], axis=1
-        )  # (T*D*H*W, embedding_dim)
-        emb = emb.to(x.device)
-        # cache sin and cos
-        self.cos_cached = emb.cos()[
-            None, None, :, :
-        ]  # batch, Num Heads, Seq Len, Embed Dim
-        self.sin_cached = emb.sin()[None, None, :, :]
-
-    def _neg_half(self, x: torch.Tensor) -> torch.Tensor:
-        d_2 = self.d // 2
-        return torch.cat([-x[:, :, :, d_2:], x[:, :, :, :d_2]], dim=-1)
-
-    def forward(self, x: torch.Tensor, mask: Optional[torch.Tensor]):
+    def forward(
+        self,
+        positions: torch.Tensor,
+        grid_time: int = None,
+        dtype: torch.dtype = torch.float32,
+    ):
         """
-        Args:
-        -----
-        x: query or key vector
-        mask: boolean vector of length sequence length.
-        True for the non-masked positions.
+        Gather the rotations of tokens from the cached sin/cos tables.
+
+        positions: long tensor [batch, tokens] of flat grid indices, -1 for tokens which aren't rotated.
+        grid_time: number of frames the positions span, the cache is extended if it's larger than grid_time
+            passed at construction.
+        dtype: dtype of the queries and keys to rotate.
+
+        Returns:
+            (cos, sin) each of shape [batch, 1, tokens, d].
         """
-        self._build_cache(x)
-        x_rope, x_pass = x[..., : self.d], x[..., self.d :]
-        neg_half_x = self._neg_half(x_rope)
-        x_rope = (
-            (x_rope * self.cos_cached[:, :, : x.shape[1], :])
-            + (neg_half_x * self.sin_cached[:, :, : x.shape[1], :])
-            if mask is None
-            else (
-                x_rope * self.cos_cached[:, :, mask, :]
-                + neg_half_x * self.sin_cached[:, :, mask, :]
-            )
-        )
+        grid_time = max(grid_time or 0, self.grid_time)
+        key = (positions.device, dtype)
+        if key not in self._cache or self._cache[key][0] < grid_time:
+            self._cache[key] = self._build_cache(grid_time, positions.device, dtype)
+        _, cos, sin = self._cache[key]
 
-        return torch.cat((x_rope, x_pass), dim=-1)
+        index = positions + 1
+        return cos[index].unsqueeze(1), sin[index].unsqueeze(1)
 
 
 if __name__ == "__main__":
@@ -108,4 +108,5 @@ if __name__ == "__main__":
     query_ = torch.randn(
         10, 1, 8 * 8 * 6 * 4, 512
     )  # Batch, Heads, Num Tokens/Seq Length, Embedding Dims
-    print(rot_embed(query_).shape)
+    positions = torch.arange(8 * 8 * 6 * 4).expand(10, -1)
+    print(apply_rotary_embedding(query_, *rot_embed(positions)).shape)
@@ -4,11 +4,23 @@ import logging
 import os
 import torch
 import torch.nn as nn
+from torch.distributed.optim import ZeroRedundancyOptimizer
 from torch.utils.tensorboard import SummaryWriter
 
-from config import VideoMAEExperimentConfig, write_config_file
-from pretrain_engine import train_single_epoch, test_single_epoch
-
+from checkpoint import (
+    AsyncCheckpointWriter,
+    latest_checkpoint,
+    load_checkpoint,
+    save_model,
+)
+from config import VideoMAEExperimentConfig, config_to_string, write_config_file
+from pretrain_engine import (
+    SkippableLRScheduler,
+    train_single_epoch,
+    train_step,
+    test_single_epoch,
+)
+from utils import get_autocast, get_rng_state, set_rng_state
 
 logger = logging.getLogger(__name__)
 
@@ -38,7 +50,7 @@ def train_model(
         optimizer: Adam optimizer instance - https://www.analyticsvidhya.com/blog/2023/12/adam-optimizer/
         lr_scheduler: https://pytorch.org/docs/stable/generated/torch.optim.lr_scheduler.OneCycleLR.html
         accelerator: an accelerator instance - https://huggingface.co/docs/accelerate/en/index
-        data_type: the data type to be used, we use "fp16" mixed precision - https://towardsdatascience.com/understanding-mixed-precision-training-4b246679c7c4
+        data_type: the data type to autocast to, see TrainerConfig.precision - https://towardsdatascience.com/understanding-mixed-precision-training-4b246679c7c4
         local_rank: the local rank environment variable (only needed for multi-gpu training)
 
     Returns:
@@ -63,9 +75,72 @@ def train_model(
         os.makedirs(checkpoint_dir)
     write_config_file(os.path.join(checkpoint_dir, "experiment_config.ini"), config)
 
-    for epoch in range(config.trainer_config.num_epochs):
+    # Steps with a nan loss don't advance the schedule, and checkpoints include the last step's.
+    lr_scheduler = SkippableLRScheduler(lr_scheduler)
+
+    start_epoch, start_batch = 0, 0
+    if config.trainer_config.resume:
+        start_epoch, start_batch = resume_training(
+            checkpoint_dir, model, optimizer, lr_scheduler, accelerator, train_dl
+        )
+
+    # Checkpoints are written by the first process only, in the background while training continues.
+    checkpoint_writer = None
+    if local_rank == 0:
+        checkpoint_writer = AsyncCheckpointWriter(
+            checkpoint_dir, config.trainer_config.num_checkpoints
+        )
+
+    # The model is built with static shapes when compiling, so this only compiles once per batch shape.
+    if config.trainer_config.compile_model:
+        # Trace the backward pass into the same graph as the forward pass instead of breaking the graph at it.
+        torch._dynamo.config.trace_autograd_ops = True
+        train_step_fn = torch.compile(train_step)
+        forward_model = torch.compile(model)
+    else:
+        train_step_fn = train_step
+        forward_model = model
+
+    checkpoint_interval = config.trainer_config.checkpoint_interval_minutes * 60
+    last_checkpoint_time = t.time()
+
+    def save_checkpoint(epoch, name, batch=None, test_loss=None):
+        nonlocal last_checkpoint_time
+        last_checkpoint_time = t.time()
+        # A sharded optimizer state has to be gathered on one process to save it.
+        if isinstance(optimizer, ZeroRedundancyOptimizer):
+            optimizer.consolidate_state_dict(to=0)
+        if checkpoint_writer is not None:
+            checkpoint_writer.save(
+                get_training_state(
+                    config,
+                    epoch,
+                    model,
+                    optimizer,
+                    lr_scheduler,
+                    accelerator,
+                    train_dl,
+                    batch,
+                ),
+                name,
+                test_loss=test_loss,
+            )
+
+    def save_step_checkpoint(epoch, batch):
+        if checkpoint_interval <= 0:
+            return
+        should_save = t.time() - last_checkpoint_time >= checkpoint_interval
+        if isinstance(optimizer, ZeroRedundancyOptimizer):
+            # Every process takes part in consolidating the optimizer state, so they follow the first one's clock.
+            should_save = torch.tensor(should_save, device=device)
+            torch.distributed.broadcast(should_save, src=0)
+            should_save = should_save.item()
+        if should_save:
+            save_checkpoint(epoch, f"{epoch}_{batch}_checkpoint.pth", batch=batch)
+
+    for epoch in range(start_epoch, config.trainer_config.num_epochs):
         start = t.time()
-        with torch.cuda.amp.autocast(dtype=data_type):
+        with get_autocast(device, data_type):
             model.train()
             train_single_epoch(
                 train_dl,
@@ -78,10 +153,19 @@ def train_model(
                 config,
                 logger,
                 log_writer=log_writer,
+                start_batch=start_batch if epoch == start_epoch else 0,
+                on_optimizer_step=lambda batch: save_step_checkpoint(epoch, batch),
+                train_step_fn=train_step_fn,
             )
 
-            test_single_epoch(
-                test_dl, epoch, device, model, config, logger, log_writer=log_writer
+            test_stats = test_single_epoch(
+                test_dl,
+                epoch,
+                device,
+                forward_model,
+                config,
+                logger,
+                log_writer=log_writer,
             )
 
             end = t.time()
@@ -90,15 +174,91 @@ def train_model(
                 "Epoch " + str(epoch) + " done. Time elapsed: " + str(end - start)
             )
 
-        # save model checkpoints
-        checkpoint = {
-            "epoch": epoch,
-            "model": model,
-            "optimizer": optimizer.state_dict(),
-            "lr_scheduler": lr_scheduler.state_dict(),
-        }
-
         # Save a different checkpoint for every epoch.
-        torch.save(checkpoint, os.path.join(checkpoint_dir, f"{epoch}_checkpoint.pth"))
+        save_checkpoint(epoch, f"{epoch}_checkpoint.pth", test_loss=test_stats["loss"])
+
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
+        # Only the weights and config, for downstream jobs to load with checkpoint.load_model.
+        save_model(model, config, os.path.join(checkpoint_dir, "model.safetensors"))
 
     return model
+
+
+def get_training_state(
+    config,
+    epoch,
+    model,
+    optimizer,
+    lr_scheduler,
+    accelerator,
+    train_dl=None,
+    batch=None,
+):
+    """Collect the state to save in a checkpoint to continue training from.
+
+    Args:
+        config: experiment config, saved with the model so checkpoint.load_model can recreate it.
+        epoch: current epoch.
+        model: model being trained.
+        optimizer: optimizer, a sharded optimizer's state has to be consolidated on this process.
+        lr_scheduler: lr scheduler.
+        accelerator: accelerator whose gradient scaler to save.
+        train_dl: data loader of the training split, see batch.
+        batch: number of batches trained on in epoch for a checkpoint in the middle of an epoch, together with the
+            streaming position of train_dl. None at the end of an epoch.
+
+    Returns:
+        dict to save, see resume_training.
+    """
+    state = {
+        "config": config_to_string(config),
+        "epoch": epoch,
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "lr_scheduler": lr_scheduler.state_dict(),
+        "rng": get_rng_state(),
+    }
+    if accelerator.scaler is not None:
+        state["scaler"] = accelerator.scaler.state_dict()
+    if batch is not None:
+        state["batch"] = batch
+        state["data"] = train_dl.dataset.state_dict()
+    return state
+
+
+def resume_training(
+    checkpoint_dir, model, optimizer, lr_scheduler, accelerator, train_dl=None
+):
+    """Restore the training state from the latest checkpoint in checkpoint_dir.
+
+    Args:
+        checkpoint_dir: directory of the job's checkpoints.
+        model: model to load the parameters into, already on the training device.
+        optimizer: optimizer to restore.
+        lr_scheduler: lr scheduler to restore.
+        accelerator: accelerator whose gradient scaler to restore.
+        train_dl: data loader of the training split to continue from the checkpoint's sample, for checkpoints saved
+            in the middle of an epoch.
+
+    Returns:
+        (epoch, batch) to continue training from, (0, 0) if there is no checkpoint.
+    """
+    path = latest_checkpoint(checkpoint_dir)
+    if path is None:
+        logger.warning(f"No checkpoint to resume from in {checkpoint_dir}.")
+        return 0, 0
+
+    checkpoint = load_checkpoint(path)
+    model.load_state_dict(checkpoint["model"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+    if accelerator.scaler is not None and "scaler" in checkpoint:
+        accelerator.scaler.load_state_dict(checkpoint["scaler"])
+    set_rng_state(checkpoint["rng"])
+    logger.info(f"Resuming training from {path}.")
+
+    if "batch" in checkpoint:
+        train_dl.dataset.load_state_dict(checkpoint["data"])
+        return checkpoint["epoch"], checkpoint["batch"]
+    return checkpoint["epoch"] + 1, 0
@@ -9,6 +9,30 @@ from typing import Optional
 from config import ViTConfig
 import constants
 
+# Torch dtypes for the precisions supported in TrainerConfig.precision.
+PRECISION_DTYPES = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+
+def get_autocast(device, dtype):
+    """Get an autocast context for running a model in dtype on device, autocast is disabled for float32.
+
+    Args:
+        device: device (or its name) the model runs on, i.e. "cuda:0" or "cpu".
+        dtype: torch dtype to autocast to, see PRECISION_DTYPES.
+
+    Returns:
+        torch.autocast context manager.
+    """
+    return torch.autocast(
+        device_type=torch.device(device).type,
+        dtype=dtype,
+        enabled=dtype != torch.float32,
+    )
+
 
 def seed_everything(seed=0, cudnn_deterministic=True):
     random.seed(seed)
@@ -19,7 +43,45 @@ def seed_everything(seed=0, cudnn_deterministic=True):
     torch.cuda.manual_seed_all(seed)
 
 
+def get_rng_state():
+    """Get the state of all random number generators seeded by seed_everything, to restore with set_rng_state.
+
+    The state only holds tensors and builtin types, so checkpoints holding it can be loaded with weights_only.
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {
+        "python": random.getstate(),
+        "numpy": (
+            name,
+            torch.from_numpy(keys.astype(np.int64)),
+            pos,
+            has_gauss,
+            cached_gaussian,
+        ),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Restore the random number generators to a state returned from get_rng_state."""
+    random.setstate(state["python"])
+    name, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    np.random.set_state(
+        (name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian)
+    )
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
 def patchify(imgs, patch_size, frame_patch_size):
+    """
+    imgs: (N, C, T, H, W)
+    x: (N, t * h * w, frame_patch_size * ph * pw * C)
+    """
     N, C, T, H, W = imgs.shape
     ph, pw = patch_size
     assert H % ph == 0 and W % pw == 0 and T % frame_patch_size == 0
@@ -27,13 +89,18 @@ def patchify(imgs, patch_size, frame_patch_size):
     w = W // pw
     t = T // frame_patch_size
 
-    x = imgs.reshape(shape=(N, C, t, frame_patch_size, h, ph, w, pw))
-    x = torch.einsum("nctuhpwq->nthwupqc", x)
-    x = x.reshape(shape=(N, t * h * w, frame_patch_size * ph * pw * C))
+    x = imgs.reshape(N, C, t, frame_patch_size, h, ph, w, pw)
+    # n c t u h p w q -> n t h w u p q c
+    x = x.permute(0, 2, 4, 6, 3, 5, 7, 1)
+    x = x.reshape(N, t * h * w, frame_patch_size * ph * pw * C)
     return x
 
 
 def unpatchify(x, patch_size, frame_patch_size, grid_size):
+    """
+    x: (N, t * h * w, frame_patch_size * ph * pw * C)
+    imgs: (N, C, T, H, W)
+    """
     N, L, D = x.shape
 
     ph, pw = patch_size
@@ -41,11 +108,11 @@ def unpatchify(x, patch_size, frame_patch_size, grid_size):
     t = L // h // w
     C = D // frame_patch_size // ph // pw
 
-    x = x.reshape(shape=(N, t, h, w, frame_patch_size, ph, pw, C))
-
-    x = torch.einsum("nthwupqc->nctuhpwq", x)
+    x = x.reshape(N, t, h, w, frame_patch_size, ph, pw, C)
+    # n t h w u p q c -> n c t u h p w q
+    x = x.permute(0, 7, 1, 4, 2, 5, 3, 6)
     T, H, W = t * frame_patch_size, h * ph, w * pw
-    imgs = x.reshape(shape=(N, C, T, H, W))
+    imgs = x.reshape(N, C, T, H, W)
     return imgs
 
 
@@ -368,28 +435,32 @@ def overwrite_model_padding_mask(model, padding_mask, using_padding_mask):
 def get_signal_correlations(signal_a, signal_b):
     """Get correlation coefficients between channels of signal_a and signal_b averaged over batch.
 
+    All correlations are computed at once from per-channel sums. Observations which are nan in either signal are
+    left out, so electrodes padded with nan in some samples are averaged over the remaining samples.
+
     Args:
         signal_a (tensor): shape [batch, num_electrodes, channels, observations]
         signal_b (tensor): shape [batch, num_electrodes, channels, observations]
 
     Returns:
         tensor of shape [num_electrodes, channels] where each entry is the correlation found between
-        the two signals for that electrode and channel.
+        the two signals for that electrode and channel. nan if the electrode is padded (or constant) in every sample.
     """
-    correlation_matrix = torch.zeros(
-        signal_a.shape[0], signal_a.shape[1], signal_a.shape[2]
-    ).fill_(torch.nan)
-
-    for batch in range(signal_a.shape[0]):
-        for electrode in range(signal_a.shape[1]):
-            for channel in range(signal_a.shape[2]):
-                correlation_matrix[batch, electrode, channel] = torch.corrcoef(
-                    torch.stack(
-                        [
-                            signal_a[batch, electrode, channel],
-                            signal_b[batch, electrode, channel],
-                        ]
-                    )
-                )[0, 1]
-
-    return correlation_matrix.mean(dim=0)
+    valid = ~(torch.isnan(signal_a) | torch.isnan(signal_b))
+    count = valid.sum(dim=-1, keepdim=True)
+    signal_a = torch.where(valid, signal_a, 0.0)
+    signal_b = torch.where(valid, signal_b, 0.0)
+    # Centered on the mean of the valid observations, the others stay 0.
+    signal_a = torch.where(
+        valid, signal_a - signal_a.sum(-1, keepdim=True) / count, 0.0
+    )
+    signal_b = torch.where(
+        valid, signal_b - signal_b.sum(-1, keepdim=True) / count, 0.0
+    )
+
+    covariance = (signal_a * signal_b).sum(dim=-1)
+    variance = (signal_a**2).sum(dim=-1) * (signal_b**2).sum(dim=-1)
+    # Same clipping as torch.corrcoef, 0 / 0 stays nan for padded and constant channels.
+    correlation = (covariance / variance.sqrt()).clamp(-1, 1)
+
+    return correlation.nanmean(dim=0)
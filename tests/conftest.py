@@ -4,8 +4,16 @@ import numpy as np
 import mne
 import pytest
 
-from config import ECoGDataConfig
+import constants
+from config import ECoGDataConfig, VideoMAEExperimentConfig
 from loader import ECoGDataset
+from mae_st_util.models_mae import MaskedAutoencoderViT
+
+
+@pytest.fixture(autouse=True)
+def loader_cache_file(tmp_path, monkeypatch):
+    """Keeps the datasets' cache of file lengths in tmp_path instead of the working directory."""
+    monkeypatch.setattr(ECoGDataset, "CACHE_FILE", str(tmp_path / ECoGDataset.CACHE_FILE))
 
 @pytest.fixture
 def create_fake_mne_file_fn(tmp_path):
@@ -48,3 +56,54 @@ def data_loader_creation_fn(create_fake_mne_file_fn):
         return ECoGDataset(fake_mne_file, config)
 
     return get_data_loader
+
+
+@pytest.fixture
+def small_config():
+    """Experiment config of a small model on one second samples at 8 Hz, for tests building the model from a config."""
+    config = VideoMAEExperimentConfig(job_name="test")
+    config.ecog_data_config.sample_length = 1
+    config.ecog_data_config.new_fs = 8
+    config.video_mae_task_config.encoder_mask_ratio = 0.5
+    vit_config = config.video_mae_task_config.vit_config
+    vit_config.dim = 16
+    vit_config.decoder_embed_dim = 8
+    vit_config.depth = 1
+    vit_config.decoder_depth = 1
+    vit_config.num_heads = 2
+    vit_config.decoder_num_heads = 1
+    vit_config.patch_size = 2
+    vit_config.frame_patch_size = 4
+    return config
+
+
+@pytest.fixture
+def model_creation_fn():
+    def create_model(**kwargs):
+        """Creates a small model for 40 frames of 5 bands, keyword arguments override the defaults."""
+        model_kwargs = dict(
+            img_size=constants.GRID_SIZE,
+            patch_size=1,
+            in_chans=5,
+            norm_pix_loss=False,
+            num_frames=40,
+            t_patch_size=4,
+            cls_embed=False,
+            pred_t_dim=10,
+            embed_dim=64,
+            depth=2,
+            num_heads=2,
+            decoder_embed_dim=32,
+            decoder_depth=1,
+            decoder_num_heads=1,
+            mlp_ratio=2.0,
+        )
+        model_kwargs.update(kwargs)
+        return MaskedAutoencoderViT(**model_kwargs)
+
+    return create_model
+
+
+@pytest.fixture
+def model(model_creation_fn):
+    return model_creation_fn()
@@ -1,6 +1,16 @@
+import pytest
+import torch
+
+import constants
 from config import ECoGDataConfig
-from downstream_tasks.encoding_decoding.utils import merge_data_configs
+from downstream_tasks.encoding_decoding.utils import (
+    generate_embedding_dataset,
+    get_correlation_metrics,
+    merge_data_configs,
+    quantize_model,
+)
 from downstream_tasks.encoding_decoding.config import EncodingDecodingDataConfig
+from mae_st_util.models_mae import MaskedAutoencoderViT
 
 
 def test_merge_data_configs_correctly_sets_ecog_config_values():
@@ -47,3 +57,48 @@ def test_merge_data_configs_correctly_sets_ecog_config_values():
     )
 
     assert final_config == expected_final_config
+
+
+def test_quantized_model_embeddings_match_fp32_embeddings():
+    torch.manual_seed(0)
+    model = MaskedAutoencoderViT(
+        img_size=constants.GRID_SIZE,
+        patch_size=1,
+        in_chans=5,
+        num_frames=40,
+        t_patch_size=4,
+        pred_t_dim=10,
+        embed_dim=64,
+        depth=2,
+        num_heads=2,
+        decoder_embed_dim=32,
+        decoder_depth=1,
+        decoder_num_heads=1,
+    )
+    model.eval()
+    neural_data = 1e-6 * torch.randn(8, 5, 40, constants.GRID_SIZE, constants.GRID_SIZE)
+
+    quantized_model = quantize_model(model)
+    with torch.no_grad():
+        embeddings = model(neural_data, forward_features=True).numpy()
+        quantized_embeddings = quantized_model(
+            neural_data, forward_features=True
+        ).numpy()
+
+    metrics = get_correlation_metrics(embeddings, quantized_embeddings)
+    assert metrics["overall_correlation"] > 0.99
+    assert metrics["mean_embedding_correlation"] > 0.99
+    # The fp32 model is left unchanged.
+    assert type(model.blocks[0].attn.q) is torch.nn.Linear
+    assert type(quantized_model.blocks[0].attn.q) is not torch.nn.Linear
+
+
+def test_generate_embedding_dataset_rejects_int8_off_cpu():
+    with pytest.raises(ValueError, match="int8"):
+        generate_embedding_dataset(
+            dataset=None,
+            model=None,
+            embedding_batch_size=1,
+            device="cuda",
+            precision="int8",
+        )
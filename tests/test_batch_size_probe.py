@@ -0,0 +1,93 @@
+import itertools
+import json
+
+import pytest
+import torch
+
+import batch_size_probe
+import constants
+from batch_size_probe import get_input_shape, probe_batch_sizes
+
+
+def test_probe_batch_sizes_reports_and_caches_results(tmp_path, mocker, small_config):
+    config = small_config
+    cache_file = str(tmp_path / "cache.json")
+
+    probe = probe_batch_sizes(
+        config, "cpu", batch_sizes=[1, 2], num_steps=1, cache_file=cache_file
+    )
+
+    assert probe["max_batch_size"] == 2
+    assert [result["batch_size"] for result in probe["results"]] == [1, 2]
+    assert all(result["samples_per_second"] > 0 for result in probe["results"])
+    assert all(result["peak_memory"] > 0 for result in probe["results"])
+    with open(cache_file) as f:
+        assert list(json.load(f).values()) == [probe]
+
+    # Settings not affecting the model reuse the cached results without probing.
+    create_model = mocker.patch.object(batch_size_probe, "create_model")
+    config.trainer_config.max_learning_rate = 1.0
+    assert (
+        probe_batch_sizes(
+            config, "cpu", batch_sizes=[1, 2], num_steps=1, cache_file=cache_file
+        )
+        == probe
+    )
+    create_model.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        torch.cuda.OutOfMemoryError(),
+        RuntimeError(
+            "DefaultCPUAllocator: can't allocate memory: you tried to allocate 1 bytes."
+        ),
+    ],
+)
+def test_probe_batch_sizes_stops_at_out_of_memory(mocker, error, small_config):
+    config = small_config
+    measure = batch_size_probe._measure_batch_size
+
+    def out_of_memory_above_two(model, optimizer, config, device, batch_size, steps):
+        if batch_size > 2:
+            raise error
+        return measure(model, optimizer, config, device, batch_size, steps)
+
+    mocker.patch.object(
+        batch_size_probe, "_measure_batch_size", side_effect=out_of_memory_above_two
+    )
+
+    probe = probe_batch_sizes(config, "cpu", num_steps=1, train=False, cache_file=None)
+
+    assert probe["max_batch_size"] == 2
+    assert len(probe["results"]) == 2
+
+
+def test_probe_batch_sizes_stops_before_running_out_of_cpu_memory(mocker, small_config):
+    config = small_config
+    mocker.patch.object(
+        batch_size_probe, "_get_peak_rss", side_effect=itertools.count(100, 100)
+    )
+    mocker.patch.object(
+        batch_size_probe.psutil,
+        "virtual_memory",
+        return_value=mocker.Mock(available=200),
+    )
+
+    probe = probe_batch_sizes(config, "cpu", num_steps=1, train=False, cache_file=None)
+
+    # Peak memory grows by 100 with every batch size and the limit is 100 + 200 / 2.
+    assert probe["max_batch_size"] == 2
+    assert [result["peak_memory"] for result in probe["results"]] == [200, 300]
+
+
+def test_get_input_shape(small_config):
+    config = small_config
+    assert get_input_shape(config, 3) == (
+        3,
+        len(config.ecog_data_config.bands),
+        8,
+        8,
+        8,
+    )
@@ -0,0 +1,168 @@
+import os
+import random
+
+from accelerate import Accelerator
+import numpy as np
+import pytest
+import torch
+
+from checkpoint import (
+    AsyncCheckpointWriter,
+    latest_checkpoint,
+    load_model,
+    load_model_config,
+    read_manifest,
+    save_model,
+)
+from config import VideoMAEExperimentConfig
+from ecog_setup import create_model
+from train import get_training_state, resume_training
+from utils import get_rng_state
+
+
+def test_async_checkpoint_writer_keeps_last_and_best_checkpoints(tmp_path):
+    writer = AsyncCheckpointWriter(str(tmp_path), num_checkpoints=2)
+    tensor = torch.arange(4.0)
+
+    for epoch, test_loss in enumerate([3.0, 1.0, 2.0, 4.0]):
+        writer.save(
+            {"epoch": epoch, "tensor": tensor, "nested": [{"tensor": tensor}]},
+            f"{epoch}_checkpoint.pth",
+            test_loss=test_loss,
+        )
+        # Training continues to update tensors while the checkpoint is written.
+        tensor.add_(1.0)
+    writer.close()
+
+    assert sorted(os.listdir(tmp_path)) == [
+        "1_checkpoint.pth",
+        "2_checkpoint.pth",
+        "3_checkpoint.pth",
+        "checkpoints.json",
+    ]
+    manifest = read_manifest(str(tmp_path))
+    assert manifest["best"] == {"name": "1_checkpoint.pth", "test_loss": 1.0}
+    assert latest_checkpoint(str(tmp_path)) == str(tmp_path / "3_checkpoint.pth")
+    checkpoint = torch.load(tmp_path / "1_checkpoint.pth", weights_only=True)
+    assert checkpoint["epoch"] == 1
+    assert torch.equal(checkpoint["tensor"], torch.arange(4.0) + 1.0)
+    assert torch.equal(checkpoint["nested"][0]["tensor"], torch.arange(4.0) + 1.0)
+
+
+def test_resume_training_restores_state(tmp_path, small_config):
+    small_config.video_mae_task_config.pct_masks_to_decode = 1.0
+    model = create_model(small_config)
+    # Masks of the last batch aren't part of the checkpoint, the resumed model has none set.
+    padding_mask = torch.ones(8, 8, dtype=torch.bool)
+    padding_mask[0, 0:2] = False
+    model.initialize_mask(padding_mask)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1.0)
+    lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=1, gamma=0.5)
+    signal = torch.randn(2, len(small_config.ecog_data_config.bands), 8, 8, 8)
+    model(signal, mask_ratio=0.5)[0].backward()
+    optimizer.step()
+    lr_scheduler.step()
+
+    writer = AsyncCheckpointWriter(str(tmp_path))
+    writer.save(
+        get_training_state(
+            small_config, 4, model, optimizer, lr_scheduler, Accelerator(cpu=True)
+        ),
+        "4_checkpoint.pth",
+    )
+    writer.close()
+    expected = (random.random(), np.random.rand(), torch.rand(1))
+
+    resumed_model = create_model(small_config)
+    resumed_optimizer = torch.optim.AdamW(resumed_model.parameters(), lr=1.0)
+    resumed_lr_scheduler = torch.optim.lr_scheduler.StepLR(
+        resumed_optimizer, step_size=1, gamma=0.5
+    )
+    start = resume_training(
+        str(tmp_path),
+        resumed_model,
+        resumed_optimizer,
+        resumed_lr_scheduler,
+        Accelerator(cpu=True),
+    )
+
+    assert start == (5, 0)
+    for param, resumed_param in zip(model.parameters(), resumed_model.parameters()):
+        assert torch.equal(param, resumed_param)
+    assert resumed_optimizer.state_dict()["state"][0]["step"] == 1
+    assert resumed_optimizer.param_groups[0]["lr"] == 0.5
+    assert (random.random(), np.random.rand(), torch.rand(1)) == expected
+
+
+def test_resume_training_without_checkpoint_starts_at_first_epoch(tmp_path):
+    model = torch.nn.Linear(2, 2)
+    optimizer = torch.optim.AdamW(model.parameters())
+    lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=1)
+
+    assert resume_training(
+        str(tmp_path), model, optimizer, lr_scheduler, Accelerator(cpu=True)
+    ) == (0, 0)
+
+
+def test_resume_training_continues_step_checkpoint_from_same_sample(tmp_path, mocker):
+    model = torch.nn.Linear(2, 2)
+    optimizer = torch.optim.AdamW(model.parameters())
+    lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=1)
+    train_dl = mocker.Mock()
+    train_dl.dataset.state_dict.return_value = {"file_index": 2, "sample_index": 7}
+
+    writer = AsyncCheckpointWriter(str(tmp_path))
+    writer.save(
+        get_training_state(
+            VideoMAEExperimentConfig(job_name="test"),
+            3,
+            model,
+            optimizer,
+            lr_scheduler,
+            Accelerator(cpu=True),
+            train_dl,
+            batch=12,
+        ),
+        "3_12_checkpoint.pth",
+    )
+    writer.close()
+
+    resumed_train_dl = mocker.Mock()
+    start = resume_training(
+        str(tmp_path),
+        model,
+        optimizer,
+        lr_scheduler,
+        Accelerator(cpu=True),
+        resumed_train_dl,
+    )
+
+    assert start == (3, 12)
+    resumed_train_dl.dataset.load_state_dict.assert_called_once_with(
+        {"file_index": 2, "sample_index": 7}
+    )
+
+
+@pytest.mark.parametrize("file_name", ["model.pth", "model.safetensors"])
+def test_load_model_recreates_saved_model(tmp_path, small_config, file_name):
+    config = small_config
+    config.ecog_data_config.dataset_path = "dataset"
+    model = create_model(config).eval()
+    # Masks of the last batch aren't part of the saved model.
+    model.initialize_mask(torch.ones(8, 8, dtype=torch.bool))
+    path = str(tmp_path / file_name)
+
+    save_model(model, config, path)
+    loaded_model = load_model(path)
+
+    assert load_model_config(path) == config
+    assert not loaded_model.training
+    assert loaded_model.state_dict().keys() == model.state_dict().keys()
+    for key, value in model.state_dict().items():
+        assert torch.equal(loaded_model.state_dict()[key], value)
+    signal = torch.randn(2, len(config.ecog_data_config.bands), 8, 8, 8)
+    with torch.no_grad():
+        assert torch.allclose(
+            loaded_model(signal, forward_features=True),
+            model(signal, forward_features=True),
+        )
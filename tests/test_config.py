@@ -4,8 +4,10 @@ import os
 import pytest
 
 from config import (
+    config_to_string,
     create_video_mae_experiment_config,
     create_video_mae_experiment_config_from_file,
+    create_video_mae_experiment_config_from_string,
     VideoMAEExperimentConfig,
     VideoMAETaskConfig,
     ViTConfig,
@@ -31,10 +33,15 @@ CONFIG_VALUES = {
         "sep_pos_embed": False,
         "trunc_init": False,
         "no_qkv_bias": False,
+        "pack_tokens": False,
+        "use_rope": False,
     },
     "VideoMAETaskConfig": {
         "encoder_mask_ratio": 0.75,
         "pct_masks_to_decode": 1.0,
+        "mask_strategy": "random",
+        "running_cell_masking": False,
+        "num_masks_per_sample": 1,
         "alpha": 0.5,
     },
     "ECoGDataConfig": {
@@ -58,6 +65,17 @@ CONFIG_VALUES = {
     "TrainerConfig": {
         "max_learning_rate": 0.0,
         "num_epochs": 10,
+        "compile_model": False,
+        "precision": "fp32",
+        "gradient_accumulation_steps": 1,
+        "micro_batch_size": 0,
+        "auto_micro_batch_size": False,
+        "weight_decay": 0.05,
+        "optimizer_implementation": "fused",
+        "shard_optimizer_state": False,
+        "num_checkpoints": 3,
+        "resume": False,
+        "checkpoint_interval_minutes": 30.0,
     },
 }
 
@@ -141,9 +159,14 @@ def test_command_line_args_overwrite_config(mocker, fake_config_path):
         "sep_pos_embed": True,
         "trunc_init": True,
         "no_qkv_bias": True,
+        "pack_tokens": True,
+        "use_rope": True,
         # VideoMAETaskConfig parameters
         "encoder_mask_ratio": 0.73,
         "pct_masks_to_decode": 0.02,
+        "mask_strategy": "tube",
+        "running_cell_masking": True,
+        "num_masks_per_sample": 2,
         "alpha": 0.75,
         # ECoGDataConfig parameters
         "data_size": 0.98,
@@ -160,6 +183,17 @@ def test_command_line_args_overwrite_config(mocker, fake_config_path):
         # TrainerConfig parameters
         "max_learning_rate": 0.001,
         "num_epochs": 11,
+        "compile_model": True,
+        "precision": "bf16",
+        "gradient_accumulation_steps": 4,
+        "micro_batch_size": 16,
+        "auto_micro_batch_size": True,
+        "weight_decay": 0.1,
+        "optimizer_implementation": "fused",
+        "shard_optimizer_state": True,
+        "num_checkpoints": 5,
+        "resume": True,
+        "checkpoint_interval_minutes": 45.0,
         # LoggingConfig parameters
         "event_log_dir": "new_dir/",
         "print_freq": 100,
@@ -236,9 +270,14 @@ def test_write_config_file(mocker, tmp_path):
                 sep_pos_embed=False,
                 trunc_init=True,
                 no_qkv_bias=True,
+                pack_tokens=True,
+                use_rope=True,
             ),
             encoder_mask_ratio=0.75,
             pct_masks_to_decode=0.25,
+            mask_strategy="tube",
+            running_cell_masking=True,
+            num_masks_per_sample=4,
             alpha=0.5,
         ),
         ecog_data_config=ECoGDataConfig(
@@ -254,7 +293,21 @@ def test_write_config_file(mocker, tmp_path):
             shuffle=True,
             test_loader=True,
         ),
-        trainer_config=TrainerConfig(max_learning_rate=1e-4, num_epochs=50),
+        trainer_config=TrainerConfig(
+            max_learning_rate=1e-4,
+            num_epochs=50,
+            compile_model=True,
+            precision="fp16",
+            gradient_accumulation_steps=2,
+            micro_batch_size=32,
+            auto_micro_batch_size=True,
+            weight_decay=0.0,
+            optimizer_implementation="for_loop",
+            shard_optimizer_state=True,
+            num_checkpoints=2,
+            resume=True,
+            checkpoint_interval_minutes=10.0,
+        ),
         logging_config=LoggingConfig(
             event_log_dir="custom_logs/", print_freq=50, plot_dir="custom_plots/"
         ),
@@ -290,3 +343,14 @@ def test_write_config_file(mocker, tmp_path):
 
     # Clean up the temporary file
     os.unlink(tmp_file_path)
+
+
+def test_config_to_string_round_trips(fake_config_path):
+    experiment_config = create_video_mae_experiment_config_from_file(fake_config_path)
+
+    assert (
+        create_video_mae_experiment_config_from_string(
+            config_to_string(experiment_config)
+        )
+        == experiment_config
+    )
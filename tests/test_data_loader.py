@@ -1,6 +1,10 @@
+import os
+
 import numpy as np
+import torch
 
 from config import ECoGDataConfig
+from loader import ECoGDataset, ResumableChainDataset
 
 
 NUM_CHANNELS = 64
@@ -94,3 +98,38 @@ def test_data_loader_resets_from_beginning_of_dataset(data_loader_creation_fn):
         
     # Make sure it actually iterated a second time.
     assert i > 0
+
+
+def test_resumable_chain_dataset_continues_from_saved_position(create_fake_mne_file_fn, tmp_path):
+    config = ECoGDataConfig(
+        batch_size=3, bands=[[4, 8], [8, 13]], new_fs=20, sample_length=10, original_fs=FILE_SAMPLING_FREQUENCY
+    )
+    ch_names = ["G" + str(i + 1) for i in range(NUM_CHANNELS + 1)]
+    # The fake file is always written to the same path, so move the first one before creating the second.
+    first_path = os.path.join(tmp_path, "first_raw.fif")
+    os.rename(create_fake_mne_file_fn(ch_names, create_fake_sin_data(), FILE_SAMPLING_FREQUENCY), first_path)
+    second_path = create_fake_mne_file_fn(ch_names, 2 * create_fake_sin_data(), FILE_SAMPLING_FREQUENCY)
+
+    def create_data_loader():
+        dataset = ResumableChainDataset([ECoGDataset(first_path, config), ECoGDataset(second_path, config)])
+        return torch.utils.data.DataLoader(dataset, batch_size=config.batch_size)
+
+    all_batches = list(create_data_loader())
+
+    # Stop in the middle of an epoch and save the position.
+    data_loader = create_data_loader()
+    for i, batch in enumerate(data_loader):
+        if i == 4:
+            break
+    state = data_loader.dataset.state_dict()
+    assert state == {"file_index": 1, "sample_index": 5}
+
+    resumed_data_loader = create_data_loader()
+    resumed_data_loader.dataset.load_state_dict(state)
+    resumed_batches = list(resumed_data_loader)
+    assert len(resumed_batches) == len(all_batches) - 5
+    for resumed_batch, batch in zip(resumed_batches, all_batches[5:]):
+        assert torch.equal(resumed_batch, batch)
+
+    # The next epoch starts from the beginning again.
+    assert len(list(resumed_data_loader)) == len(all_batches)
@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+from ecog_setup import create_model, create_optimizer, get_parameter_groups
+
+
+def test_get_parameter_groups_decays_only_layer_weights(small_config):
+    model = create_model(small_config)
+
+    decay, no_decay = get_parameter_groups(model, 0.1)
+
+    assert decay["weight_decay"] == 0.1
+    assert no_decay["weight_decay"] == 0.0
+    names = {param: name for name, param in model.named_parameters()}
+    decay_names = {names[param] for param in decay["params"]}
+    no_decay_names = {names[param] for param in no_decay["params"]}
+    assert decay_names.isdisjoint(no_decay_names)
+    assert decay_names | no_decay_names == {
+        name for name, param in model.named_parameters() if param.requires_grad
+    }
+    assert "blocks.0.attn.q.weight" in decay_names
+    assert "blocks.0.mlp.fc1.weight" in decay_names
+    assert "patch_embed.proj.weight" in decay_names
+    assert "blocks.0.norm1.weight" in no_decay_names
+    assert "blocks.0.norm2.bias" in no_decay_names
+    assert "blocks.0.mlp.fc1.bias" in no_decay_names
+    assert "mask_token" in no_decay_names
+
+
+@pytest.mark.parametrize("implementation", ["for_loop", "foreach", "fused"])
+def test_create_optimizer_steps_with_implementation(small_config, implementation):
+    small_config.trainer_config.optimizer_implementation = implementation
+    small_config.trainer_config.max_learning_rate = 0.1
+    model = create_model(small_config)
+    optimizer = create_optimizer(model, small_config)
+
+    for group in optimizer.param_groups:
+        assert group["foreach"] == (implementation == "foreach")
+        assert group["fused"] == (implementation == "fused")
+    param = model.blocks[0].mlp.fc1.weight
+    before = param.detach().clone()
+    param.grad = torch.ones_like(param)
+    optimizer.step()
+    assert not torch.equal(before, param.detach())
@@ -0,0 +1,63 @@
+import pytest
+import torch
+
+import constants
+from mae_st_util.encoder import export_encoder, load_encoder
+from mae_st_util.models_mae import MaskedAutoencoderViT
+
+FRAMES_PER_SAMPLE = 40
+NUM_BANDS = 5
+FRAME_PATCH_SIZE = 4
+
+
+@pytest.mark.parametrize(
+    "model_kwargs",
+    [
+        {"sep_pos_embed": True, "cls_embed": False},
+        {"sep_pos_embed": False, "cls_embed": True},
+        {"use_rope": True, "cls_embed": True},
+    ],
+)
+def test_exported_encoder_matches_forward_features(tmp_path, model_kwargs):
+    model = MaskedAutoencoderViT(
+        img_size=constants.GRID_SIZE,
+        patch_size=2,
+        in_chans=NUM_BANDS,
+        num_frames=FRAMES_PER_SAMPLE,
+        t_patch_size=FRAME_PATCH_SIZE,
+        pred_t_dim=FRAMES_PER_SAMPLE // FRAME_PATCH_SIZE,
+        embed_dim=64,
+        depth=2,
+        num_heads=2,
+        decoder_embed_dim=32,
+        decoder_depth=2,
+        decoder_num_heads=1,
+        **model_kwargs,
+    )
+    model.eval()
+    padding_mask = torch.ones(
+        constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[0, 0:2] = False
+    padding_mask[4, 3] = False
+    path = tmp_path / "encoder.pth"
+
+    export_encoder(model, path, padding_mask=padding_mask)
+    encoder = load_encoder(path)
+
+    fake_batch = 1e-6 * torch.randn(
+        2, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    longer_batch = torch.cat((fake_batch, fake_batch), dim=2)
+    with torch.no_grad():
+        for batch in [fake_batch, longer_batch]:
+            for kwargs in [{}, {"global_pool": False}, {"per_frame": True}]:
+                expected = model.forward_features(
+                    model.patch_embed(model.forward_input_norm(batch)), **kwargs
+                )
+                assert torch.allclose(encoder(batch, **kwargs), expected, atol=1e-5)
+
+    assert not any("decoder" in key for key in encoder.state_dict())
+    assert sum(p.numel() for p in encoder.parameters()) < sum(
+        p.numel() for p in model.parameters()
+    )
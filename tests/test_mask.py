@@ -1,7 +1,16 @@
 from einops.layers.torch import Rearrange
 import torch
 
-from mask import get_padding_mask, get_tube_mask, get_decoder_mask
+from mask import (
+    get_padding_mask,
+    get_tube_mask,
+    get_decoder_mask,
+    padding_mask_key,
+    PatchMaskCache,
+    get_running_cell_mask,
+    keep_mask_ids,
+    sample_keep_ids,
+)
 
 
 def test_get_padding_mask():
@@ -18,3 +27,151 @@ def test_get_padding_mask():
     assert torch.all(actual_padding_mask == torch.tensor([[False, False, True],
                                                           [False, False, False],
                                                           [True, True, True]]))
+
+
+def test_padding_mask_key_packs_electrodes_into_bits():
+    padding_mask = torch.zeros(8, 8, dtype=torch.bool)
+    padding_mask[0, 0] = True
+    padding_mask[7, 7] = True
+
+    # Electrode 63 is the sign bit of the 64 bit word.
+    assert padding_mask_key(padding_mask) == (1 - (1 << 63),)
+
+    other_mask = padding_mask.clone()
+    other_mask[3, 4] = True
+    batch_keys = padding_mask_key(
+        torch.stack([padding_mask, other_mask, padding_mask])
+    )
+    assert batch_keys[0] == batch_keys[2] == padding_mask_key(padding_mask)
+    assert batch_keys[1] != batch_keys[0]
+
+
+def test_patch_mask_cache_evicts_least_recently_used():
+    cache = PatchMaskCache(max_size=2)
+    build_calls = []
+
+    def build(value):
+        build_calls.append(value)
+        return value
+
+    assert cache.get("a", lambda: build(1)) == 1
+    assert cache.get("b", lambda: build(2)) == 2
+    # Hit moves "a" to most recently used, so "b" is evicted next.
+    assert cache.get("a", lambda: build(3)) == 1
+    cache.get("c", lambda: build(4))
+
+    assert build_calls == [1, 2, 4]
+    assert "a" in cache and "c" in cache and "b" not in cache
+
+
+def test_get_padding_mask_per_sample():
+    fake_signal = torch.ones(2, 3, 4, 8, 8)
+    fake_signal[0, :, :, 0, 0] = torch.nan
+    fake_signal[1, 1, 2, 3, 3] = torch.nan
+
+    padding_mask = get_padding_mask(fake_signal, "cpu", per_sample=True)
+
+    expected_padding_mask = torch.ones(
+        2, 8, 8, dtype=torch.bool
+    )
+    expected_padding_mask[0, 0, 0] = False
+    expected_padding_mask[1, 3, 3] = False
+    assert torch.equal(padding_mask, expected_padding_mask)
+
+
+def test_sample_keep_ids_keeps_smallest_valid_noise_first():
+    generator = torch.Generator().manual_seed(0)
+    noise = torch.rand(3, 20, generator=generator)
+    valid = torch.ones(3, 20, dtype=torch.bool)
+    valid[1, :5] = False
+
+    ids_keep, ids_restore = sample_keep_ids(noise, 6, valid)
+
+    # Kept tokens match sorting the noise with missing tokens shifted to the end.
+    ids_shuffle = torch.argsort(noise + (~valid).float(), dim=1)
+    assert torch.equal(ids_keep, ids_shuffle[:, :6])
+    # ids_restore is a permutation putting kept tokens first and missing tokens last.
+    assert torch.equal(
+        ids_restore.sort(dim=1).values, torch.arange(20).expand(3, 20)
+    )
+    assert torch.equal(
+        torch.gather(ids_restore, 1, ids_keep), torch.arange(6).expand(3, 6)
+    )
+    assert (ids_restore[1, :5] >= 15).all()
+
+
+def test_get_tube_mask_keeps_same_patches_in_every_frame():
+    patch_mask = torch.ones(3, 16, dtype=torch.bool)
+    patch_mask[1, :4] = False
+    generator = torch.Generator().manual_seed(0)
+
+    tube_mask = get_tube_mask(0.5, 5, patch_mask, "cpu", generator)
+
+    assert tube_mask.shape == (3, 5 * 16)
+    tube_mask = tube_mask.view(3, 5, 16)
+    assert (tube_mask == tube_mask[:, :1]).all()
+    assert tube_mask[:, 0].sum(dim=1).tolist() == [8, 6, 8]
+    assert not tube_mask[1, :, :4].any()
+    assert torch.equal(
+        tube_mask.view(3, -1),
+        get_tube_mask(0.5, 5, patch_mask, "cpu", generator.manual_seed(0)),
+    )
+
+
+def test_keep_mask_ids_orders_kept_tokens_frame_by_frame():
+    patch_mask = torch.ones(2, 16, dtype=torch.bool)
+    patch_mask[1, :4] = False
+    tube_mask = get_tube_mask(0.75, 3, patch_mask, "cpu")
+    valid = patch_mask.repeat(1, 3)
+
+    ids_keep, ids_restore = keep_mask_ids(tube_mask, 12, valid)
+
+    frames = ids_keep[0].view(3, 4) // 16
+    assert torch.equal(frames, torch.arange(3).view(3, 1).expand(3, 4))
+    assert torch.equal(ids_keep[0], tube_mask[0].nonzero().squeeze(1))
+    # The second sample keeps 3 patches per frame and is filled up with removed tokens.
+    assert torch.equal(ids_keep[1, :9], tube_mask[1].nonzero().squeeze(1))
+    assert valid[1, ids_keep[1, 9:]].all()
+    assert (ids_restore[1, :4] >= 48 - 12).all()
+
+
+def test_get_decoder_mask_selects_unseen_patches():
+    tube_mask = torch.zeros(2, 8, dtype=torch.bool)
+    tube_mask[0, :4] = True
+    tube_mask[1, ::2] = True
+
+    decoder_mask = get_decoder_mask(0.5, tube_mask, "cpu")
+
+    expected_decoder_mask = torch.tensor(
+        [[0, 0, 0, 0, 1, 1, 0, 0], [0, 1, 0, 1, 0, 0, 0, 0]], dtype=torch.bool
+    )
+    assert torch.equal(decoder_mask, expected_decoder_mask)
+
+
+def test_running_cell_mask_moves_across_frames():
+    tube_mask = torch.zeros(3 * 8, dtype=torch.bool)
+
+    running_cell_mask = get_running_cell_mask(0.5, 1, 3, tube_mask, "cpu")
+
+    expected_running_cell_mask = torch.tensor(
+        [
+            [0, 1, 0, 1, 0, 1, 0, 1],
+            [1, 0, 1, 0, 1, 0, 1, 0],
+            [0, 1, 0, 1, 0, 1, 0, 1],
+        ],
+        dtype=torch.bool,
+    ).view(1, -1)
+    assert torch.equal(running_cell_mask, expected_running_cell_mask)
+
+
+def test_get_running_cell_mask_excludes_patches_seen_by_encoder():
+    tube_mask = torch.zeros(2 * 8, dtype=torch.bool)
+    tube_mask[[1, 8]] = True
+
+    running_cell_mask = get_running_cell_mask(0.5, 4, 8, tube_mask, "cpu")
+
+    expected_running_cell_mask = get_running_cell_mask(
+        0.5, 4, 8, torch.zeros_like(tube_mask), "cpu"
+    )
+    expected_running_cell_mask[0, [1, 8]] = False
+    assert torch.equal(running_cell_mask, expected_running_cell_mask)
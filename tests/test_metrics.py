@@ -1,6 +1,7 @@
 import torch
 
-from metrics import pearson_correlation
+import utils
+from metrics import ReconstructionMetrics, pearson_correlation
 
 
 def test_get_signal_correlations():
@@ -16,3 +17,103 @@ def test_get_signal_correlations():
 
     assert corr.detach().numpy().shape == ()
     assert torch.isclose(corr, torch.tensor(-1.0))
+
+
+def test_masked_pearson_correlation_matches_indexed_correlation():
+    signal_a = torch.randn(32)
+    signal_b = torch.randn(32)
+    mask = torch.rand(32) > 0.5
+
+    corr = pearson_correlation(signal_a, signal_b, mask)
+
+    assert torch.isclose(corr, pearson_correlation(signal_a[mask], signal_b[mask]))
+
+
+def test_reconstruction_metrics_match_direct_computation():
+    # t * h * w tokens of u * ph * pw * C values.
+    t, h, w, u, ph, pw, C = 3, 2, 2, 2, 2, 1, 3
+    L, D = t * h * w, u * ph * pw * C
+    metrics = ReconstructionMetrics(t * u, (h, w), (ph, pw), u, C)
+
+    targets, preds, weights = [], [], []
+    for N, M in [(2, 5), (3, 7)]:
+        target = torch.randn(N, L, D)
+        pred = target + torch.randn(N, L, D)
+        ids_masked = torch.rand(N, L).argsort(dim=1)[:, :M]
+        weight = (torch.rand(N, M, D) > 0.2).float()
+        gather_idx = ids_masked.unsqueeze(-1).expand(-1, -1, D)
+
+        metrics.update(
+            torch.gather(target, 1, gather_idx),
+            torch.gather(pred, 1, gather_idx),
+            ids_masked,
+            weight,
+        )
+
+        targets.append(target)
+        preds.append(pred)
+        weights.append(torch.zeros(N, L, D).scatter(1, gather_idx, weight))
+
+    # [N, C, T, H, W]
+    target, pred, weight = (
+        utils.unpatchify(torch.cat(x), (ph, pw), u, (h, w))
+        for x in (targets, preds, weights)
+    )
+
+    def expected(index):
+        x, y, mask = target[index].flatten(), pred[index].flatten(), weight[index]
+        mse = (((x - y) ** 2) * mask.flatten()).sum() / mask.sum()
+        return mse, pearson_correlation(x, y, mask.flatten())
+
+    result = metrics.compute()
+    groups = {
+        "": [(...,)],
+        "band_": [(slice(None), c) for c in range(C)],
+        "time_patch_": [
+            (slice(None), slice(None), slice(i * u, (i + 1) * u)) for i in range(t)
+        ],
+        "electrode_": [(..., i, j) for i in range(h * ph) for j in range(w * pw)],
+    }
+    for name, indices in groups.items():
+        mse, correlation = zip(*(expected(index) for index in indices))
+        shape = result[f"{name}mse"].shape
+        assert torch.allclose(
+            result[f"{name}mse"], torch.stack(mse).double().view(shape), atol=1e-5
+        )
+        assert torch.allclose(
+            result[f"{name}correlation"],
+            torch.stack(correlation).double().view(shape),
+            atol=1e-5,
+        )
+
+
+def test_reconstruction_metrics_exclude_non_finite_values_and_missing_electrodes():
+    metrics = ReconstructionMetrics(2, (2, 1), (1, 1), 1, 2)
+    target = torch.randn(1, 4, 2)
+    pred = target.clone()
+    pred[0, 0, 0] = torch.nan
+    weights = torch.ones_like(target)
+    # Tokens 3 and 1 are the electrode at (1, 0) in both frames, it's missing.
+    weights[0, 1:3] = 0.0
+
+    metrics.update(target, pred, torch.tensor([[0, 3, 1, 2]]), weights)
+    result = metrics.compute()
+
+    assert result["mse"] == 0.0
+    assert torch.isclose(result["correlation"], torch.tensor(1.0, dtype=torch.float64))
+    assert result["electrode_mse"][0, 0] == 0.0
+    assert torch.isnan(result["electrode_mse"][1, 0])
+
+
+def test_reconstruction_metrics_synchronize_without_updates(tmp_path):
+    metrics = ReconstructionMetrics(2, (2, 1), (1, 1), 1, 2)
+
+    torch.distributed.init_process_group(
+        "gloo", init_method=f"file://{tmp_path / 'init'}", rank=0, world_size=1
+    )
+    try:
+        metrics.synchronize()
+    finally:
+        torch.distributed.destroy_process_group()
+
+    assert torch.isnan(metrics.compute()["mse"])
@@ -5,7 +5,7 @@ from torch.utils.data import DataLoader
 
 import constants
 from config import ECoGDataConfig
-from mae_st_util.models_mae import MaskedAutoencoderViT
+from mae_st_util.video_vit import MaskedBatchNorm
 from pretrain_engine import model_forward
 
 EMBEDDING_DIM = 64
@@ -14,27 +14,6 @@ NUM_BANDS = 5
 FRAME_PATCH_SIZE = 4
 
 
-@pytest.fixture
-def model():
-    return MaskedAutoencoderViT(
-        img_size=constants.GRID_SIZE,
-        patch_size=1,
-        in_chans=NUM_BANDS,
-        norm_pix_loss=False,
-        num_frames=FRAMES_PER_SAMPLE,
-        t_patch_size=FRAME_PATCH_SIZE,
-        cls_embed=False,
-        pred_t_dim=FRAMES_PER_SAMPLE // FRAME_PATCH_SIZE,
-        embed_dim=EMBEDDING_DIM,
-        depth=2,
-        num_heads=2,
-        decoder_embed_dim=32,
-        decoder_depth=1,
-        decoder_num_heads=1,
-        mlp_ratio=2.0,
-    )
-
-
 def test_model_forward_without_mask_succeeds(model):
     fake_batch = torch.randn(
         16, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
@@ -148,3 +127,634 @@ def test_model_with_data_loader_input_succeeds(model, data_loader_creation_fn):
 
         # Check that loss is set as expected
         assert torch.isclose(-correlations * 0.25 + mse * 0.75, loss)
+
+
+def test_forward_loss_matches_dense_loss_over_masked_patches(model):
+    fake_batch = torch.randn(
+        4, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    fake_batch[:, :, :, 0, 0] = 0.0
+
+    padding_mask = torch.ones(
+        constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[0][0] = False
+    model.initialize_mask(padding_mask)
+
+    latent, mask, ids_restore = model.forward_encoder(fake_batch, 0.75)
+    pred = model.forward_decoder(latent, ids_restore)
+    ids_masked = model.masked_token_ids(ids_restore, latent.shape[1])
+    loss, mse, correlation = model.forward_loss(fake_batch, pred, ids_masked, 0.5)
+
+    # Dense reference: every removed patch which is not padding.
+    target = model.patchify(
+        fake_batch[
+            :, :, torch.linspace(0, FRAMES_PER_SAMPLE - 1, model.pred_t_dim).long()
+        ]
+    )
+    loss_mask = mask.unsqueeze(-1) * model.img_mask_patches
+    expected_mse = (((pred - target) ** 2) * loss_mask).sum() / loss_mask.sum()
+    expected_correlation = np.corrcoef(
+        target[loss_mask.bool()].detach().numpy(),
+        pred[loss_mask.bool()].detach().numpy(),
+    )[0, 1]
+
+    assert ids_masked.shape == (
+        4,
+        int(mask[0].sum()) - FRAMES_PER_SAMPLE // FRAME_PATCH_SIZE,
+    )
+    assert torch.isclose(mse, expected_mse)
+    assert np.isclose(correlation.item(), expected_correlation, atol=1e-5)
+    assert torch.isclose(loss, -0.5 * correlation + 0.5 * mse)
+
+
+def test_initialize_mask_reuses_cached_patch_masks(model, mocker):
+    padding_mask = torch.ones(
+        constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[0][0] = False
+    other_padding_mask = padding_mask.clone()
+    other_padding_mask[1][1] = False
+    build_spy = mocker.spy(model, "_build_patch_masks")
+
+    model.initialize_mask(padding_mask)
+    patch_mask_indices = model.patch_mask_indices
+    model.initialize_mask(padding_mask.clone())
+    model.initialize_mask(other_padding_mask)
+    model.initialize_mask(padding_mask)
+
+    assert build_spy.call_count == 2
+    assert model.patch_mask_indices is patch_mask_indices
+    assert len(model.patch_mask_indices) == constants.GRID_SIZE**2 - 1
+    assert model.n_mask_patches == len(model.patch_mask_indices)
+    assert "img_mask" in dict(model.named_buffers())
+
+
+def test_model_forward_with_per_sample_mask_succeeds(model):
+    fake_batch = torch.randn(
+        4, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    fake_batch[0, :, :, 0, 0] *= torch.nan
+    fake_batch[1, :, :, 0, 0:4] *= torch.nan
+
+    padding_mask = torch.ones(
+        4, constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[0, 0, 0] = False
+    padding_mask[1, 0, 0:4] = False
+
+    model.initialize_mask(padding_mask)
+    loss, mse, pred, mask, latent, correlations = model_forward(
+        model, fake_batch, mask_ratio=0.8, alpha=0.5
+    )
+
+    t_patches = FRAMES_PER_SAMPLE // FRAME_PATCH_SIZE
+    num_patches = t_patches * constants.GRID_SIZE * constants.GRID_SIZE
+    assert model.n_valid_patches == [63, 60, 64, 64]
+    assert not torch.isnan(loss)
+    assert pred.shape == (4, num_patches, NUM_BANDS)
+    assert latent.shape == (4, int(num_patches * (1 - 0.8)), EMBEDDING_DIM)
+    # Each sample keeps its own share of tokens, padded electrodes are never kept.
+    kept = (1 - mask).view(4, t_patches, -1)
+    assert kept.sum((1, 2)).tolist() == [
+        int(t_patches * n * (1 - 0.8)) for n in [63, 60, 64, 64]
+    ]
+    assert kept[0, :, 0].sum() == 0
+    assert kept[1, :, 0:4].sum() == 0
+    assert torch.isclose(-correlations * 0.5 + mse * 0.5, loss)
+
+
+def test_cls_model_forward_with_per_sample_mask_matches_single_sample(
+    model_creation_fn,
+):
+    model = model_creation_fn(cls_embed=True).eval()
+    fake_batch = torch.randn(
+        2, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    fake_batch[0, :, :, 0, 0:3] = 0.0
+    padding_mask = torch.ones(
+        2, constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[0, 0, 0:3] = False
+    noise, decoder_noise = model.generate_noise(2, "cpu")
+
+    with torch.no_grad():
+        model.initialize_mask(padding_mask)
+        batch_pred = model(
+            fake_batch, mask_ratio=0.75, noise=noise, decoder_noise=decoder_noise
+        )[2]
+        model.initialize_mask(padding_mask[:1])
+        single_pred = model(
+            fake_batch[:1],
+            mask_ratio=0.75,
+            noise=noise[:1],
+            decoder_noise=decoder_noise[:1],
+        )[2]
+
+    # The sample with fewer electrodes keeps fewer tokens than the batch is padded to, the padding must not shift
+    # which of its tokens reach the decoder.
+    assert torch.allclose(batch_pred[:1], single_pred, atol=1e-5)
+
+
+def test_forward_features_with_per_sample_mask_matches_single_sample(model):
+    model.eval()
+    # Scaled to signal magnitudes so the running statistics of the input norm give normalized values.
+    fake_batch = 1e-6 * torch.randn(
+        2, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    fake_batch[0, :, :, 2, 3] = 0.0
+
+    padding_mask = torch.ones(
+        2, constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[0, 2, 3] = False
+
+    model.initialize_mask(padding_mask)
+    batch_features = model(fake_batch, forward_features=True)
+    model.initialize_mask(padding_mask[0])
+    single_features = model(fake_batch[:1], forward_features=True)
+
+    assert batch_features.shape == (2, EMBEDDING_DIM)
+    assert torch.allclose(batch_features[:1], single_features, atol=1e-5)
+
+
+@pytest.mark.parametrize("use_rope", [False, True])
+def test_packed_tokens_match_padded_tokens(model, use_rope, model_creation_fn):
+    if use_rope:
+        model = model_creation_fn(cls_embed=True, use_rope=True)
+    fake_batch = torch.randn(
+        3, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    fake_batch[0, :, :, 0, 0:3] = 0.0
+    fake_batch[1, :, :, 5, :] = 0.0
+
+    padding_mask = torch.ones(
+        3, constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[0, 0, 0:3] = False
+    padding_mask[1, 5, :] = False
+    model.initialize_mask(padding_mask)
+
+    torch.manual_seed(0)
+    padded_outputs = model(fake_batch, mask_ratio=0.75)
+    model.pack_tokens = True
+    torch.manual_seed(0)
+    packed_outputs = model(fake_batch, mask_ratio=0.75)
+
+    padded_loss, _, padded_pred, padded_mask, padded_latent, _ = padded_outputs
+    packed_loss, _, packed_pred, packed_mask, packed_latent, _ = packed_outputs
+    keep_mask = model.get_keep_mask(packed_mask, packed_latent.shape[1])
+    assert torch.equal(padded_mask, packed_mask)
+    assert torch.allclose(padded_latent[keep_mask], packed_latent[keep_mask], atol=1e-5)
+    assert torch.allclose(padded_pred, packed_pred, atol=1e-5)
+    assert torch.isclose(padded_loss, packed_loss, atol=1e-5)
+
+
+def test_static_shapes_forward_has_no_graph_breaks(model_creation_fn):
+    model = model_creation_fn(static_shapes=True)
+    fake_batch = torch.randn(
+        4, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    padding_mask = torch.ones(
+        4, constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[0, 0, 0:2] = False
+    model.initialize_mask(padding_mask)
+    noise, decoder_noise = model.generate_noise(4, "cpu")
+
+    train_explanation = torch._dynamo.explain(model)(
+        fake_batch, mask_ratio=0.75, noise=noise, decoder_noise=decoder_noise
+    )
+    features_explanation = torch._dynamo.explain(model)(
+        fake_batch, forward_features=True
+    )
+
+    assert train_explanation.graph_break_count == 0
+    assert features_explanation.graph_break_count == 0
+
+
+def test_static_shapes_forward_matches_dynamic_shapes_forward(model, model_creation_fn):
+    static_model = model_creation_fn(static_shapes=True)
+    static_model.load_state_dict(model.state_dict(), strict=False)
+    fake_batch = torch.randn(
+        4, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    fake_batch[:, :, :, 0, 0:3] = 0.0
+    padding_mask = torch.ones(
+        constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[0, 0:3] = False
+    model.initialize_mask(padding_mask)
+    static_model.initialize_mask(padding_mask)
+    noise, decoder_noise = model.generate_noise(4, "cpu")
+
+    loss, mse, _, mask, _, correlation = model(
+        fake_batch, mask_ratio=0.75, noise=noise, decoder_noise=decoder_noise
+    )
+    static_loss, static_mse, _, static_mask, static_latent, static_correlation = (
+        static_model(
+            fake_batch, mask_ratio=0.75, noise=noise, decoder_noise=decoder_noise
+        )
+    )
+
+    num_patches = FRAMES_PER_SAMPLE // FRAME_PATCH_SIZE * constants.GRID_SIZE**2
+    assert static_latent.shape == (4, int(num_patches * 0.25), EMBEDDING_DIM)
+    assert torch.equal(mask, static_mask)
+    assert torch.isclose(loss, static_loss, atol=1e-5)
+    assert torch.isclose(mse, static_mse, atol=1e-5)
+    assert torch.isclose(correlation, static_correlation, atol=1e-5)
+
+
+def test_rope_model_forward_with_per_sample_mask_succeeds(model_creation_fn):
+    model = model_creation_fn(cls_embed=True, use_rope=True)
+    fake_batch = torch.randn(
+        4, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    padding_mask = torch.ones(
+        4, constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[1, 0, 0:4] = False
+    fake_batch[1, :, :, 0, 0:4] = 0.0
+    model.initialize_mask(padding_mask)
+
+    loss, mse, pred, mask, latent, correlations = model_forward(
+        model, fake_batch, mask_ratio=0.8, alpha=0.5
+    )
+    features = model(fake_batch, forward_features=True)
+
+    assert not any("pos_embed" in name for name, _ in model.named_parameters())
+    assert not torch.isnan(loss)
+    assert features.shape == (4, EMBEDDING_DIM)
+    assert not torch.isnan(features).any()
+
+
+def test_rope_static_shapes_forward_matches_dynamic_shapes_forward(model_creation_fn):
+    torch.manual_seed(0)
+    model = model_creation_fn(use_rope=True)
+    static_model = model_creation_fn(use_rope=True, static_shapes=True)
+    static_model.load_state_dict(model.state_dict())
+    model.eval()
+    static_model.eval()
+    # Scaled to signal magnitudes so the running statistics of the input norm give normalized values.
+    fake_batch = 1e-6 * torch.randn(
+        4, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    fake_batch[:, :, :, 0, 0:3] = 0.0
+    padding_mask = torch.ones(
+        constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[0, 0:3] = False
+    model.initialize_mask(padding_mask)
+    static_model.initialize_mask(padding_mask)
+    noise, decoder_noise = model.generate_noise(4, "cpu")
+
+    # Tokens are selected differently, so this only matches if every token keeps its position.
+    loss, _, _, _, _, _ = model(
+        fake_batch, mask_ratio=0.75, noise=noise, decoder_noise=decoder_noise
+    )
+    static_loss, _, _, _, _, _ = static_model(
+        fake_batch, mask_ratio=0.75, noise=noise, decoder_noise=decoder_noise
+    )
+    features = model(fake_batch, forward_features=True)
+    static_features = static_model(fake_batch, forward_features=True)
+
+    assert torch.isclose(loss, static_loss, atol=1e-5)
+    assert torch.allclose(features, static_features, atol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "model_kwargs",
+    [{"sep_pos_embed": True}, {"sep_pos_embed": False}, {"use_rope": True}],
+)
+def test_forward_features_accepts_other_sample_lengths(model_kwargs, model_creation_fn):
+    model = model_creation_fn(cls_embed=True, depth=1, mlp_ratio=4.0, **model_kwargs)
+    model.eval()
+    padding_mask = torch.ones(
+        constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[0, 0] = False
+    model.initialize_mask(padding_mask)
+    fake_batch = 1e-6 * torch.randn(
+        2, NUM_BANDS, 2 * FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+
+    with torch.no_grad():
+        long_features = model(fake_batch, forward_features=True)
+        cached_features = model(fake_batch, forward_features=True)
+        short_features = model(
+            fake_batch[:, :, :FRAME_PATCH_SIZE], forward_features=True
+        )
+
+    assert long_features.shape == (2, EMBEDDING_DIM)
+    assert short_features.shape == (2, EMBEDDING_DIM)
+    assert torch.equal(long_features, cached_features)
+    assert len(model._pos_embed_cache) == (0 if model.use_rope else 2)
+
+
+def test_interpolated_temporal_pos_embed_is_cached_until_updated(model):
+    assert torch.equal(
+        model.get_pos_embed(t_grid_size=model.input_size[0]), model.get_pos_embed()
+    )
+    # Gradients flow through the interpolation when training.
+    assert model.get_pos_embed(t_grid_size=5).shape == (
+        1,
+        5 * constants.GRID_SIZE**2,
+        EMBEDDING_DIM,
+    )
+    assert model.get_pos_embed(t_grid_size=5).requires_grad
+
+    with torch.no_grad():
+        cached = model.interpolate_pos_embed(model.pos_embed_temporal, 5)
+        assert model.interpolate_pos_embed(model.pos_embed_temporal, 5) is cached
+        model.pos_embed_temporal.add_(1.0)
+        assert torch.allclose(
+            model.interpolate_pos_embed(model.pos_embed_temporal, 5), cached + 1.0
+        )
+
+        # Only the most recent lengths are kept.
+        for t_grid_size in range(2, 4 + 2 * model.POS_EMBED_CACHE_SIZE):
+            model.interpolate_pos_embed(model.pos_embed_temporal, t_grid_size)
+        assert len(model._pos_embed_cache) == model.POS_EMBED_CACHE_SIZE
+
+        # Replaced embeddings aren't mistaken for the cached ones.
+        model.pos_embed_temporal = torch.nn.Parameter(model.pos_embed_temporal + 1.0)
+        assert torch.allclose(
+            model.interpolate_pos_embed(model.pos_embed_temporal, 5), cached + 2.0
+        )
+
+
+def test_embed_stream_matches_embedding_each_window(model):
+    model.eval()
+    padding_mask = torch.ones(
+        constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[0, 0] = False
+    model.initialize_mask(padding_mask)
+    recording = 1e-6 * torch.randn(
+        NUM_BANDS, 3 * FRAMES_PER_SAMPLE + 6, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    # Chunks of irregular sizes which don't line up with windows or temporal patches.
+    chunks = recording.split([7, 50, 3, 33, 20, 13], dim=1)
+    hop_size = 3 * FRAME_PATCH_SIZE
+
+    windows = list(model.embed_stream(iter(chunks), hop_size=hop_size, batch_size=3))
+    frame_windows = list(
+        model.embed_stream(recording, hop_size=hop_size, per_frame=True)
+    )
+
+    starts = list(range(0, recording.shape[1] - FRAMES_PER_SAMPLE + 1, hop_size))
+    with torch.no_grad():
+        expected = model(
+            torch.stack([recording[:, s : s + FRAMES_PER_SAMPLE] for s in starts]),
+            forward_features=True,
+        )
+    assert [start for start, _ in windows] == starts
+    assert torch.allclose(torch.stack([e for _, e in windows]), expected, atol=1e-5)
+    assert [start for start, _ in frame_windows] == starts
+    assert frame_windows[0][1].shape == (
+        FRAMES_PER_SAMPLE // FRAME_PATCH_SIZE,
+        EMBEDDING_DIM,
+    )
+    # Per frame embeddings average to the window embedding.
+    assert torch.allclose(frame_windows[1][1].mean(dim=0), expected[1], atol=1e-5)
+
+
+def test_embed_stream_in_train_mode_embeds_like_eval_mode(model):
+    model.train()
+    model.initialize_mask(
+        torch.ones(constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool)
+    )
+    recording = 1e-6 * torch.randn(
+        NUM_BANDS, 2 * FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    running_mean = model.masked_input_norm.bn.running_mean.clone()
+
+    embeddings = torch.stack([e for _, e in model.embed_stream(recording)])
+
+    assert model.training
+    assert not embeddings.requires_grad
+    assert torch.equal(model.masked_input_norm.bn.running_mean, running_mean)
+    model.eval()
+    with torch.no_grad():
+        expected = model(
+            recording.unflatten(1, (2, FRAMES_PER_SAMPLE)).transpose(0, 1),
+            forward_features=True,
+        )
+    assert torch.allclose(embeddings, expected, atol=1e-5)
+
+
+def test_masked_batch_norm_matches_batch_norm_over_masked_values():
+    norm = MaskedBatchNorm(NUM_BANDS, scale_factor=1.0)
+    reference_norm = torch.nn.BatchNorm1d(NUM_BANDS, affine=False)
+    x = torch.randn(3, NUM_BANDS, 4, constants.GRID_SIZE, constants.GRID_SIZE)
+    mask = torch.rand(3, constants.GRID_SIZE, constants.GRID_SIZE) > 0.3
+
+    for _ in range(2):
+        normed = norm(x, mask)
+        # Reference: batch norm over only the values of present electrodes.
+        values = x.permute(0, 2, 3, 4, 1)[mask.unsqueeze(1).expand(-1, 4, -1, -1)]
+        expected = reference_norm(values)
+
+    actual = normed.permute(0, 2, 3, 4, 1)[mask.unsqueeze(1).expand(-1, 4, -1, -1)]
+    assert torch.allclose(actual, expected, atol=1e-5)
+    assert torch.allclose(norm.bn.running_mean, reference_norm.running_mean)
+    assert torch.allclose(norm.bn.running_var, reference_norm.running_var)
+    assert norm.bn.num_batches_tracked == reference_norm.num_batches_tracked
+    # Padded values are passed through.
+    assert torch.equal(
+        normed[~mask.unsqueeze(1).unsqueeze(1).expand_as(x)],
+        x[~mask.unsqueeze(1).unsqueeze(1).expand_as(x)],
+    )
+
+
+def test_masked_batch_norm_folds_scale_factor_into_statistics():
+    norm = MaskedBatchNorm(NUM_BANDS)
+    reference_norm = MaskedBatchNorm(NUM_BANDS, scale_factor=1.0)
+    # Small offset signals like raw ECoG, where scaling is needed for the variance to not vanish next to eps.
+    x = (
+        torch.randn(3, NUM_BANDS, 4, constants.GRID_SIZE, constants.GRID_SIZE) + 3
+    ) * 1e-6
+    mask = torch.rand(3, constants.GRID_SIZE, constants.GRID_SIZE) > 0.3
+
+    for training in (True, False):
+        norm.train(training)
+        reference_norm.train(training)
+        normed = norm(x, mask)
+        expected = reference_norm(x * 1e6, mask)
+
+        assert torch.allclose(normed, expected, atol=1e-4)
+    assert torch.allclose(norm.bn.running_mean, reference_norm.bn.running_mean)
+    assert torch.allclose(norm.bn.running_var, reference_norm.bn.running_var)
+
+
+def test_masked_batch_norm_is_stable_for_large_means():
+    norm = MaskedBatchNorm(NUM_BANDS, scale_factor=1.0)
+    x = torch.randn(3, NUM_BANDS, 40, constants.GRID_SIZE, constants.GRID_SIZE) + 1e4
+    mask = torch.rand(3, constants.GRID_SIZE, constants.GRID_SIZE) > 0.3
+
+    norm(x, mask)
+
+    values = x.permute(0, 2, 3, 4, 1)[mask.unsqueeze(1).expand(-1, 40, -1, -1)]
+    expected_var = values.double().var(dim=0)
+    assert torch.allclose(
+        norm.bn.running_var, 0.9 + 0.1 * expected_var.float(), rtol=1e-3
+    )
+
+
+def test_unpatchify_is_independent_of_previous_patchify(model):
+    pred = torch.randn(
+        2,
+        FRAMES_PER_SAMPLE // FRAME_PATCH_SIZE * constants.GRID_SIZE**2,
+        NUM_BANDS,
+    )
+    imgs = model.unpatchify(pred)
+
+    # Patchifying a tensor of a different shape, as initialize_mask does, must not change unpatchify.
+    model.patchify(torch.randn(1, 1, model.pred_t_dim, constants.GRID_SIZE, 4))
+    model.initialize_mask(
+        torch.ones(constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool)
+    )
+
+    assert imgs.shape == (
+        2,
+        NUM_BANDS,
+        model.pred_t_dim,
+        constants.GRID_SIZE,
+        constants.GRID_SIZE,
+    )
+    assert torch.equal(model.unpatchify(pred), imgs)
+    assert torch.equal(model.patchify(imgs), pred)
+
+
+def test_bf16_autocast_keeps_norm_and_loss_in_fp32(model):
+    fake_batch = torch.randn(
+        2, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    padding_mask = torch.ones(
+        constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[0, 0] = False
+    model.initialize_mask(padding_mask)
+
+    with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+        # Inputs scaled by 1e6 would overflow fp16 if normalized in half precision.
+        normed = model.masked_input_norm(fake_batch.half(), model.img_mask)
+        loss, mse, pred, _, _, correlation = model(fake_batch, mask_ratio=0.75)
+
+    assert normed.dtype == torch.float32
+    assert torch.isfinite(normed).all()
+    assert pred.dtype == torch.bfloat16
+    assert loss.dtype == torch.float32
+    assert torch.isfinite(loss)
+    assert torch.isclose(-correlation * 0.5 + mse * 0.5, loss)
+
+
+def test_masks_are_reproducible_with_generator(model):
+    fake_batch = torch.randn(
+        4, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    padding_mask = torch.ones(
+        constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[0, 0:3] = False
+    model.initialize_mask(padding_mask)
+    model.eval()
+
+    loss, _, _, mask, _, _ = model_forward(
+        model,
+        fake_batch,
+        mask_ratio=0.75,
+        alpha=0.5,
+        generator=torch.Generator().manual_seed(0),
+    )
+    other_loss, _, _, other_mask, _, _ = model_forward(
+        model,
+        fake_batch,
+        mask_ratio=0.75,
+        alpha=0.5,
+        generator=torch.Generator().manual_seed(0),
+    )
+
+    assert torch.equal(mask, other_mask)
+    assert torch.equal(loss, other_loss)
+    # Missing patches are never kept.
+    assert (mask.view(4, -1, constants.GRID_SIZE**2)[:, :, 0:3] == 1).all()
+
+
+@pytest.mark.parametrize("static_shapes", [False, True])
+def test_tube_and_running_cell_masking(static_shapes, model_creation_fn):
+    model = model_creation_fn(
+        pct_masks_to_decode=0.5,
+        mask_strategy="tube",
+        decoder_mask_strategy="running_cell",
+        static_shapes=static_shapes,
+    )
+    fake_batch = torch.randn(
+        4, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    padding_mask = torch.ones(
+        constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[0, 0:2] = False
+    model.initialize_mask(padding_mask)
+    generator = torch.Generator().manual_seed(0)
+    noise, decoder_noise = model.generate_noise(4, "cpu", generator)
+
+    loss, _, _, mask, latent, _ = model(
+        fake_batch, mask_ratio=0.75, noise=noise, decoder_noise=decoder_noise
+    )
+    decoded_patches = model.select_decoder_patches(decoder_noise)
+
+    # The same 15 of the 62 patches with signal are kept in every frame.
+    T = FRAMES_PER_SAMPLE // FRAME_PATCH_SIZE
+    kept = (1 - mask).view(4, T, -1)
+    assert (kept == kept[:, :1]).all()
+    assert (kept[:, 0].sum(dim=1) == 15).all()
+    assert (kept[:, 0, 0:2] == 0).all()
+    assert latent.shape[1] == T * (16 if static_shapes else 15)
+    # Every other patch is decoded in turns across frames.
+    assert decoded_patches.shape == (4, T, 32 if static_shapes else 31)
+    assert (decoded_patches[:, 0] % 2 != decoded_patches[:, 1] % 2).all()
+    assert not torch.isnan(loss)
+
+
+@pytest.mark.parametrize("per_sample_mask", [False, True])
+def test_multiple_masks_per_sample_share_embedding(
+    model, per_sample_mask, model_creation_fn
+):
+    multi_mask_model = model_creation_fn(num_masks=3)
+    multi_mask_model.load_state_dict(model.state_dict())
+    model.eval()
+    multi_mask_model.eval()
+    fake_batch = torch.randn(
+        4, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    padding_mask = torch.ones(
+        4, constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    if per_sample_mask:
+        padding_mask[1, 0, 0:4] = False
+        fake_batch[1, :, :, 0, 0:4] = 0.0
+    model.initialize_mask(padding_mask)
+    multi_mask_model.initialize_mask(padding_mask)
+    noise, decoder_noise = model.generate_noise(4, "cpu")
+
+    loss, mse, _, mask, _, correlation = model(
+        fake_batch, mask_ratio=0.75, noise=noise, decoder_noise=decoder_noise
+    )
+    # Every sample gets its mask from the single mask model three times.
+    multi_loss, multi_mse, pred, multi_mask, _, multi_correlation = multi_mask_model(
+        fake_batch,
+        mask_ratio=0.75,
+        noise=noise.repeat_interleave(3, dim=0),
+        decoder_noise=decoder_noise.repeat_interleave(3, dim=0),
+    )
+
+    assert pred.shape[0] == 12
+    assert torch.equal(multi_mask, mask.repeat_interleave(3, dim=0))
+    assert torch.isclose(loss, multi_loss, atol=1e-5)
+    assert torch.isclose(mse, multi_mse, atol=1e-5)
+    assert torch.isclose(correlation, multi_correlation, atol=1e-5)
+    # The per-sample masks are restored after the forward pass.
+    assert multi_mask_model.patch_mask.shape[0] == (4 if per_sample_mask else 64)
+    assert multi_mask_model.generate_noise(4, "cpu")[0].shape[0] == 12
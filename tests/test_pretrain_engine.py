@@ -0,0 +1,341 @@
+import copy
+import logging
+
+from accelerate import Accelerator
+import numpy as np
+import pytest
+import torch
+from torch.distributed.optim import ZeroRedundancyOptimizer
+
+import constants
+import pretrain_engine
+from config import VideoMAEExperimentConfig
+from pretrain_engine import (
+    SkippableLRScheduler,
+    optimizer_step,
+    train_single_epoch,
+    train_step,
+)
+
+NUM_BANDS = 5
+FRAMES_PER_SAMPLE = 40
+FRAME_PATCH_SIZE = 4
+
+
+@pytest.mark.parametrize("implementation", ["foreach", "fused"])
+def test_train_single_epoch_skips_nan_loss_on_device(model, mocker, implementation):
+    config = VideoMAEExperimentConfig(job_name="test")
+    config.video_mae_task_config.encoder_mask_ratio = 0.5
+    config.logging_config.print_freq = 1
+    batch = torch.randn(
+        2, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    optimizer = torch.optim.AdamW(
+        model.parameters(),
+        lr=1e-3,
+        weight_decay=0.1,
+        foreach=implementation == "foreach",
+        fused=implementation == "fused",
+    )
+    lr_scheduler = torch.optim.lr_scheduler.LambdaLR(
+        optimizer, lambda step: 1.0 / (step + 1)
+    )
+
+    def run_epoch():
+        return train_single_epoch(
+            [batch],
+            0,
+            Accelerator(cpu=True),
+            optimizer,
+            lr_scheduler,
+            "cpu",
+            model,
+            config,
+            logging.getLogger(),
+        )
+
+    # A finite step first so the optimizer has state to leave untouched.
+    run_epoch()
+    params_before = [p.detach().clone() for p in model.parameters()]
+    state_before = copy.deepcopy(optimizer.state_dict())
+    lr_scheduler_before = lr_scheduler.state_dict()
+
+    # Force a nan loss which still depends on the model parameters so gradients are nan as well.
+    def nan_loss(imgs, pred, *args, **kwargs):
+        loss = pred.sum() * torch.nan
+        return loss, loss, loss
+
+    mocker.patch.object(model, "forward_loss", side_effect=nan_loss)
+    stats = run_epoch()
+
+    for param in model.parameters():
+        assert torch.all(param.grad == 0)
+    # Neither weight decay nor momentum was applied and the step count didn't advance.
+    for before, after in zip(params_before, model.parameters()):
+        assert torch.equal(before, after)
+    state_after = optimizer.state_dict()["state"]
+    for key, state in state_before["state"].items():
+        for name, value in state.items():
+            assert torch.equal(value, state_after[key][name])
+    assert lr_scheduler.state_dict() == lr_scheduler_before
+    assert stats["loss"] is None
+
+
+def _step_sharded_optimizer(rank, world_size, init_file, implementation):
+    torch.distributed.init_process_group(
+        "gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size
+    )
+    try:
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.Linear(4, 2))
+        optimizer = ZeroRedundancyOptimizer(
+            model.parameters(),
+            optimizer_class=torch.optim.AdamW,
+            lr=1.0,
+            foreach=implementation == "foreach",
+            fused=implementation == "fused",
+        )
+        for finite in (True, False):
+            optimizer.zero_grad()
+            model(torch.ones(1, 4)).sum().backward()
+            before = [param.detach().clone() for param in model.parameters()]
+
+            optimizer_step(optimizer, is_finite=torch.tensor(finite))
+
+            unchanged = [
+                torch.equal(param, previous)
+                for param, previous in zip(model.parameters(), before)
+            ]
+            assert not any(unchanged) if finite else all(unchanged)
+
+        optimizer.consolidate_state_dict(to=0)
+        if rank == 0:
+            assert len(optimizer.state_dict()["state"]) == 4
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+@pytest.mark.parametrize("implementation", ["foreach", "fused"])
+def test_optimizer_step_skips_sharded_step_and_consolidates_state(
+    tmp_path, implementation
+):
+    world_size = 2
+    torch.multiprocessing.spawn(
+        _step_sharded_optimizer,
+        args=(world_size, str(tmp_path / "init"), implementation),
+        nprocs=world_size,
+    )
+
+
+def test_optimizer_step_skips_overflowing_fp16_step():
+    param = torch.nn.Parameter(torch.ones(3))
+    optimizer = torch.optim.SGD([param], lr=1.0)
+    scaler = torch.amp.GradScaler("cpu", init_scale=2.0**16)
+
+    scaler.scale(param.sum() * torch.inf).backward()
+    overflowed = optimizer_step(optimizer, scaler)
+
+    assert overflowed
+    assert torch.equal(param.detach(), torch.ones(3))
+    assert scaler.get_scale() < 2.0**16
+
+    optimizer.zero_grad()
+    scaler.scale(param.sum()).backward()
+    assert not optimizer_step(optimizer, scaler)
+    assert torch.equal(param.detach(), torch.zeros(3))
+
+
+def test_compiled_train_step_only_breaks_the_graph_at_the_optimizer_step(model):
+    model.static_shapes = True
+    fake_batch = torch.randn(
+        4, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    padding_mask = torch.ones(
+        4, constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    padding_mask[0, 0, 0:2] = False
+    model.initialize_mask(padding_mask)
+    optimizer = torch.optim.AdamW(model.parameters(), foreach=True)
+    lr_scheduler = SkippableLRScheduler(
+        torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 1.0)
+    )
+
+    def step(signal):
+        metrics, is_finite = train_step(model, signal, 0.75, 0.5, 1.0)
+        lr_scheduler.flush()
+        optimizer_step(optimizer, is_finite=is_finite)
+        lr_scheduler.step(is_finite)
+        return metrics
+
+    with torch._dynamo.config.patch(trace_autograd_ops=True):
+        train_step_explanation = torch._dynamo.explain(train_step)(
+            model, fake_batch, 0.75, 0.5, 1.0
+        )
+        torch._dynamo.reset()
+        step_explanation = torch._dynamo.explain(step)(fake_batch)
+
+    # Forward and backward are a single graph.
+    assert train_step_explanation.graph_count == 1
+    assert train_step_explanation.graph_break_count == 0
+    # torch.optim breaks the graph around optimizer.step by design, nothing else does.
+    assert step_explanation.break_reasons
+    for break_reason in step_explanation.break_reasons:
+        assert break_reason.user_stack[-1].line == "optimizer.step()"
+
+
+def test_train_single_epoch_accumulates_micro_batches(model, mocker):
+    config = VideoMAEExperimentConfig(job_name="test")
+    config.video_mae_task_config.encoder_mask_ratio = 0.5
+    config.logging_config.print_freq = 1
+    config.trainer_config.micro_batch_size = 1
+    batches = [
+        torch.randn(
+            2, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+        )
+        for _ in range(3)
+    ]
+
+    forward = mocker.spy(model, "forward")
+    step = mocker.spy(pretrain_engine, "optimizer_step")
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3, weight_decay=0.0)
+    lr_scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda _: 1.0)
+    accelerator = Accelerator(cpu=True, gradient_accumulation_steps=2)
+
+    train_single_epoch(
+        batches,
+        0,
+        accelerator,
+        optimizer,
+        lr_scheduler,
+        "cpu",
+        model,
+        config,
+        logging.getLogger(),
+    )
+
+    assert forward.call_count == 6
+    # One step after the first two batches and one for the last batch of the epoch.
+    assert step.call_count == 2
+    assert lr_scheduler.last_epoch == 2
+
+
+@pytest.mark.parametrize(
+    "micro_batch_size, gradient_accumulation_steps", [(1, 1), (0, 2), (1, 2)]
+)
+def test_accumulated_gradients_match_full_batch_gradients(
+    model, mocker, micro_batch_size, gradient_accumulation_steps
+):
+    config = VideoMAEExperimentConfig(job_name="test")
+    config.video_mae_task_config.encoder_mask_ratio = 0.5
+    # The correlation term of the loss is taken over all samples at once, the mse averages over them.
+    config.video_mae_task_config.alpha = 0.0
+    batch = 1e-6 * torch.randn(
+        4, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    # Every sample is masked the same however the batch is split, and normalized with the running statistics
+    # instead of those of the micro-batch.
+    model.static_shapes = True
+    model.eval()
+    mocker.patch.object(model, "train")
+    noise, decoder_noise = model.generate_noise(4, "cpu")
+    offset = 0
+
+    def generate_noise(batch_size, device, generator=None):
+        nonlocal offset
+        samples = slice(offset, offset + batch_size)
+        offset = (offset + batch_size) % 4
+        return noise[samples], decoder_noise[samples]
+
+    mocker.patch.object(model, "generate_noise", side_effect=generate_noise)
+
+    def get_gradients(batches, accelerator):
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.0)
+        lr_scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda _: 1.0)
+        train_single_epoch(
+            batches,
+            0,
+            accelerator,
+            optimizer,
+            lr_scheduler,
+            "cpu",
+            model,
+            config,
+            logging.getLogger(),
+        )
+        return [param.grad.clone() for param in model.parameters()]
+
+    expected = get_gradients([batch], Accelerator(cpu=True))
+    config.trainer_config.micro_batch_size = micro_batch_size
+    actual = get_gradients(
+        list(batch.chunk(gradient_accumulation_steps)),
+        Accelerator(cpu=True, gradient_accumulation_steps=gradient_accumulation_steps),
+    )
+
+    for actual_grad, expected_grad in zip(actual, expected):
+        assert torch.allclose(actual_grad, expected_grad, rtol=1e-4, atol=1e-7)
+
+
+def test_find_micro_batch_size_halves_until_the_batch_fits(model, mocker):
+    batch = torch.randn(
+        8, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    padding_mask = torch.ones(
+        8, constants.GRID_SIZE, constants.GRID_SIZE, dtype=torch.bool
+    )
+    model_forward = pretrain_engine.model_forward
+
+    def forward_fitting_two_samples(model, signal, *args):
+        if len(signal) > 2:
+            raise torch.cuda.OutOfMemoryError()
+        return model_forward(model, signal, *args)
+
+    forward = mocker.patch.object(
+        pretrain_engine, "model_forward", side_effect=forward_fitting_two_samples
+    )
+    bn = model.masked_input_norm.bn
+    running_stats = [buffer.clone() for buffer in bn.buffers()]
+
+    micro_batch_size = pretrain_engine.find_micro_batch_size(
+        model, batch, padding_mask, "cpu", 0.5, 0.5, Accelerator(cpu=True)
+    )
+
+    assert micro_batch_size == 2
+    assert [len(call.args[1]) for call in forward.call_args_list] == [8, 4, 2]
+    # Probing leaves the model as it was.
+    assert all(param.grad is None for param in model.parameters())
+    for buffer, previous in zip(bn.buffers(), running_stats):
+        assert torch.equal(buffer, previous)
+
+
+def test_test_single_epoch_breaks_down_metrics(model, mocker):
+    config = VideoMAEExperimentConfig(job_name="test")
+    config.video_mae_task_config.encoder_mask_ratio = 0.5
+    batch = torch.randn(
+        2, NUM_BANDS, FRAMES_PER_SAMPLE, constants.GRID_SIZE, constants.GRID_SIZE
+    )
+    # Missing electrode.
+    batch[:, :, :, 0, 0] = torch.nan
+    mocker.patch.object(pretrain_engine, "save_reconstruction_plot")
+
+    stats = pretrain_engine.test_single_epoch(
+        [batch, batch], 0, "cpu", model, config, logging.getLogger()
+    )
+
+    assert set(stats) == {
+        "loss",
+        "mse",
+        "correlation",
+        "electrode_mse",
+        "electrode_correlation",
+        "band_mse",
+        "band_correlation",
+        "time_patch_mse",
+        "time_patch_correlation",
+    }
+    assert stats["electrode_mse"].shape == (constants.GRID_SIZE, constants.GRID_SIZE)
+    assert stats["band_mse"].shape == (NUM_BANDS,)
+    assert stats["time_patch_mse"].shape == (model.pred_t_dim,)
+    assert np.isnan(stats["electrode_mse"][0, 0])
+    assert np.isfinite(stats["electrode_mse"][1:]).all()
+    assert np.isfinite(stats["band_correlation"]).all()
+    assert np.isfinite([stats["loss"], stats["mse"], stats["correlation"]]).all()
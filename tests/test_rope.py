@@ -0,0 +1,28 @@
+import torch
+
+from rope import RotaryPositionalEmbeddings4D, apply_rotary_embedding
+
+
+def test_rotary_embeddings_depend_on_relative_positions():
+    rope = RotaryPositionalEmbeddings4D(
+        16, grid_height=4, grid_width=4, grid_depth=1, grid_time=2
+    )
+    q = torch.randn(1, 1, 1, 16)
+    k = torch.randn(1, 1, 1, 16)
+    frame_size = 4 * 4
+
+    def score(q_position, k_position):
+        q_rope = rope(torch.tensor([[q_position]]))
+        k_rope = rope(torch.tensor([[k_position]]), grid_time=4)
+        return (
+            apply_rotary_embedding(q, *q_rope) * apply_rotary_embedding(k, *k_rope)
+        ).sum()
+
+    # Shifting both tokens by a frame, including past grid_time, keeps the score.
+    assert torch.isclose(score(5, 2), score(5 + frame_size, 2 + frame_size), atol=1e-5)
+    assert torch.isclose(
+        score(5, 2), score(5 + 3 * frame_size, 2 + 3 * frame_size), atol=1e-5
+    )
+    assert not torch.isclose(score(5, 2), score(5, 3))
+    # Tokens without a position aren't rotated.
+    assert torch.equal(apply_rotary_embedding(q, *rope(torch.tensor([[-1]]))), q)
@@ -7,7 +7,13 @@ import torch
 
 from config import ViTConfig
 from mask import get_tube_mask, get_decoder_mask
-from utils import resample_mean_signals, rearrange_signals, get_signal_correlations
+from utils import (
+    resample_mean_signals,
+    rearrange_signals,
+    get_signal_correlations,
+    patchify,
+    unpatchify,
+)
 
 FRAME_PATCH_SIZE = 4
 NUM_BANDS = 5
@@ -95,6 +101,54 @@ def test_resampling_can_handle_non_divisible_sampling_rates():
     )
 
 
+def test_patchify_matches_einops_and_unpatchify_inverts_it():
+    imgs = torch.randn(2, NUM_BANDS, NUM_FRAMES, GRID_HEIGHT, GRID_WIDTH)
+
+    patches = patchify(imgs, (2, 2), FRAME_PATCH_SIZE)
+
+    expected_patches = rearrange(
+        imgs,
+        "n c (t u) (h ph) (w pw) -> n (t h w) (u ph pw c)",
+        u=FRAME_PATCH_SIZE,
+        ph=2,
+        pw=2,
+    )
+    assert torch.equal(patches, expected_patches)
+    assert torch.equal(
+        unpatchify(
+            patches, (2, 2), FRAME_PATCH_SIZE, (GRID_HEIGHT // 2, GRID_WIDTH // 2)
+        ),
+        imgs,
+    )
+
+
 def test_apply_mask_to_batch(fake_model):
     batch = torch.ones(2, 2, 8, 2, 2)
     mask = torch.tensor([[], []])
+
+
+def test_get_signal_correlations_matches_corrcoef_and_ignores_padding():
+    signal_a = torch.randn(3, 4, NUM_BANDS, 20)
+    signal_b = signal_a + torch.randn(3, 4, NUM_BANDS, 20)
+    # Electrode 1 is padded in the first sample and electrode 2 in every sample.
+    signal_a[0, 1] = torch.nan
+    signal_b[:, 2] = torch.nan
+
+    correlations = get_signal_correlations(signal_a, signal_b)
+
+    assert correlations.shape == (4, NUM_BANDS)
+    for electrode in [0, 1, 3]:
+        for band in range(NUM_BANDS):
+            expected = np.nanmean(
+                [
+                    np.corrcoef(
+                        signal_a[batch, electrode, band],
+                        signal_b[batch, electrode, band],
+                    )[0, 1]
+                    for batch in range(3)
+                ]
+            )
+            assert correlations[electrode, band].item() == pytest.approx(
+                expected, abs=1e-5
+            )
+    assert torch.all(torch.isnan(correlations[2]))